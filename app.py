@@ -1,18 +1,23 @@
-import requests, os
-from flask import Flask, render_template, redirect, session, g, flash, request, url_for
+import os, sys, math, time, tempfile, click
+from datetime import datetime, timedelta
+from flask import Flask, render_template, redirect, session, g, flash, request, url_for, jsonify, Response, stream_with_context
 from flask_debugtoolbar import DebugToolbarExtension
+from jinja2 import FileSystemBytecodeCache
 from sqlalchemy.exc import IntegrityError, InvalidRequestError
-from models import connect_db, db, bcrypt, Role, User, Tag, Movie, MovieComment, MovieCommentTag
-from forms import SearchForm, UserEditForm, UserLoginForm, UserSignUpForm, MovieCommentForm, TagForm, UserRoleForm
+from sqlalchemy.orm import joinedload
+from models import connect_db, db, bcrypt, Role, User, Tag, Movie, MovieComment, MovieCommentTag, RelatedMovie, RelatedTag, TagUsage, ModerationJob
+from forms import SearchForm, UserEditForm, UserLoginForm, UserSignUpForm, MovieCommentForm, TagForm, UserRoleForm, ModerationForm
+from limiter import RateLimiter, Capacity, Overloaded, make_backend
+from metrics import metrics
+import export, bulk_import, related, rollups, refresher, tmdb, suggest, moderation, viewmodels, profiling, counters, trends, versions, planner
+from compression import Compressor
+from tmdb import API_POSTER_PATH, NO_POSTER_PATH
 try:
     from secrets import SECRET_KEY, TMDB_API_KEY
 except: 
     SECRET_KEY = "no secrets file"
     TMDB_API_KEY = "api key not properly set"
 
-API_BASE_URL = "https://api.themoviedb.org/3/"
-API_POSTER_PATH = "https://image.tmdb.org/t/p/w600_and_h900_bestv2"
-NO_POSTER_PATH = "./static/no-poster.png"
 CURR_USER_KEY = "curr_user"
 DATABASE_NAME = "bimd"
 
@@ -26,11 +31,59 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', SECRET_KEY)
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+app.config['DB_POOL_SIZE'] = int(os.environ.get("DB_POOL_SIZE", 5))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get("DB_POOL_TIMEOUT", 10)) # seconds to wait for a connection
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get("DB_POOL_RECYCLE", 1800)) # seconds before a connection is replaced
+app.config['DB_POOL_PRE_PING'] = os.environ.get("DB_POOL_PRE_PING", "1") == "1"
+app.config['DB_STATEMENT_TIMEOUT'] = int(os.environ.get("DB_STATEMENT_TIMEOUT", 0)) # milliseconds, 0 for none
+app.config['DB_PGBOUNCER'] = os.environ.get("DB_PGBOUNCER", "0") == "1"
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get("RATE_LIMIT_BACKEND", "memory") # "memory" or "database"
+app.config['RATE_LIMIT_ENABLED'] = os.environ.get("RATE_LIMIT_ENABLED", "1") == "1"
+app.config['TMDB_CAPACITY'] = int(os.environ.get("TMDB_CAPACITY", 8))
+app.config['BCRYPT_CAPACITY'] = int(os.environ.get("BCRYPT_CAPACITY", 4))
+app.config['SUGGEST_SNAPSHOT'] = os.environ.get("SUGGEST_SNAPSHOT", os.path.join(tempfile.gettempdir(), "bimd-suggest.idx"))
+app.config['SUGGEST_REFRESH'] = int(os.environ.get("SUGGEST_REFRESH", suggest.REFRESH_EVERY)) # seconds
+app.config['TEMPLATE_CACHE_DIR'] = os.environ.get("TEMPLATE_CACHE_DIR", os.path.join(tempfile.gettempdir(), "bimd-templates"))
+app.config['PROFILING_ENABLED'] = os.environ.get("PROFILING_ENABLED", "0") == "1"
+app.config['PROFILE_DIR'] = os.environ.get("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "bimd-profiles"))
+app.config['COMPRESSION_ENABLED'] = os.environ.get("COMPRESSION_ENABLED", "1") == "1"
+app.config['COMPRESSION_THRESHOLD'] = int(os.environ.get("COMPRESSION_THRESHOLD", 1024)) # bytes
 #toolbar = DebugToolbarExtension(app)
 
+# Compiled templates are cached on disk for every worker on this machine, and all of them are loaded at boot
+# so the first request to each page doesn't pay for compiling it.
+os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+app.jinja_options = dict(app.jinja_options, bytecode_cache=FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR']))
+for template_name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(template_name)
+
 connect_db(app)
 db.create_all()
 
+# Per-client rate limits, plus caps on the in-flight TMDb and bcrypt work each worker will take on.
+limiter = RateLimiter(make_backend(app.config['RATE_LIMIT_BACKEND'], db.engine))
+tmdb_capacity = Capacity("tmdb", app.config['TMDB_CAPACITY'])
+bcrypt_capacity = Capacity("bcrypt", app.config['BCRYPT_CAPACITY'])
+
+# Text responses are compressed on the way out, and anonymous views of movie and user pages get ETags made from
+# the pages' content versions and the release of the app.
+if app.config['COMPRESSION_ENABLED']:
+    app.wsgi_app = Compressor(app.wsgi_app, threshold=app.config['COMPRESSION_THRESHOLD'])
+release = versions.release_hash(app.root_path)
+VERSIONED_PAGES = {"show_movie": "movie", "user": "user"}
+
+# Title suggestions for the search box, from a snapshot file shared by every worker on this machine and rebuilt
+# from the database once it is SUGGEST_REFRESH seconds old.
+def build_suggestions():
+    with app.app_context():
+        suggest.build(app.config['SUGGEST_SNAPSHOT'], suggest.load_movies())
+        db.session.remove() # don't leave the read transaction open
+
+if not os.path.exists(app.config['SUGGEST_SNAPSHOT']):
+    build_suggestions()
+suggestions = suggest.SuggestionIndex(app.config['SUGGEST_SNAPSHOT'], build_suggestions, app.config['SUGGEST_REFRESH'])
+
 def debug_print(i):
     print("==========================================================================\n")
     print(i)
@@ -46,6 +99,70 @@ def add_user_to_g():
     else:
         g.user = None
 
+@app.before_request
+def check_rate_limit():
+    """Before each request, turn away clients which have gone over the rate limit for the route."""
+
+    if not app.config['RATE_LIMIT_ENABLED']:
+        return None
+
+    # Heroku's router appends the connecting address to X-Forwarded-For, so the last entry is the one to trust.
+    ip = request.access_route[-1] if request.access_route else request.remote_addr
+    user_id = g.user.id if g.user else None
+
+    retry_after = limiter.check(request.endpoint, request.method, ip, user_id)
+    if retry_after is not None:
+        return too_many_requests(retry_after)
+
+@app.before_request
+def check_page_version():
+    """Before an anonymous view of a movie or user page, answer 304 Not Modified if the visitor's copy is still
+    current, without loading any of the page. Visitors with messages waiting to be flashed always get the page."""
+
+    g.etag = None
+    if request.method != "GET" or g.user or "_flashes" in session or request.endpoint not in VERSIONED_PAGES:
+        return None
+
+    scope = VERSIONED_PAGES[request.endpoint]
+    key = request.view_args["id"] if scope == "movie" else versions.user_key(request.view_args["username"])
+    if key is None:
+        return None
+    g.etag = versions.etag(scope, key, release)
+
+    if request.if_none_match.contains_weak(g.etag):
+        if scope == "movie":
+            refresher.record_view(key)
+        return Response(status=304)
+
+@app.after_request
+def add_page_version(response):
+    """Give anonymous views of movie and user pages their ETag, and have them checked again before reuse. Logged in
+    users see the same urls differently, so caches have to keep copies per session cookie."""
+
+    if g.get("etag") and response.status_code in (200, 304):
+        response.set_etag(g.etag, weak=True)
+        response.headers["Cache-Control"] = "no-cache"
+        response.vary.add("Cookie")
+    return response
+
+@app.errorhandler(Overloaded)
+def handle_overloaded(e):
+    """Shed the request when there is no capacity left for TMDb calls or password hashing."""
+
+    return too_many_requests(e.retry_after)
+
+def too_many_requests(retry_after):
+    """Returns a 429 response asking the client to try again after the given number of seconds."""
+
+    return "Too many requests. Please try again later.", 429, {"Retry-After": str(retry_after)}
+
+def tmdb_get(path, **params):
+    """Send a GET request to TMDb and return the json response."""
+
+    with tmdb_capacity:
+        res = tmdb.get(path, tmdb_api_key, **params)
+    return res.json()
+
 def do_login(user):
     """Log in user."""
 
@@ -133,7 +250,28 @@ def index():
     if form.validate_on_submit():
         return redirect( url_for("search", q=form.title.data) )
     else:
-        return render_template("index.html", form=form)
+        trending = counters.trending(1, 10)
+        most_discussed = counters.most_discussed(1, 10)
+        return render_template("index.html", form=form, trending=trending, most_discussed=most_discussed)
+
+@app.route("/movies/<listing>")
+def movie_listing(listing):
+    """Paginated listings of the movies most recently commented on, and with the most comments."""
+
+    listings = {
+        "trending": ("Trending Movies", counters.trending),
+        "discussed": ("Most Discussed Movies", counters.most_discussed),
+    }
+    if listing not in listings:
+        return "Listing not found.", 404
+
+    title, load = listings[listing]
+    page = max(1, request.args.get("page", 1, type=int))
+    per_page = 20
+    movies = load(page, per_page)
+
+    return render_template("movies/listing.html", title=title, listing=listing, movies=movies, page=page, per_page=per_page,
+                           has_next=len(movies) == per_page)
 
 @app.route("/about")
 def about():
@@ -149,11 +287,12 @@ def signup():
 
     if form.validate_on_submit():
         try:
-            user = User.signup(
-                username=form.username.data,
-                email=form.email.data,
-                password=form.password.data,
-            )
+            with bcrypt_capacity:
+                user = User.signup(
+                    username=form.username.data,
+                    email=form.email.data,
+                    password=form.password.data,
+                )
             db.session.commit()
 
         except (InvalidRequestError, IntegrityError):
@@ -173,8 +312,9 @@ def login():
     form = UserLoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        with bcrypt_capacity:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
 
         if user:
             do_login(user)
@@ -210,13 +350,18 @@ def search():
         return redirect("/")
 
     # Get the current page of search results.
-    res = requests.get(
-        f"{API_BASE_URL}search/movie",
-        params={"api_key": tmdb_api_key, "query": query, "page": page}
-    )
-    data = res.json()
+    data = tmdb_get("search/movie", query=query, page=page)
     results = data["results"]
 
+    # Add the info we want to keep for the movies which aren't in our database yet, with one statement.
+    known = {id for (id,) in db.session.query(Movie.id).filter(Movie.id.in_([m["id"] for m in results]))} if results else set()
+    new = [m for m in results if m["id"] not in known]
+    if new:
+        planner.save([(m["id"], m) for m in new])
+        db.session.commit()
+        for m in new:
+            suggestions.add(m["id"], m["title"])
+
     for m in results:
         # make release date object and prepare pretty string version for display
         relDateObj = Movie.convert_release_date_to_datetime(m)
@@ -229,15 +374,31 @@ def search():
         else:
             m["poster_path"] = API_POSTER_PATH + m["poster_path"]
 
-        # check if this movie is in our database - if not, add the info we want to keep to it
-        movie = Movie.query.get(m["id"])
-        if movie == None:
-            movie = Movie(id=m["id"], title=m["title"], poster_path=m["poster_path"], release_date=relDateObj, overview=m["overview"])
+    return render_template("search.html", query=query, page=page, results=results, total_pages=data["total_pages"])
+
+@app.route("/api/trends")
+def tag_trends():
+    """How often tags were given in each hour or day of a time range, for one movie or over every movie.
 
-            db.session.add(movie)
-            db.session.commit()
+    Takes period (hour or day), since and until (YYYY-MM-DD, until defaults to now), and optionally movie and tag ids."""
 
-    return render_template("search.html", query=query, page=page, results=results, total_pages=data["total_pages"])
+    try:
+        period = request.args.get("period", "day")
+        until = datetime.strptime(request.args["until"], "%Y-%m-%d") if request.args.get("until") else datetime.utcnow()
+        since = datetime.strptime(request.args["since"], "%Y-%m-%d") if request.args.get("since") else until - timedelta(days=30)
+        rows = trends.series(period, since, until, movie_id=request.args.get("movie", type=int), tag_id=request.args.get("tag", type=int))
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    return jsonify([{"bucket": bucket.isoformat(), "tag_id": tag_id, "tag": name, "count": count} for bucket, tag_id, name, count in rows])
+
+@app.route("/api/suggest")
+def suggest_titles():
+    """Suggest movies in the database whose titles start with the query, most commented first."""
+
+    query = request.args.get("q", "")
+
+    return jsonify([{"id": id, "title": title} for id, title in suggestions.suggest(query)])
 
 ############################################################################################
 #
@@ -250,11 +411,14 @@ def user(username):
     """Display user account information for the given  user."""
 
     user = User.query.filter_by(username=username).first_or_404()
-    comments = MovieComment.query.filter_by(user_id=user.id).all()
+    page = max(1, request.args.get("page", 1, type=int))
+    per_page = 20
 
-    debug_print(comments)
+    # Only one page of comments is loaded; the user's comment counter says how many pages there are.
+    comments = viewmodels.load_comments(g.user, MovieComment.user_id == user.id, page=page, per_page=per_page)
+    total_pages = max(1, math.ceil(user.comment_count / per_page))
 
-    return render_template("users/user.html", user=user, comments=comments)
+    return render_template("users/user.html", user=user, comments=comments, page=page, total_pages=total_pages)
 
 @app.route("/u/<username>/edit", methods=["GET", "POST"])
 def edit(username):
@@ -267,7 +431,8 @@ def edit(username):
     form = UserEditForm(obj=g.user) # put the user's object here to prefill the form
 
     if form.validate_on_submit():
-        user = User.authenticate(g.user.username, form.old_password.data)
+        with bcrypt_capacity:
+            user = User.authenticate(g.user.username, form.old_password.data)
 
         if user:
             try:
@@ -276,9 +441,11 @@ def edit(username):
 
                 new_password = form.new_password.data
                 if(len(new_password) > 7):
-                    hashed_pwd = bcrypt.generate_password_hash(new_password).decode('UTF-8')
+                    with bcrypt_capacity:
+                        hashed_pwd = bcrypt.generate_password_hash(new_password).decode('UTF-8')
                     user.password = hashed_pwd
 
+                versions.bump_user(user.id)
                 db.session.add(user)
                 db.session.commit()
             except (InvalidRequestError, IntegrityError):
@@ -315,8 +482,17 @@ def set_role(username):
 
     if form.validate_on_submit():
         try:
+            old_role = user.role
             user.role = Role(form.role.data)
 
+            # Shadow banning or banning a user hides their comments, so the tags on the movies they commented on change.
+            if (old_role.value < 30) != (user.role.value < 30):
+                related.mark_user_movies_dirty(user.id)
+                rollups.user_visibility_changed(user, old_role.value < 30)
+                counters.user_visibility_changed(user, old_role.value < 30)
+                trends.mark_user(user.id)
+            versions.bump_user(user.id)
+
             db.session.add(user)
             db.session.commit()
         except (InvalidRequestError, IntegrityError):
@@ -345,45 +521,43 @@ def show_movie(id):
 
     # If it is not in our database, send a request to TMDb to get the info and put it in our database.
     if movie == None:
-        res = requests.get(f"{API_BASE_URL}movie/{id}", params={"api_key": tmdb_api_key})
-        m = res.json()
-        relDateObj = Movie.convert_release_date_to_datetime(m)
-
-        poster_path = NO_POSTER_PATH
-        if "poster_path" in m and  m["poster_path"]:
-            poster_path = API_POSTER_PATH + m["poster_path"]
-
-        movie = Movie(id=m["id"], title=m["title"], poster_path=poster_path, release_date=relDateObj, overview=m["overview"])
-
-        db.session.add(movie)
+        with tmdb_capacity:
+            results = dict(planner.fetch_movies([id], tmdb_api_key))
+        if id not in results:
+            return "TMDb could not be reached. Please try again later.", 503
+        if results[id] is None:
+            return "Movie not found.", 404
+
+        planner.save(results.items())
         db.session.commit()
+        movie = Movie.query.get(id)
+        suggestions.add(movie.id, movie.title)
     # Then the data is in our database and we can load it to the page below.
 
-    # Also load the MovieComments and MovieCommentTags for this page to display as well.
-    comments = MovieComment.query.filter(MovieComment.movie_id == id).all()
-
-    # Remove comments from the list which come from banned or shadowbanned users
-    comments = list(filter(lambda c: c.user.role.value < 30, comments))
+    # Count the view so the background refresh keeps the most viewed movies the freshest.
+    refresher.record_view(id)
 
     # If the user is logged in, check to see if they left a comment and load it as well.
     user_comment = None
     user = None
     if g.user:
-        user_comment = MovieComment.query.filter_by(user_id=g.user.id, movie_id=id).one_or_none()
         user = g.user
+        user_comment = next(iter(viewmodels.load_comments(user, MovieComment.user_id == user.id, MovieComment.movie_id == id)), None)
 
-    # Calculate tag stats for the page
-    stats = {}
+    # Also load the MovieComments and MovieCommentTags for this page, leaving out comments from banned or shadowbanned users.
+    comments = viewmodels.load_comments(user, MovieComment.movie_id == id, visible_only=True)
+
+    # Load the tag stats for the page from the rollups, which already leave out shadow banned and banned user comments
+    stats = []
     tag_ids = {}
-    for comment in comments:
-        if comment.user.role.value < 30: # remove shadow banned and banned user comments from the stats
-            for tag in comment.tags:
-                if(tag.tag.active):
-                    stats[tag.tag.name] = stats.get(tag.tag.name, 0) + 1 
-                    tag_ids[tag.tag.name] = tag.tag.id
-    stats = sorted(((v, k) for k, v in stats.items()), reverse=True)
+    for count, name, tag_id in rollups.movie_tag_stats(id):
+        stats.append((count, name))
+        tag_ids[name] = tag_id
+
+    # Movies with similar tags, as of the last related movies refresh.
+    related_movies = RelatedMovie.query.filter_by(movie_id=id).options(joinedload(RelatedMovie.related_movie)).order_by(RelatedMovie.rank).all()
 
-    return render_template("movies/show.html", movie=movie, comments=comments, user_comment=user_comment, user=user, stats=stats, tag_ids=tag_ids)
+    return render_template("movies/show.html", movie=movie, comments=comments, user_comment=user_comment, user=user, stats=stats, tag_ids=tag_ids, related_movies=related_movies)
 
 @app.route("/m/<int:id>/add", methods=["GET", "POST"])
 def add_comment(id):
@@ -416,7 +590,7 @@ def add_comment(id):
             )
 
             db.session.add(comment)
-            db.session.commit()
+            db.session.flush() # the comment, its tags, and everything counted from them are committed together
 
             tags = []
 
@@ -426,9 +600,16 @@ def add_comment(id):
                     tag_id = tag
                 ))
             db.session.add_all(tags)
+            db.session.flush() # the tags get their created_at, which is the hour their trends are counted in
+            related.mark_movies_dirty([id])
+            rollups.comment_tags_changed(comment, [], form.tags.data)
+            counters.comment_added(comment)
+            trends.mark_hours([t.created_at for t in tags])
+            versions.bump_comment(comment)
             db.session.commit()
 
         except (InvalidRequestError, IntegrityError):
+            db.session.rollback()
             flash("You can only add one comment per movie.", 'danger')
             return redirect(f'/m/{id}')
 
@@ -451,10 +632,12 @@ def view_comment(movie_id, comment_id):
     movie = Movie.query.get(movie_id)
 
     # Get the comment.
-    comment = MovieComment.query.get(comment_id)
+    comment = next(iter(viewmodels.load_comments(user, MovieComment.id == comment_id)), None)
+    if not comment:
+        return "Comment not found.", 404
     
     # Determine if the comment belongs to the current user.
-    your_comment = comment.user == user
+    your_comment = user is not None and comment.user_id == user.id
 
     return render_template("movies/view_comment.html", movie=movie, c=comment, user=user, your_comment=your_comment)
 
@@ -481,23 +664,33 @@ def edit_comment(movie_id, comment_id):
 
             db.session.add(comment)
 
-            # Remove old tags before assigning the new ones
+            # Remove the tags which are no longer chosen. The ones which are kept keep the time they were first given.
             old_tags = MovieCommentTag.query.filter_by(movie_comment_id=comment.id).all()
-            for t in old_tags:
+            old_tag_ids = [t.tag_id for t in old_tags]
+            removed = [t for t in old_tags if t.tag_id not in form.tags.data]
+            trends.mark_hours([t.created_at for t in removed])
+            for t in removed:
                 db.session.delete(t)
-            db.session.commit()
+            db.session.flush() # the tag changes and the rollups are committed together
 
             tags = []
 
             for tag in form.tags.data:
-                tags.append(MovieCommentTag(
-                    movie_comment_id=comment.id,
-                    tag_id = tag
-                ))
+                if tag not in old_tag_ids:
+                    tags.append(MovieCommentTag(
+                        movie_comment_id=comment.id,
+                        tag_id = tag
+                    ))
             db.session.add_all(tags)
+            db.session.flush() # the tags get their created_at, which is the hour their trends are counted in
+            related.mark_movies_dirty([comment.movie_id])
+            rollups.comment_tags_changed(comment, old_tag_ids, form.tags.data)
+            trends.mark_hours([t.created_at for t in tags])
+            versions.bump_comment(comment)
             db.session.commit()
 
         except (InvalidRequestError, IntegrityError):
+            db.session.rollback()
             flash("Error editing comment.", 'danger')
             return redirect(f'/m/{movie_id}')
 
@@ -526,6 +719,11 @@ def delete_comment(movie_id, comment_id):
     
     # Delete the comment.
     try:
+        related.mark_movies_dirty([comment.movie_id])
+        rollups.comment_tags_changed(comment, [t.tag_id for t in comment.tags], [])
+        counters.comment_deleted(comment)
+        trends.mark_hours([t.created_at for t in comment.tags])
+        versions.bump_comment(comment)
         db.session.delete(comment)
         db.session.commit()
 
@@ -590,9 +788,21 @@ def new_tag():
 def see_tag(id):
     """Route to see a single tag's page."""
 
-    tag = Tag.query.get(id)
+    tag = Tag.query.get_or_404(id)
+    page = max(1, request.args.get("page", 1, type=int))
+    per_page = 20
+
+    # The movies given this tag the most, and how often the tag has been used overall.
+    usage = TagUsage.query.get(id)
+    leaderboard = rollups.tag_leaderboard(id, page, per_page) if tag.active else []
+    total_pages = max(1, math.ceil(usage.movies / per_page)) if usage else 1
+
+    # Tags often given to the same movies, as of the last related movies refresh.
+    related_tags = RelatedTag.query.filter_by(tag_id=id).options(joinedload(RelatedTag.related_tag)).order_by(RelatedTag.rank).all()
+    related_tags = [r for r in related_tags if r.related_tag.active]
 
-    return render_template("tags/show.html", tag=tag, user=g.user)
+    return render_template("tags/show.html", tag=tag, user=g.user, related_tags=related_tags,
+                           usage=usage, leaderboard=leaderboard, page=page, per_page=per_page, total_pages=total_pages)
 
 @app.route("/tags/<int:id>/edit", methods=["GET", "POST"])
 def edit_tag(id):
@@ -616,6 +826,7 @@ def edit_tag(id):
             tag.description = form.description.data
             
             db.session.add(tag)
+            versions.bump_site()
             db.session.commit()
 
         except (InvalidRequestError, IntegrityError):
@@ -645,6 +856,8 @@ def hide_tag(id):
         tag.active = False
 
         db.session.add(tag)
+        related.mark_tag_movies_dirty(tag.id)
+        versions.bump_site()
         db.session.commit()
 
     except (InvalidRequestError, IntegrityError):
@@ -672,6 +885,8 @@ def show_tag(id):
         tag.active = True
 
         db.session.add(tag)
+        related.mark_tag_movies_dirty(tag.id)
+        versions.bump_site()
         db.session.commit()
 
     except (InvalidRequestError, IntegrityError):
@@ -695,13 +910,280 @@ def delete_tag(id):
         flash("You do not have permission to edit that tag.", "danger")
         return redirect("/")
     
+    # A tag can be on a great many comments, so it is deleted in the background a chunk at a time.
+    job = moderation.create("delete_tag", {"tag": tag.name}, g.user)
+    moderation.start(app, job.id)
+
+    flash("Tag is being deleted.", 'success')
+    return redirect("/tags")
+
+############################################################################################
+#
+# Bulk moderation of users, tags, and comments, for mods and admins
+#
+############################################################################################
+
+@app.route("/admin/moderation", methods=["GET", "POST"])
+def moderation_console():
+    """Page to start bulk moderation jobs and follow their progress. Banning users and changing tags is for admins only."""
+
+    if not auth(10):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    form = ModerationForm()
+
+    if form.validate_on_submit():
+        if not auth(moderation.ACTIONS[form.action.data].permission):
+            flash("Only admins can do that.", "danger")
+            return redirect("/admin/moderation")
+
+        params = {name: form[name].data for name in ("username", "tag", "into", "movie", "contains") if form[name].data}
+        try:
+            job = moderation.create(form.action.data, params, g.user)
+        except moderation.InvalidAction as e:
+            flash(str(e), "danger")
+            return render_template("admin/moderation.html", form=form, jobs=recent_moderation_jobs())
+
+        moderation.start(app, job.id)
+        flash("Moderation job started.", "success")
+        return redirect("/admin/moderation")
+
+    return render_template("admin/moderation.html", form=form, jobs=recent_moderation_jobs())
+
+def recent_moderation_jobs():
+    """Returns the progress of the most recent moderation jobs."""
+
+    return [moderation.progress(job) for job in ModerationJob.query.order_by(ModerationJob.id.desc()).limit(20)]
+
+@app.route("/api/moderation/jobs", methods=["POST"])
+def start_moderation_job():
+    """Start a bulk moderation job from a json body with an action and its parameters. Returns the job's progress."""
+
+    if not auth(10) or not request.is_json:
+        return jsonify(error="Access unauthorized."), 403
+
+    params = request.get_json(silent=True)
+    if not isinstance(params, dict):
+        return jsonify(error="The body must be a json object."), 400
+    action = params.pop("action", None)
+    if isinstance(action, str) and action in moderation.ACTIONS and not auth(moderation.ACTIONS[action].permission):
+        return jsonify(error="Only admins can do that."), 403
+
     try:
-        db.session.delete(tag)
-        db.session.commit()
+        job = moderation.create(action, params, g.user)
+    except moderation.InvalidAction as e:
+        return jsonify(error=str(e)), 400
 
-    except (InvalidRequestError, IntegrityError):
-        flash("Tag could not be deleted", 'danger')
-        return render_template('/tags')
-    
-    flash("Tag deleted!", 'success')
-    return redirect("/tags")
\ No newline at end of file
+    moderation.start(app, job.id)
+    return jsonify(moderation.progress(job)), 202
+
+@app.route("/api/moderation/jobs/<int:id>")
+def moderation_job_progress(id):
+    """Returns the progress of a bulk moderation job."""
+
+    if not auth(10):
+        return jsonify(error="Access unauthorized."), 403
+
+    return jsonify(moderation.progress(ModerationJob.query.get_or_404(id)))
+
+############################################################################################
+#
+# Admin routes for monitoring the app
+#
+############################################################################################
+
+@app.route("/admin/metrics")
+def show_metrics():
+    """Route to see this worker's metrics as json. Admins only."""
+
+    if not auth(0):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return jsonify(metrics.snapshot())
+
+# Profiling of single requests and memory snapshots, for admins. Nothing is hooked in unless PROFILING_ENABLED is set.
+profiling.init_app(app, db, lambda: auth(0))
+
+############################################################################################
+#
+# Bulk export and import of the database, as routes for admins and commands
+#
+############################################################################################
+
+@app.route("/admin/export/<name>.<fmt>")
+def export_data(name, fmt):
+    """Stream one table of the database as ndjson, csv, or parquet. Admins only.
+
+    Takes the optional filters movie, tag, since, and until (YYYY-MM-DD) in the query string."""
+
+    if not auth(0):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if name not in export.EXPORTS or fmt not in export.FORMATS:
+        return "Unknown export.", 404
+
+    if fmt == "parquet" and not export.parquet_available():
+        return "Parquet exports need pyarrow to be installed.", 501
+
+    try:
+        filters = export.Filters.from_strings(**{k: request.args.get(k) for k in ("movie", "tag", "since", "until")})
+    except ValueError:
+        return "Invalid filter.", 400
+
+    # Rows are read through a server-side cursor and sent in chunks, so memory stays flat however big the table is.
+    res = Response(stream_with_context(export.stream(name, fmt, filters)), mimetype=export.FORMATS[fmt])
+    res.headers["Content-Disposition"] = f"attachment; filename={name}.{fmt}"
+    return res
+
+@app.cli.command("export")
+@click.argument("name", type=click.Choice(sorted(export.EXPORTS)))
+@click.option("--format", "fmt", type=click.Choice(sorted(export.FORMATS)), default="ndjson")
+@click.option("--movie", help="Only export data for this movie id.")
+@click.option("--tag", help="Only export data for this tag id.")
+@click.option("--since", help="Only export data from this date on (YYYY-MM-DD).")
+@click.option("--until", help="Only export data from before this date (YYYY-MM-DD).")
+@click.option("--output", type=click.Path(dir_okay=False), help="File to write to instead of stdout.")
+def export_command(name, fmt, movie, tag, since, until, output):
+    """Export one table of the database."""
+
+    try:
+        filters = export.Filters.from_strings(movie, tag, since, until)
+    except ValueError as e:
+        raise click.BadParameter(f"invalid filter: {e}")
+    binary = fmt == "parquet"
+
+    if output:
+        out = open(output, "wb" if binary else "w", newline=None if binary else "")
+    else:
+        out = sys.stdout.buffer if binary else sys.stdout
+
+    for chunk in export.stream(name, fmt, filters):
+        out.write(chunk)
+
+    if output:
+        out.close()
+
+@app.cli.command("import-data")
+@click.argument("kind", type=click.Choice(sorted(bulk_import.IMPORTERS)))
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "ndjson"]), help="Defaults to the file extension.")
+@click.option("--batch-size", default=bulk_import.BATCH_SIZE, show_default=True)
+@click.option("--checkpoint", type=click.Path(dir_okay=False), help="File to record progress in. An import given the same checkpoint resumes where it stopped.")
+@click.option("--created-by", help="Username to credit tags to when the file has no created_by_id.")
+def import_command(kind, path, fmt, batch_size, checkpoint, created_by):
+    """Import tags, movies, comments, or comment tags from a csv or ndjson file."""
+
+    options = {}
+    if created_by:
+        options["created_by_id"] = User.query.filter_by(username=created_by).one().id
+
+    def progress(report):
+        click.echo(f"{report.read} rows read, {report.inserted} inserted, {report.duplicates} duplicates, {report.invalid} invalid ({report.rows_per_second:.0f} rows/sec)")
+
+    report = bulk_import.run(kind, bulk_import.read_rows(path, fmt), options, batch_size,
+                             bulk_import.Checkpoint(checkpoint), progress)
+
+    for error in report.errors:
+        click.echo(error, err=True)
+
+    if kind in ("comments", "comment_tags") and report.inserted:
+        click.echo("Rebuilding tag rollups...")
+        rollups.rebuild()
+    if kind == "comments" and report.inserted:
+        click.echo("Recounting comments...")
+        counters.reconcile()
+    if kind in ("comments", "comment_tags") and report.inserted:
+        click.echo("Rebuilding tag trends...")
+        trends.rebuild()
+        click.echo("Run flask refresh-related --full to update related movies.")
+
+############################################################################################
+#
+# Commands for batch jobs which keep derived data up to date
+#
+############################################################################################
+
+@app.cli.command("refresh-related")
+@click.option("--full", is_flag=True, help="Rescore every movie instead of only those whose tags have changed.")
+def refresh_related_command(full):
+    """Recompute related movies and related tags."""
+
+    rescored = related.refresh(full)
+    click.echo(f"Rescored {rescored} movies.")
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Rebuild the tag usage rollups from the comments."""
+
+    rollups.rebuild()
+    click.echo("Tag rollups rebuilt.")
+
+@app.cli.command("reconcile-counters")
+def reconcile_counters_command():
+    """Recount the comments on every movie and by every user, fixing counters which have drifted."""
+
+    fixed = counters.reconcile()
+    click.echo(f"Fixed {fixed} counters.")
+
+@app.cli.command("aggregate-trends")
+@click.option("--rebuild", is_flag=True, help="Recount every hour instead of only those whose tags have changed.")
+def aggregate_trends_command(rebuild):
+    """Recount the hourly and daily tag trends."""
+
+    hours = trends.rebuild() if rebuild else trends.aggregate()
+    click.echo(f"Recounted {hours} hours.")
+
+@app.cli.command("refresh-movies")
+@click.option("--budget", default=500, show_default=True, help="Most TMDb requests to make per run.")
+@click.option("--rate", default=20.0, show_default=True, help="Most TMDb requests to start per second.")
+@click.option("--concurrency", default=4, show_default=True, help="TMDb requests in flight at once.")
+@click.option("--max-age-days", default=7, show_default=True, help="Refresh movies fetched longer ago than this.")
+@click.option("--every", type=int, help="Keep running, refreshing every this many minutes.")
+def refresh_movies_command(budget, rate, concurrency, max_age_days, every):
+    """Refresh stale movie details from TMDb, most viewed first."""
+
+    while True:
+        fetched, changed = refresher.refresh(tmdb_api_key, budget, rate, concurrency, timedelta(days=max_age_days))
+        click.echo(f"Refreshed {fetched} movies, {changed} changed.")
+        if not every:
+            break
+        time.sleep(every * 60)
+
+@app.cli.command("fetch-movies")
+@click.argument("movie_ids", nargs=-1, type=int)
+@click.option("--file", "path", type=click.Path(exists=True), help="A file of TMDb movie ids, one per line.")
+@click.option("--rate", default=20.0, show_default=True, help="Most TMDb requests to start per second.")
+@click.option("--concurrency", default=4, show_default=True, help="TMDb requests in flight at once.")
+def fetch_movies_command(movie_ids, path, rate, concurrency):
+    """Copy the details of movies not yet in the database from TMDb, for example before importing comments on them."""
+
+    movie_ids = list(movie_ids)
+    if path:
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        movie_ids.append(int(line))
+                    except ValueError:
+                        raise click.BadParameter(f"line {number} is not a movie id: {line.strip()!r}", param_hint="--file")
+
+    added = planner.backfill(movie_ids, tmdb_api_key, planner.RequestBudget(len(movie_ids), rate), concurrency)
+    click.echo(f"Added {added} movies.")
+
+@app.cli.command("resume-moderation")
+def resume_moderation_command():
+    """Finish the moderation jobs which were queued or running when their worker stopped."""
+
+    for job in ModerationJob.query.filter(ModerationJob.status.in_(["queued", "running"])).order_by(ModerationJob.id).all():
+        job = moderation.run(job.id)
+        click.echo(f"Job {job.id} {job.status}: {job.done} of {job.total} rows.")
+
+@app.cli.command("build-suggest")
+def build_suggest_command():
+    """Rebuild the title suggestion snapshot on this machine. Workers on this machine pick it up within a few seconds."""
+
+    suggest.build(app.config['SUGGEST_SNAPSHOT'], suggest.load_movies())
+    click.echo(f"Suggestion snapshot written to {app.config['SUGGEST_SNAPSHOT']}.")
@@ -0,0 +1,76 @@
+"""Benchmark for the database connection pool
+
+Runs one simulated gunicorn worker with a number of request threads against DATABASE_URL, for each pool size in
+turn. Each request checks out a connection, spends --db-ms in the database and --app-ms in Python while holding
+it (as a request holds its session's connection until teardown), then returns it. Reports throughput and how long
+requests waited for a connection.
+
+    python -m benchmarks.pool --threads 16 --sizes 1,2,4,8,16
+"""
+
+import argparse
+import os
+import threading
+import time
+from sqlalchemy import create_engine, text, exc
+from dbpool import engine_options
+
+def run(url, size, threads, seconds, db_ms, app_ms):
+    """Returns (requests per second, checkout waits in seconds, timeouts) for one pool size."""
+    engine = create_engine(url, **engine_options({
+        "DB_PGBOUNCER": False, "DB_POOL_SIZE": size, "DB_MAX_OVERFLOW": 0, "DB_POOL_TIMEOUT": 5,
+        "DB_POOL_RECYCLE": 1800, "DB_POOL_PRE_PING": True, "DB_STATEMENT_TIMEOUT": 0,
+    }))
+    waits, timeouts, lock = [], [0], threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                conn = engine.connect()
+            except exc.TimeoutError:
+                with lock:
+                    timeouts[0] += 1
+                continue
+            waited = time.perf_counter() - start
+            try:
+                conn.execute(text("SELECT pg_sleep(:seconds)"), seconds=db_ms / 1000)
+                time.sleep(app_ms / 1000)
+            finally:
+                conn.close()
+            with lock:
+                waits.append(waited)
+
+    # Open the pool's connections first so connecting isn't counted as waiting.
+    warm = [engine.connect() for _ in range(size)]
+    for conn in warm:
+        conn.close()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    engine.dispose()
+    return len(waits) / seconds, sorted(waits), timeouts[0]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=os.environ.get("DATABASE_URL", "postgresql:///bimd"))
+    parser.add_argument("--threads", type=int, default=16, help="request threads in the worker")
+    parser.add_argument("--sizes", default="1,2,4,8,16", help="pool sizes to try, comma separated")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--db-ms", type=float, default=5, help="time each request spends in the database")
+    parser.add_argument("--app-ms", type=float, default=10, help="time each request holds its connection outside the database")
+    args = parser.parse_args()
+
+    print(f"{args.threads} threads, {args.db_ms:g} ms in the database and {args.app_ms:g} ms outside it per request")
+    for size in [int(size) for size in args.sizes.split(",")]:
+        throughput, waits, timeouts = run(args.url, size, args.threads, args.seconds, args.db_ms, args.app_ms)
+        mean = sum(waits) / len(waits) if waits else 0
+        p99 = waits[int(len(waits) * 0.99)] if waits else 0
+        print(f"pool size {size:>3}: {throughput:8.1f} requests/s, checkout wait mean {mean * 1000:7.2f} ms, "
+              f"p99 {p99 * 1000:7.2f} ms, {timeouts} timeouts")
+
+if __name__ == "__main__":
+    main()
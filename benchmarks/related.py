@@ -0,0 +1,51 @@
+"""Benchmark for the related movies and tags engine
+
+Builds a synthetic movie x tag matrix and times the full computation of related movies and tags.
+
+    python -m benchmarks.related --movies 100000 --tags 1000
+"""
+
+import argparse
+import time
+import numpy as np
+from related import TagMatrix, movie_neighbours, tag_neighbours
+
+def synthetic_matrix(movies, tags, tags_per_movie, seed=0):
+    """A matrix where each movie has a handful of tags, with a few tags far more popular than the rest."""
+    rng = np.random.default_rng(seed)
+    popularity = 1 / np.arange(1, tags + 1)
+    popularity /= popularity.sum()
+
+    per_movie = rng.poisson(tags_per_movie, movies).clip(1, tags)
+    movie_ids = np.repeat(np.arange(1, movies + 1), per_movie)
+    tag_ids = rng.choice(np.arange(1, tags + 1), size=len(movie_ids), p=popularity)
+    counts = rng.integers(1, 20, size=len(movie_ids))
+    return TagMatrix.from_triples(movie_ids, tag_ids, counts)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--movies", type=int, default=100000)
+    parser.add_argument("--tags", type=int, default=1000)
+    parser.add_argument("--tags-per-movie", type=int, default=8)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    matrix = synthetic_matrix(args.movies, args.tags, args.tags_per_movie)
+    built = time.perf_counter()
+    print(f"matrix: {matrix.counts.shape[0]} movies x {matrix.counts.shape[1]} tags, {matrix.counts.nnz} entries, built in {built - start:.2f}s")
+
+    found = sum(1 for movie_id, neighbours in movie_neighbours(matrix))
+    movies_done = time.perf_counter()
+    print(f"related movies: {found} movies in {movies_done - built:.2f}s ({(movies_done - built) / found * 1000:.3f} ms per movie)")
+
+    found = sum(1 for tag_id, neighbours in tag_neighbours(matrix))
+    tags_done = time.perf_counter()
+    print(f"related tags: {found} tags in {tags_done - movies_done:.2f}s")
+
+    rows = np.arange(0, matrix.counts.shape[0], 100)
+    sum(1 for movie_id, neighbours in movie_neighbours(matrix, rows))
+    refreshed = time.perf_counter()
+    print(f"incremental refresh of 1% of movies: {len(rows)} movies in {refreshed - tags_done:.2f}s")
+
+if __name__ == "__main__":
+    main()
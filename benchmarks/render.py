@@ -0,0 +1,57 @@
+"""Benchmark for rendering comments
+
+Times compiling every template with and without the bytecode cache, then rendering comments through the
+comment macro, with a standalone Jinja environment so no database or app is needed.
+
+    python -m benchmarks.render --comments 10000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from viewmodels import CommentView, TagView
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+
+def synthetic_comments(count, tags_per_comment=3):
+    """Comments with a few tags each, as the movie page would load them for a logged in admin."""
+    return [CommentView(id, id % 500, f"user{id % 500}", id % 50, f"Movie {id % 50}", f"Subject {id}",
+                        "Comment text. " * 20, [TagView(t, f"tag{t}") for t in range(id % 7, id % 7 + tags_per_comment)], True, True)
+            for id in range(1, count + 1)]
+
+def compile_all(bytecode_cache=None):
+    """Compile every template in a fresh environment. Returns the seconds taken and the environment."""
+    start = time.perf_counter()
+    env = Environment(loader=FileSystemLoader(TEMPLATES), autoescape=True, bytecode_cache=bytecode_cache)
+    for name in env.list_templates():
+        env.get_template(name)
+    return time.perf_counter() - start, env
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--comments", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    cold, env = compile_all()
+    print(f"compile all templates, no cache: {cold * 1000:.1f} ms")
+    with tempfile.TemporaryDirectory() as directory:
+        compile_all(FileSystemBytecodeCache(directory))
+        warm, env = compile_all(FileSystemBytecodeCache(directory))
+    print(f"compile all templates, warm bytecode cache: {warm * 1000:.1f} ms")
+
+    template = env.from_string('{% from "movies/comment.html" import comment %}{% for c in comments %}{{ comment(c) }}{% endfor %}')
+    comments = synthetic_comments(args.comments)
+    template.render(comments=comments[:100])
+
+    best = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        template.render(comments=comments)
+        best = min(best, time.perf_counter() - start)
+    print(f"render {args.comments} comments: {best * 1000:.1f} ms ({best / args.comments * 1000 * 1000:.2f} ms per 1,000 comments)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+"""Bulk import of tags, movies, comments, and comment tags from csv or ndjson files"""
+
+import csv
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+from models import db, User, Tag, Movie, MovieComment, MovieCommentTag
+import versions
+
+BATCH_SIZE = 5000 # rows validated, deduplicated, and inserted per transaction
+
+class InvalidRow(Exception):
+    """Raised when a row of an import file can't be imported."""
+
+def read_rows(path, fmt=None):
+    """Yields each row of a csv or ndjson file as a dict. The format is taken from the file extension if not given.
+    An ndjson line which isn't valid json is yielded as an InvalidRow, so it is reported like any other invalid row."""
+    fmt = fmt or ("csv" if path.endswith(".csv") else "ndjson")
+    with open(path, newline="") as f:
+        if fmt == "csv":
+            yield from csv.DictReader(f)
+        else:
+            for number, line in enumerate(f, start=1):
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        yield InvalidRow(f"line {number} is not valid json")
+
+def required(row, key):
+    """Returns the value for key from the row, which must be present."""
+    value = row.get(key)
+    if value is None or value == "":
+        raise InvalidRow(f"missing {key}")
+    return value
+
+def as_int(value, key):
+    """Returns the value as an int."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise InvalidRow(f"{key} is not a number")
+
+def as_str(value, key, max_length=None):
+    """Returns the value as a string no longer than max_length."""
+    value = "" if value is None else str(value)
+    if max_length and len(value) > max_length:
+        raise InvalidRow(f"{key} is longer than {max_length} characters")
+    return value
+
+def as_bool(value):
+    """Returns the value as a bool. Strings like "false", "no", and "0" are False."""
+    if isinstance(value, str):
+        return value.strip().lower() not in ("0", "false", "no", "")
+    return bool(value)
+
+def as_date(value, key):
+    """Returns a YYYY-MM-DD value as a datetime, or None if it is empty."""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(str(value)[:10], "%Y-%m-%d")
+    except ValueError:
+        raise InvalidRow(f"{key} is not a YYYY-MM-DD date")
+
+def as_time(value, key):
+    """Returns an ISO 8601 date and time as a datetime, or the current time if it is empty."""
+    if not value:
+        return datetime.utcnow()
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", ""))
+    except ValueError:
+        raise InvalidRow(f"{key} is not an ISO 8601 date and time")
+
+class Importer(ABC):
+    """Imports one kind of record. Subclasses say how to validate a row, what makes a row a duplicate,
+    and how to fill in references to other tables for a batch."""
+
+    model = None
+    unique = None # the columns of the model's unique key, which inserts skip conflicts on
+
+    def __init__(self, options):
+        self.options = options
+
+    @abstractmethod
+    def clean(self, row):
+        """Returns the validated values for the row, or raises InvalidRow."""
+
+    @abstractmethod
+    def key(self, values):
+        """Returns the unique key for a row's values, or None if it is only known once the batch is resolved."""
+
+    @abstractmethod
+    def existing_keys(self, keys):
+        """Returns which of the given keys are already in the database."""
+
+    def resolve(self, batch):
+        """Fill in references to other tables for a batch of values.
+
+        Returns the rows which could be resolved, a list of errors, and how many rows turned out to be duplicates."""
+        return batch, [], 0
+
+    def insert(self, batch):
+        """Insert a batch of rows with a single multi-row insert, skipping rows whose unique key is already taken,
+        such as ones inserted by another import since the batch was deduplicated. Returns how many were inserted."""
+        if not batch:
+            return 0
+        stmt = insert(self.model.__table__).values(batch).on_conflict_do_nothing(index_elements=self.unique)
+        return db.session.execute(stmt).rowcount
+
+class TagImporter(Importer):
+    """Tags are keyed by name and must name the user who created them."""
+
+    model = Tag
+    unique = ["name"]
+
+    def clean(self, row):
+        created_by_id = row.get("created_by_id") or self.options.get("created_by_id")
+        if not created_by_id:
+            raise InvalidRow("missing created_by_id")
+        active = row.get("active")
+        return {
+            "name": as_str(required(row, "name"), "name", 100),
+            "description": as_str(row.get("description"), "description"),
+            "active": True if active is None or active == "" else as_bool(active), # a blank csv cell is the default
+            "created_by_id": as_int(created_by_id, "created_by_id"),
+        }
+
+    def key(self, values):
+        return values["name"]
+
+    def existing_keys(self, keys):
+        return {name for (name,) in db.session.query(Tag.name).filter(Tag.name.in_(keys))}
+
+    def resolve(self, batch):
+        user_ids = {values["created_by_id"] for values in batch}
+        found = {id for (id,) in db.session.query(User.id).filter(User.id.in_(user_ids))}
+        errors = [f"user {values['created_by_id']} does not exist" for values in batch if values["created_by_id"] not in found]
+        return [values for values in batch if values["created_by_id"] in found], errors, 0
+
+class MovieImporter(Importer):
+    """Movies are keyed by their TMDb id."""
+
+    model = Movie
+    unique = ["id"]
+
+    def clean(self, row):
+        return {
+            "id": as_int(required(row, "id"), "id"),
+            "title": as_str(required(row, "title"), "title", 1000),
+            "release_date": as_date(row.get("release_date"), "release_date"),
+            "overview": as_str(row.get("overview"), "overview"),
+            "poster_path": row.get("poster_path") or None,
+        }
+
+    def key(self, values):
+        return values["id"]
+
+    def existing_keys(self, keys):
+        return {id for (id,) in db.session.query(Movie.id).filter(Movie.id.in_(keys))}
+
+class CommentImporter(Importer):
+    """Comments are keyed by movie and user, and both must already exist."""
+
+    model = MovieComment
+    unique = ["movie_id", "user_id"]
+
+    def clean(self, row):
+        return {
+            "movie_id": as_int(required(row, "movie_id"), "movie_id"),
+            "user_id": as_int(required(row, "user_id"), "user_id"),
+            "subject": as_str(row.get("subject"), "subject", 100),
+            "text": as_str(row.get("text"), "text"),
+            "created_at": as_time(row.get("created_at"), "created_at"),
+            "updated_at": as_time(row.get("updated_at") or row.get("created_at"), "updated_at"),
+        }
+
+    def key(self, values):
+        # Each user can leave one comment on each movie.
+        return (values["movie_id"], values["user_id"])
+
+    def existing_keys(self, keys):
+        query = db.session.query(MovieComment.movie_id, MovieComment.user_id)
+        return set(query.filter(tuple_(MovieComment.movie_id, MovieComment.user_id).in_(list(keys))))
+
+    def resolve(self, batch):
+        movie_ids = {values["movie_id"] for values in batch}
+        user_ids = {values["user_id"] for values in batch}
+        movies = {id for (id,) in db.session.query(Movie.id).filter(Movie.id.in_(movie_ids))}
+        users = {id for (id,) in db.session.query(User.id).filter(User.id.in_(user_ids))}
+
+        rows, errors = [], []
+        for values in batch:
+            if values["movie_id"] not in movies:
+                errors.append(f"movie {values['movie_id']} does not exist")
+            elif values["user_id"] not in users:
+                errors.append(f"user {values['user_id']} does not exist")
+            else:
+                rows.append(values)
+        return rows, errors, 0
+
+class CommentTagImporter(Importer):
+    """Comment tags can name their comment by movie_comment_id or by movie_id and user_id,
+    and their tag by tag_id or tag_name."""
+
+    model = MovieCommentTag
+    unique = ["movie_comment_id", "tag_id"]
+
+    def clean(self, row):
+        values = {}
+        if row.get("movie_comment_id"):
+            values["movie_comment_id"] = as_int(row["movie_comment_id"], "movie_comment_id")
+        else:
+            values["comment_key"] = (as_int(required(row, "movie_id"), "movie_id"), as_int(required(row, "user_id"), "user_id"))
+        if row.get("tag_id"):
+            values["tag_id"] = as_int(row["tag_id"], "tag_id")
+        else:
+            values["tag_name"] = as_str(required(row, "tag_name"), "tag_name", 100)
+        values["created_at"] = as_time(row.get("created_at"), "created_at")
+        return values
+
+    def resolve(self, batch):
+        comment_keys = {values["comment_key"] for values in batch if "comment_key" in values}
+        comments = {}
+        if comment_keys:
+            query = db.session.query(MovieComment.movie_id, MovieComment.user_id, MovieComment.id)
+            comments = {(movie_id, user_id): id for movie_id, user_id, id in query.filter(tuple_(MovieComment.movie_id, MovieComment.user_id).in_(list(comment_keys)))}
+        comment_ids = {values["movie_comment_id"] for values in batch if "movie_comment_id" in values}
+        if comment_ids:
+            comment_ids = {id for (id,) in db.session.query(MovieComment.id).filter(MovieComment.id.in_(comment_ids))}
+
+        tag_names = {values["tag_name"] for values in batch if "tag_name" in values}
+        tags = dict(db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(tag_names))) if tag_names else {}
+        tag_ids = {values["tag_id"] for values in batch if "tag_id" in values}
+        if tag_ids:
+            tag_ids = {id for (id,) in db.session.query(Tag.id).filter(Tag.id.in_(tag_ids))}
+
+        rows, errors = [], []
+        for values in batch:
+            comment_id = comments.get(values["comment_key"]) if "comment_key" in values else values["movie_comment_id"]
+            tag_id = tags.get(values["tag_name"]) if "tag_name" in values else values["tag_id"]
+            if comment_id is None or ("movie_comment_id" in values and comment_id not in comment_ids):
+                errors.append("comment does not exist")
+            elif tag_id is None or ("tag_id" in values and tag_id not in tag_ids):
+                errors.append("tag does not exist")
+            else:
+                rows.append({"movie_comment_id": comment_id, "tag_id": tag_id, "created_at": values["created_at"]})
+
+        # Comment tags are only keyed once their references are known, so duplicates are removed here.
+        keys = {(row["movie_comment_id"], row["tag_id"]) for row in rows}
+        query = db.session.query(MovieCommentTag.movie_comment_id, MovieCommentTag.tag_id)
+        existing = set(query.filter(tuple_(MovieCommentTag.movie_comment_id, MovieCommentTag.tag_id).in_(list(keys)))) if keys else set()
+        unique = []
+        for row in rows:
+            key = (row["movie_comment_id"], row["tag_id"])
+            if key not in existing:
+                existing.add(key)
+                unique.append(row)
+        return unique, errors, len(rows) - len(unique)
+
+    def key(self, values):
+        return None
+
+    def existing_keys(self, keys):
+        return set()
+
+IMPORTERS = {
+    "tags": TagImporter,
+    "movies": MovieImporter,
+    "comments": CommentImporter,
+    "comment_tags": CommentTagImporter,
+}
+
+class Checkpoint:
+    """Records how many rows of a file have been imported so an interrupted import can pick up where it stopped."""
+
+    def __init__(self, path):
+        self.path = path
+        self.rows_done = 0
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.rows_done = json.load(f)["rows_done"]
+
+    def save(self, rows_done):
+        """Record that the first rows_done rows of the file have been imported."""
+        self.rows_done = rows_done
+        if self.path:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump({"rows_done": rows_done}, f)
+            os.replace(self.path + ".tmp", self.path)
+
+class Report:
+    """Counts of what happened during an import."""
+
+    def __init__(self):
+        self.read = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.errors = []
+        self.started = time.time()
+
+    def error(self, line, message):
+        """Count an invalid row, keeping the first few messages to show."""
+        self.invalid += 1
+        if len(self.errors) < 20:
+            self.errors.append(f"row {line}: {message}")
+
+    @property
+    def rows_per_second(self):
+        """Returns how many rows have been read per second so far."""
+        return self.read / max(time.time() - self.started, 0.001)
+
+def run(kind, rows, options=None, batch_size=BATCH_SIZE, checkpoint=None, progress=None):
+    """Import rows of the given kind, committing once per batch. Returns a Report.
+
+    Rows already recorded in the checkpoint are skipped. `progress` is called with the report after each batch."""
+    importer = IMPORTERS[kind](options or {})
+    checkpoint = checkpoint or Checkpoint(None)
+    report = Report()
+
+    batch, line = [], 0
+    for line, row in enumerate(rows, start=1):
+        if line <= checkpoint.rows_done:
+            continue
+        report.read += 1
+        try:
+            if isinstance(row, InvalidRow):
+                raise row
+            if not isinstance(row, dict):
+                raise InvalidRow("row is not an object")
+            batch.append(importer.clean(row))
+        except InvalidRow as e:
+            report.error(line, e)
+        if len(batch) >= batch_size:
+            import_batch(importer, batch, report, line)
+            checkpoint.save(line)
+            batch = []
+            if progress:
+                progress(report)
+
+    import_batch(importer, batch, report, line)
+    checkpoint.save(line)
+    if progress:
+        progress(report)
+    return report
+
+def import_batch(importer, batch, report, line):
+    """Deduplicate a batch against itself and the database, then insert and commit it."""
+    unique, seen = [], set()
+    for values in batch:
+        key = importer.key(values)
+        if key is None:
+            unique.append(values)
+        elif key not in seen:
+            seen.add(key)
+            unique.append(values)
+    report.duplicates += len(batch) - len(unique)
+
+    keys = {importer.key(values) for values in unique} - {None}
+    if keys:
+        existing = importer.existing_keys(keys)
+        report.duplicates += sum(1 for values in unique if importer.key(values) in existing)
+        unique = [values for values in unique if importer.key(values) not in existing]
+
+    rows, errors, duplicates = importer.resolve(unique)
+    for message in errors:
+        report.error(f"{line} (end of batch)", message)
+    report.duplicates += duplicates
+
+    inserted = importer.insert(rows)
+    versions.bump_site()
+    db.session.commit()
+    report.inserted += inserted
+    report.duplicates += len(rows) - inserted
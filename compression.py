@@ -0,0 +1,126 @@
+"""WSGI middleware compressing text responses with brotli or gzip
+
+Responses are compressed as they are streamed, so exports and other streamed responses are never held in memory.
+Bodies smaller than the threshold are sent as they are, since compressing them saves less than it costs. Brotli
+is used when the brotli package is installed and the client accepts it. Anything an app sends through the write
+callable returned by start_response is held until the app returns, then sent ahead of the rest of its body."""
+
+import zlib
+from itertools import chain
+from werkzeug.datastructures import Headers
+from werkzeug.wsgi import ClosingIterator
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = ("text/", "application/json", "application/javascript", "application/x-ndjson", "image/svg+xml")
+
+class GzipStream:
+    """Compresses a stream of chunks into gzip format."""
+
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def process(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+class BrotliStream:
+    """Compresses a stream of chunks into brotli format."""
+
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def process(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+class Compressor:
+    """Middleware compressing the responses of a WSGI app whose content type is compressible."""
+
+    def __init__(self, app, threshold=1024, gzip_level=6, brotli_level=4):
+        self.app = app
+        self.threshold = threshold
+        self.encodings = {"gzip": lambda: GzipStream(gzip_level)}
+        if brotli:
+            self.encodings["br"] = lambda: BrotliStream(brotli_level)
+
+    def choose_encoding(self, accept_encoding):
+        """Returns the encoding to use for a client sending the given Accept-Encoding header, or None."""
+        accepted = parse_accept_header(accept_encoding)
+        best = max(self.encodings, key=lambda encoding: (accepted.quality(encoding), encoding == "br"))
+        return best if accepted.quality(best) > 0 else None
+
+    def __call__(self, environ, start_response):
+        encoding = self.choose_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        response = {}
+
+        def capture(status, headers, exc_info=None):
+            # Nothing has been sent yet, so an error response may always replace the one captured before it.
+            response["status"], response["headers"] = status, Headers(headers)
+            return write
+
+        written = []
+
+        def write(data):
+            # The response can't be started until the app returns and its headers are known to be final.
+            written.append(data)
+
+        body = self.app(environ, capture)
+        if written:
+            body = ClosingIterator(chain(written, body), getattr(body, "close", None))
+        status, headers = response["status"], response["headers"]
+        if not self.compressible(status, headers):
+            start_response(status, headers.to_wsgi_list())
+            return body
+        headers.add("Vary", "Accept-Encoding")
+        if not encoding or int(headers.get("Content-Length", self.threshold)) < self.threshold:
+            start_response(status, headers.to_wsgi_list())
+            return body
+        return self.compress(body, status, headers, encoding, start_response)
+
+    def compressible(self, status, headers):
+        """Whether a response is worth compressing: a full body of a text-like type which isn't already encoded."""
+        return (status[:3] not in ("204", "206", "304") and "Content-Encoding" not in headers
+                and headers.get("Content-Type", "").startswith(COMPRESSIBLE))
+
+    def compress(self, body, status, headers, encoding, start_response):
+        """Yields the body compressed, after sending it as it is if it turns out smaller than the threshold."""
+        try:
+            chunks = iter(body)
+            start, size = [], 0
+            for chunk in chunks:
+                start.append(chunk)
+                size += len(chunk)
+                if size >= self.threshold:
+                    break
+            else:
+                start_response(status, headers.to_wsgi_list())
+                yield b"".join(start)
+                return
+
+            headers.remove("Content-Length")
+            headers["Content-Encoding"] = encoding
+            etag = headers.get("ETag")
+            if etag and not etag.startswith("W/"):
+                # The compressed body differs byte for byte from the uncompressed one, so it can't share a strong ETag.
+                headers["ETag"] = "W/" + etag
+            start_response(status, headers.to_wsgi_list())
+
+            stream = self.encodings[encoding]()
+            yield stream.process(b"".join(start))
+            for chunk in chunks:
+                data = stream.process(chunk)
+                if data:
+                    yield data
+            yield stream.finish()
+        finally:
+            if hasattr(body, "close"):
+                body.close()
@@ -0,0 +1,120 @@
+"""Comment counters kept on movies and users, so pages and listings don't have to count comments
+
+Movies count only the comments visible to everyone, like the rollups; users count every comment they have left.
+The counters are changed in the same transaction as the comments, and `reconcile` repairs any drift."""
+
+from sqlalchemy import func, case
+from models import db, User, Movie, MovieComment
+from rollups import VISIBLE_ROLES, is_visible
+import versions
+
+def last_visible_comment(*criteria):
+    """Returns a subquery for the time of the newest visible comment on the movie being updated which matches the
+    criteria."""
+    return (db.session.query(func.max(MovieComment.created_at))
+        .join(User, User.id == MovieComment.user_id)
+        .filter(MovieComment.movie_id == Movie.id, User.role.in_(VISIBLE_ROLES), *criteria)
+        .as_scalar())
+
+def fewer_comments(amount, gone):
+    """Returns the values for taking amount away from a movie's comment count, where gone matches the comments which
+    stop being counted. The last comment time becomes that of the newest comment left, and a movie left with no
+    visible comments has none, so it drops out of the trending listing."""
+    count = Movie.comment_count - amount
+    return {"comment_count": count, "last_comment_at": case([(count > 0, last_visible_comment(db.not_(gone)))], else_=None)}
+
+def comment_added(comment):
+    """Count a new comment, which must have been flushed. Committed with the caller's session."""
+    if is_visible(comment.user):
+        created_at = comment.created_at
+        Movie.query.filter_by(id=comment.movie_id).update({
+            "comment_count": Movie.comment_count + 1,
+            "last_comment_at": func.greatest(func.coalesce(Movie.last_comment_at, created_at), created_at),
+        }, synchronize_session=False)
+    User.query.filter_by(id=comment.user_id).update({"comment_count": User.comment_count + 1}, synchronize_session=False)
+
+def comment_deleted(comment):
+    """Stop counting a comment which is being deleted. Committed with the caller's session."""
+    if is_visible(comment.user):
+        Movie.query.filter_by(id=comment.movie_id).update(fewer_comments(1, MovieComment.id == comment.id), synchronize_session=False)
+    User.query.filter_by(id=comment.user_id).update({"comment_count": User.comment_count - 1}, synchronize_session=False)
+
+def comments_deleted(comment_ids):
+    """Stop counting a batch of comments which are about to be deleted, with one update per table."""
+    movies = (db.session.query(MovieComment.movie_id.label("id"), func.count(MovieComment.id).label("count"))
+        .join(User, User.id == MovieComment.user_id)
+        .filter(MovieComment.id.in_(comment_ids), User.role.in_(VISIBLE_ROLES))
+        .group_by(MovieComment.movie_id).subquery())
+    db.session.execute(Movie.__table__.update().where(Movie.id == movies.c.id).values(fewer_comments(movies.c.count, MovieComment.id.in_(comment_ids))))
+
+    users = (db.session.query(MovieComment.user_id.label("id"), func.count(MovieComment.id).label("count"))
+        .filter(MovieComment.id.in_(comment_ids))
+        .group_by(MovieComment.user_id).subquery())
+    db.session.execute(User.__table__.update().where(User.id == users.c.id)
+        .values(comment_count=User.comment_count - users.c.count))
+
+def user_visibility_changed(user, was_visible):
+    """Add or take away a user's comments from the movie counts when their comments are shown or hidden by a change of role."""
+    if is_visible(user) == was_visible:
+        return
+    movies = (db.session.query(MovieComment.movie_id.label("id"), func.count(MovieComment.id).label("count"),
+                                func.max(MovieComment.created_at).label("last"))
+        .filter(MovieComment.user_id == user.id)
+        .group_by(MovieComment.movie_id).subquery())
+    if is_visible(user):
+        values = {
+            "comment_count": Movie.comment_count + movies.c.count,
+            "last_comment_at": func.greatest(func.coalesce(Movie.last_comment_at, movies.c.last), movies.c.last),
+        }
+    else:
+        values = fewer_comments(movies.c.count, MovieComment.user_id == user.id)
+    db.session.execute(Movie.__table__.update().where(Movie.id == movies.c.id).values(values))
+
+def reconcile():
+    """Recount every movie's and user's comments, fixing any counter or last comment time which has drifted.
+    Returns how many rows were fixed."""
+    visible = (db.session.query(MovieComment.movie_id, func.count(MovieComment.id).label("count"),
+                                 func.max(MovieComment.created_at).label("last"))
+        .join(User, User.id == MovieComment.user_id)
+        .filter(User.role.in_(VISIBLE_ROLES))
+        .group_by(MovieComment.movie_id).subquery())
+    counted = func.coalesce(visible.c.count, 0)
+    movies = (db.session.query(Movie.id.label("id"), counted.label("count"), visible.c.last.label("last"))
+        .outerjoin(visible, visible.c.movie_id == Movie.id)
+        .filter(db.or_(Movie.comment_count != counted, Movie.last_comment_at.is_distinct_from(visible.c.last))).subquery())
+    fixed = db.session.execute(Movie.__table__.update().where(Movie.id == movies.c.id)
+        .values(comment_count=movies.c.count, last_comment_at=movies.c.last)).rowcount
+
+    left = (db.session.query(MovieComment.user_id, func.count(MovieComment.id).label("count"))
+        .group_by(MovieComment.user_id).subquery())
+    counted = func.coalesce(left.c.count, 0)
+    users = (db.session.query(User.id.label("id"), counted.label("count"))
+        .outerjoin(left, left.c.user_id == User.id)
+        .filter(User.comment_count != counted).subquery())
+    fixed += db.session.execute(User.__table__.update().where(User.id == users.c.id)
+        .values(comment_count=users.c.count)).rowcount
+
+    if fixed:
+        versions.bump_site()
+    db.session.commit()
+    return fixed
+
+def most_discussed(page, per_page):
+    """Returns one page of the movies with the most visible comments.
+
+    The page is picked from the (comment_count, id) index alone, and then only its movies are read."""
+    return page_of_movies(db.session.query(Movie.id)
+        .filter(Movie.comment_count > 0)
+        .order_by(Movie.comment_count.desc(), Movie.id.desc()), page, per_page)
+
+def trending(page, per_page):
+    """Returns one page of the movies most recently commented on, picked from the (last_comment_at, id) index alone."""
+    return page_of_movies(db.session.query(Movie.id)
+        .filter(Movie.last_comment_at != None)
+        .order_by(Movie.last_comment_at.desc(), Movie.id.desc()), page, per_page)
+
+def page_of_movies(ids, page, per_page):
+    """Load the movies for one page of a query of movie ids, in the query's order."""
+    ids = [id for (id,) in ids.offset((page - 1) * per_page).limit(per_page)]
+    movies = {movie.id: movie for movie in Movie.query.filter(Movie.id.in_(ids))} if ids else {}
+    return [movies[id] for id in ids]
@@ -0,0 +1,90 @@
+"""Configuration and metrics for the pool of database connections
+
+Each worker keeps a pool of DB_POOL_SIZE connections, plus up to DB_MAX_OVERFLOW more under load. Connections are
+checked with a cheap ping before use and replaced after DB_POOL_RECYCLE seconds, so a failover or an idle timeout
+on the server costs one reconnect instead of a failed request. With DB_PGBOUNCER set, the app keeps no pool of its
+own and leaves pooling to PgBouncer in transaction mode."""
+
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool, NullPool
+from flask_sqlalchemy import SQLAlchemy
+from metrics import metrics
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool which records how long each checkout waited for a connection, and how many gave up waiting."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            metrics.incr("db.pool.timeouts")
+            raise
+        finally:
+            metrics.observe("db.pool.checkout", time.perf_counter() - start)
+
+def engine_options(config):
+    """Returns the create_engine options for the pool settings in config."""
+    if config["DB_PGBOUNCER"]:
+        # PgBouncer hands a server connection to a client for one transaction at a time, so the app opens a cheap
+        # connection to PgBouncer per checkout, and can't set anything on the server connection for longer than a
+        # transaction. The statement timeout is set per transaction by watch() instead.
+        return {"poolclass": NullPool}
+    options = {
+        "poolclass": TimedQueuePool,
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+    }
+    if config["DB_STATEMENT_TIMEOUT"]:
+        options["connect_args"] = {"options": f"-c statement_timeout={config['DB_STATEMENT_TIMEOUT']}"}
+    return options
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy with the pool configured from the DB_* settings for Postgres databases."""
+
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        if info.drivername.startswith("postgres"):
+            options.update(engine_options(app.config))
+
+def watch(engine, config):
+    """Record the pool's saturation and connection churn in the metrics, and set the statement timeout per
+    transaction when going through PgBouncer."""
+
+    def record_usage():
+        pool = engine.pool
+        if isinstance(pool, QueuePool):
+            metrics.set_gauge("db.pool.checked_out", pool.checkedout())
+            metrics.set_gauge("db.pool.saturation", round(pool.checkedout() / (pool.size() + max(pool._max_overflow, 0)), 3))
+
+    @event.listens_for(engine, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        metrics.incr("db.pool.checkouts")
+        record_usage()
+
+    @event.listens_for(engine, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        record_usage()
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        metrics.incr("db.pool.connects")
+
+    @event.listens_for(engine, "close")
+    def close(dbapi_connection, connection_record):
+        metrics.incr("db.pool.closes")
+
+    @event.listens_for(engine, "invalidate")
+    def invalidate(dbapi_connection, connection_record, exception):
+        # Stale connections found by the ping before checkout end up here, as do ones which failed mid-query.
+        metrics.incr("db.pool.invalidated")
+
+    if config["DB_PGBOUNCER"] and config["DB_STATEMENT_TIMEOUT"]:
+        @event.listens_for(engine, "begin")
+        def set_statement_timeout(conn):
+            with conn.connection.cursor() as cursor:
+                cursor.execute("SET LOCAL statement_timeout = %s", (config["DB_STATEMENT_TIMEOUT"],))
@@ -0,0 +1,206 @@
+"""Streaming bulk export of the database for researchers"""
+
+import csv
+import io
+import json
+from datetime import datetime
+from sqlalchemy import func
+from models import db, Role, User, Tag, Movie, MovieComment, MovieCommentTag
+
+CHUNK_SIZE = 1000 # rows fetched from the server-side cursor and written out at a time
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+class Filters:
+    """Filters for an export. Any of them may be None."""
+
+    def __init__(self, movie_id=None, tag_id=None, since=None, until=None):
+        self.movie_id = movie_id
+        self.tag_id = tag_id
+        self.since = since
+        self.until = until
+
+    @classmethod
+    def from_strings(cls, movie=None, tag=None, since=None, until=None):
+        """Build filters from query string or command line values. Dates are given as YYYY-MM-DD."""
+        return cls(
+            movie_id=int(movie) if movie else None,
+            tag_id=int(tag) if tag else None,
+            since=datetime.strptime(since, "%Y-%m-%d") if since else None,
+            until=datetime.strptime(until, "%Y-%m-%d") if until else None,
+        )
+
+def filter_dates(query, column, filters):
+    """Limit a query to rows where column falls within the date range of the filters."""
+    if filters.since:
+        query = query.filter(column >= filters.since)
+    if filters.until:
+        query = query.filter(column < filters.until)
+    return query
+
+def movies_query(filters):
+    """Query for the movies in the database."""
+    query = db.session.query(Movie.id, Movie.title, Movie.release_date, Movie.overview, Movie.poster_path)
+    if filters.movie_id:
+        query = query.filter(Movie.id == filters.movie_id)
+    if filters.tag_id:
+        tagged = db.session.query(MovieComment.movie_id).join(MovieCommentTag, MovieCommentTag.movie_comment_id == MovieComment.id).filter(MovieCommentTag.tag_id == filters.tag_id)
+        query = query.filter(Movie.id.in_(tagged))
+    query = filter_dates(query, Movie.release_date, filters)
+    return query.order_by(Movie.id)
+
+def tags_query(filters):
+    """Query for the tags in the database."""
+    query = db.session.query(Tag.id, Tag.name, Tag.description, Tag.active, Tag.created_by_id)
+    if filters.tag_id:
+        query = query.filter(Tag.id == filters.tag_id)
+    return query.order_by(Tag.id)
+
+def comments_query(filters):
+    """Query for the comments left on movies."""
+    query = db.session.query(MovieComment.id, MovieComment.movie_id, MovieComment.user_id, MovieComment.subject, MovieComment.text,
+                             MovieComment.created_at, MovieComment.updated_at)
+    if filters.movie_id:
+        query = query.filter(MovieComment.movie_id == filters.movie_id)
+    if filters.tag_id:
+        tagged = db.session.query(MovieCommentTag.movie_comment_id).filter(MovieCommentTag.tag_id == filters.tag_id)
+        query = query.filter(MovieComment.id.in_(tagged))
+    query = filter_dates(query, MovieComment.created_at, filters)
+    return query.order_by(MovieComment.id)
+
+def comment_tags_query(filters):
+    """Query for the tags attached to comments."""
+    query = db.session.query(MovieCommentTag.id, MovieCommentTag.movie_comment_id, MovieCommentTag.tag_id, MovieCommentTag.created_at)
+    if filters.tag_id:
+        query = query.filter(MovieCommentTag.tag_id == filters.tag_id)
+    if filters.movie_id:
+        query = query.join(MovieComment, MovieComment.id == MovieCommentTag.movie_comment_id).filter(MovieComment.movie_id == filters.movie_id)
+    query = filter_dates(query, MovieCommentTag.created_at, filters)
+    return query.order_by(MovieCommentTag.id)
+
+def tag_counts_query(filters):
+    """Count of each tag on each movie, following the same visibility rules as the movie page:
+    comments from shadow banned and banned users and hidden tags are left out."""
+    count = func.count(MovieCommentTag.id)
+    query = (db.session.query(MovieComment.movie_id, Tag.id, Tag.name, count)
+        .join(MovieCommentTag, MovieCommentTag.movie_comment_id == MovieComment.id)
+        .join(Tag, Tag.id == MovieCommentTag.tag_id)
+        .join(User, User.id == MovieComment.user_id)
+        .filter(Tag.active == True, User.role.in_([Role.admin, Role.mod, Role.user])))
+    if filters.movie_id:
+        query = query.filter(MovieComment.movie_id == filters.movie_id)
+    if filters.tag_id:
+        query = query.filter(Tag.id == filters.tag_id)
+    query = filter_dates(query, MovieCommentTag.created_at, filters)
+    return query.group_by(MovieComment.movie_id, Tag.id, Tag.name).order_by(MovieComment.movie_id, Tag.id)
+
+# Each export is a query and its columns as (name, type) pairs.
+EXPORTS = {
+    "movies": (movies_query, [("id", "int"), ("title", "str"), ("release_date", "datetime"), ("overview", "str"), ("poster_path", "str")]),
+    "tags": (tags_query, [("id", "int"), ("name", "str"), ("description", "str"), ("active", "bool"), ("created_by_id", "int")]),
+    "comments": (comments_query, [("id", "int"), ("movie_id", "int"), ("user_id", "int"), ("subject", "str"), ("text", "str"),
+                                  ("created_at", "datetime"), ("updated_at", "datetime")]),
+    "comment_tags": (comment_tags_query, [("id", "int"), ("movie_comment_id", "int"), ("tag_id", "int"), ("created_at", "datetime")]),
+    "tag_counts": (tag_counts_query, [("movie_id", "int"), ("tag_id", "int"), ("tag_name", "str"), ("count", "int")]),
+}
+
+def iter_chunks(name, filters):
+    """Yields lists of rows for the named export, CHUNK_SIZE at a time, read through a server-side cursor."""
+    make_query, columns = EXPORTS[name]
+    chunk = []
+    for row in make_query(filters).yield_per(CHUNK_SIZE):
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def to_json_value(value):
+    """Returns the value in a form json and csv can hold."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def stream_ndjson(name, filters):
+    """Yields the named export as newline delimited json, one chunk of rows at a time."""
+    names = [column for column, kind in EXPORTS[name][1]]
+    for chunk in iter_chunks(name, filters):
+        yield "".join(json.dumps(dict(zip(names, map(to_json_value, row)))) + "\n" for row in chunk)
+
+def stream_csv(name, filters):
+    """Yields the named export as csv with a header row, one chunk of rows at a time."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([column for column, kind in EXPORTS[name][1]])
+    for chunk in iter_chunks(name, filters):
+        writer.writerows([to_json_value(value) for value in row] for row in chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+class ChunkSink(io.RawIOBase):
+    """A write-only file which holds on to what is written until it is drained."""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        """Returns everything written since the last drain."""
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+def stream_parquet(name, filters):
+    """Yields the named export as parquet, one row group per chunk of rows. Requires pyarrow."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {"int": pa.int64(), "str": pa.string(), "datetime": pa.timestamp("us"), "bool": pa.bool_()}
+    columns = EXPORTS[name][1]
+    schema = pa.schema([(column, types[kind]) for column, kind in columns])
+
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    for chunk in iter_chunks(name, filters):
+        arrays = [pa.array([row[i] for row in chunk], type=schema.field(i).type) for i in range(len(columns))]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def parquet_available():
+    """Returns True if pyarrow is installed so parquet exports can be made."""
+    try:
+        import pyarrow.parquet
+    except ImportError:
+        return False
+    return True
+
+STREAMS = {
+    "ndjson": stream_ndjson,
+    "csv": stream_csv,
+    "parquet": stream_parquet,
+}
+
+def stream(name, fmt, filters):
+    """Yields the named export in the given format."""
+    return STREAMS[fmt](name, filters)
@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, TextAreaField, SelectField, SelectMultipleField
+from wtforms import StringField, PasswordField, TextAreaField, SelectField, SelectMultipleField, IntegerField
 from wtforms.validators import DataRequired, Email, Length, EqualTo, InputRequired, Optional
 from models import User
 
@@ -44,4 +44,19 @@ class TagForm(FlaskForm):
     """Form for adding or editing a tag for the database. Moderators and Admins only."""
 
     name = StringField('Tag Name', validators=[DataRequired(), Length(max=100)], render_kw={'maxlength': 100})
-    description = TextAreaField('Description')
\ No newline at end of file
+    description = TextAreaField('Description')
+
+class ModerationForm(FlaskForm):
+    """Form for starting a bulk moderation job. Which fields are needed depends on the action."""
+
+    action = SelectField('Action', choices=[
+        ("delete_comments", "Delete comments matching the filters below"),
+        ("purge_user", "Ban a user and delete their comments"),
+        ("delete_tag", "Delete a tag"),
+        ("merge_tags", "Merge a tag into another"),
+    ])
+    username = StringField('Username', validators=[Optional(), Length(max=30)])
+    tag = StringField('Tag', validators=[Optional(), Length(max=100)])
+    into = StringField('Merge Into Tag', validators=[Optional(), Length(max=100)])
+    movie = IntegerField('Movie ID', validators=[Optional()])
+    contains = StringField('Comment Contains', validators=[Optional(), Length(max=100)])
\ No newline at end of file
@@ -0,0 +1,198 @@
+"""Rate limiting and admission control for the app"""
+
+import math
+import threading
+import time
+from sqlalchemy import text
+from metrics import metrics
+
+class Policy:
+    """A token bucket policy: a client may make `burst` requests at once, refilled at `rate` requests per second."""
+
+    def __init__(self, name, burst, rate, methods=("GET", "POST"), scopes=("ip", "user")):
+        self.name = name
+        self.burst = burst
+        self.rate = rate
+        self.methods = methods
+        self.scopes = scopes
+
+# Policies keyed by the endpoint (view function name) they apply to.
+search_policy = Policy("search", burst=10, rate=0.5, methods=("GET",))
+login_policy = Policy("login", burst=5, rate=5 / 60, methods=("POST",))
+signup_policy = Policy("signup", burst=3, rate=1 / 60, methods=("POST",))
+write_policy = Policy("write", burst=20, rate=0.2, methods=("POST",))
+
+POLICIES = {
+    "search": search_policy,
+    "login": login_policy,
+    "signup": signup_policy,
+    "edit": login_policy,
+    "add_comment": write_policy,
+    "edit_comment": write_policy,
+    "delete_comment": write_policy,
+    "new_tag": write_policy,
+    "edit_tag": write_policy,
+    "hide_tag": write_policy,
+    "show_tag": write_policy,
+    "delete_tag": write_policy,
+    "set_role": write_policy,
+}
+
+class MemoryBackend:
+    """Keeps token buckets in this worker's memory. Limits are per worker process."""
+
+    MAX_KEYS = 100000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, key, burst, rate, now):
+        """Take a token from the bucket for key. Returns a tuple of (allowed, tokens left)."""
+        with self._lock:
+            tokens, updated, _, _ = self._buckets.get(key, (burst, now, burst, rate))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            if len(self._buckets) >= self.MAX_KEYS and key not in self._buckets:
+                self.evict(now)
+
+            # Each bucket keeps its own policy's burst and rate, so it can be checked for eviction on its own terms.
+            self._buckets[key] = (tokens, now, burst, rate)
+            return allowed, tokens
+
+    def evict(self, now):
+        """Make room for new buckets. Buckets which have refilled completely carry no state, so they are dropped
+        first; if none have, the least recently used tenth of the buckets are dropped instead."""
+        self._buckets = {k: v for k, v in self._buckets.items() if v[0] + (now - v[1]) * v[3] < v[2]}
+        if len(self._buckets) >= self.MAX_KEYS:
+            by_age = sorted(self._buckets, key=lambda k: self._buckets[k][1])
+            for k in by_age[:max(1, len(by_age) // 10)]:
+                del self._buckets[k]
+
+class DatabaseBackend:
+    """Keeps token buckets in the rate_limit_bucket table so limits are shared by every worker.
+
+    A bucket left alone for longer than the slowest policy takes to refill is full again and carries no state, so
+    each worker deletes such buckets every PRUNE_EVERY seconds, keeping the table to the clients seen recently."""
+
+    PRUNE_EVERY = 60 # seconds between deletions of idle buckets by each worker
+
+    TAKE_SQL = text("""
+        INSERT INTO rate_limit_bucket (key, tokens, updated_at, allowed)
+        VALUES (:key, :burst - 1, :now, true)
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = CASE
+                WHEN LEAST(:burst, rate_limit_bucket.tokens + (:now - rate_limit_bucket.updated_at) * :rate) >= 1
+                THEN LEAST(:burst, rate_limit_bucket.tokens + (:now - rate_limit_bucket.updated_at) * :rate) - 1
+                ELSE LEAST(:burst, rate_limit_bucket.tokens + (:now - rate_limit_bucket.updated_at) * :rate)
+            END,
+            allowed = LEAST(:burst, rate_limit_bucket.tokens + (:now - rate_limit_bucket.updated_at) * :rate) >= 1,
+            updated_at = :now
+        RETURNING allowed, tokens
+    """)
+
+    PRUNE_SQL = text("DELETE FROM rate_limit_bucket WHERE updated_at < :idle_since")
+
+    def __init__(self, engine, idle_after=None):
+        self.engine = engine
+        # The longest any policy's bucket takes to refill from empty.
+        self.idle_after = idle_after or max(policy.burst / policy.rate for policy in POLICIES.values())
+        self.pruned = 0
+
+    def take(self, key, burst, rate, now):
+        """Take a token from the bucket for key. Returns a tuple of (allowed, tokens left)."""
+        if now - self.pruned >= self.PRUNE_EVERY:
+            self.prune(now)
+        # Use a connection of our own so the request's session transaction is left untouched.
+        with self.engine.begin() as conn:
+            row = conn.execute(self.TAKE_SQL, key=key, burst=burst, rate=rate, now=now).first()
+        return row.allowed, row.tokens
+
+    def prune(self, now):
+        """Delete the buckets which have been idle long enough to have refilled completely. Returns how many were deleted."""
+        self.pruned = now
+        with self.engine.begin() as conn:
+            return conn.execute(self.PRUNE_SQL, idle_since=now - self.idle_after).rowcount
+
+class RateLimiter:
+    """Checks requests against the policy for their endpoint."""
+
+    def __init__(self, backend, policies=POLICIES):
+        self.backend = backend
+        self.policies = policies
+
+    def check(self, endpoint, method, ip, user_id=None):
+        """Check a request against its policy. Returns None if it is allowed, or the number of seconds to wait."""
+        policy = self.policies.get(endpoint)
+        if not policy or method not in policy.methods:
+            return None
+
+        keys = []
+        if "ip" in policy.scopes:
+            keys.append(f"{policy.name}:ip:{ip}")
+        if "user" in policy.scopes and user_id is not None:
+            keys.append(f"{policy.name}:user:{user_id}")
+
+        now = time.time()
+        retry_after = None
+        for key in keys:
+            allowed, tokens = self.backend.take(key, policy.burst, policy.rate, now)
+            if not allowed:
+                wait = math.ceil((1 - tokens) / policy.rate)
+                retry_after = max(retry_after or 0, wait)
+
+        if retry_after is None:
+            metrics.incr(f"ratelimit.allowed.{policy.name}")
+        else:
+            metrics.incr(f"ratelimit.rejected.{policy.name}")
+        return retry_after
+
+def make_backend(name, engine=None):
+    """Returns the rate limit backend with the given name ("memory" or "database")."""
+    if name == "database":
+        return DatabaseBackend(engine)
+    return MemoryBackend()
+
+class Overloaded(Exception):
+    """Raised when there is no capacity left for a kind of expensive work."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"No capacity left for {name}")
+        self.name = name
+        self.retry_after = retry_after
+
+class Capacity:
+    """Bounds how many of one kind of expensive work (TMDb calls, bcrypt hashes) a worker runs at once.
+
+    Used as a context manager. When every slot is taken for longer than `wait` seconds, Overloaded is raised
+    so the request can be shed instead of queueing behind the others."""
+
+    def __init__(self, name, limit, wait=0.5, retry_after=1):
+        self.name = name
+        self.limit = limit
+        self.wait = wait
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def _set_in_flight(self, change):
+        with self._lock:
+            self.in_flight += change
+            metrics.set_gauge(f"admission.in_flight.{self.name}", self.in_flight)
+
+    def __enter__(self):
+        if not self._slots.acquire(timeout=self.wait):
+            metrics.incr(f"admission.rejected.{self.name}")
+            raise Overloaded(self.name, self.retry_after)
+        metrics.incr(f"admission.admitted.{self.name}")
+        self._set_in_flight(1)
+        return self
+
+    def __exit__(self, *exc):
+        self._set_in_flight(-1)
+        self._slots.release()
+        return False
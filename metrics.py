@@ -0,0 +1,38 @@
+"""In-process metrics for the app"""
+
+import threading
+from collections import Counter
+
+class Metrics:
+    """A small thread-safe registry of counters, gauges and timings kept per worker process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = Counter()
+        self.gauges = {}
+        self.timings = {}
+
+    def incr(self, name, amount=1):
+        """Increase the counter with the given name."""
+        with self._lock:
+            self.counters[name] += amount
+
+    def set_gauge(self, name, value):
+        """Set the gauge with the given name to a value."""
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        """Record how long something with the given name took."""
+        with self._lock:
+            count, total, longest = self.timings.get(name, (0, 0.0, 0.0))
+            self.timings[name] = (count + 1, total + seconds, max(longest, seconds))
+
+    def snapshot(self):
+        """Returns a copy of every counter and gauge, and the count, mean and longest of every timing in milliseconds."""
+        with self._lock:
+            timings = {name: {"count": count, "mean_ms": round(total / count * 1000, 3), "max_ms": round(longest * 1000, 3)}
+                       for name, (count, total, longest) in self.timings.items()}
+            return {"counters": dict(self.counters), "gauges": dict(self.gauges), "timings": timings}
+
+metrics = Metrics()
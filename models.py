@@ -3,10 +3,10 @@
 from enum import Enum
 from datetime import datetime
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from dbpool import PooledSQLAlchemy, watch
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = PooledSQLAlchemy()
 
 class Role(Enum):
     admin = 0
@@ -23,20 +23,32 @@ role_strings = {
     Role.full_ban: "Banned"
 }
 
+# The database's own default for timestamps, in UTC like the datetime.utcnow defaults set by the app.
+UTC_NOW = db.text("(now() at time zone 'utc')")
+
 def connect_db(app):
     db.app = app
     db.init_app(app)
+    watch(db.engine, app.config)
 
 class Movie(db.Model):
     """Model for the Movie table"""
 
     __tablename__ = "movie"
+    __table_args__ = (
+        db.Index("ix_movie_comment_count", "comment_count", "id"),
+        db.Index("ix_movie_last_comment_at", "last_comment_at", "id"),
+    )
 
     id = db.Column( db.Integer, primary_key=True)
     title = db.Column(db.String(1000), nullable=False)
     poster_path = db.Column(db.Text)
     release_date = db.Column(db.DateTime)
     overview = db.Column(db.Text)
+    fetched_at = db.Column(db.DateTime, index=True) # when the details above were last copied from TMDb
+    views = db.Column(db.Integer, nullable=False, default=0, server_default="0") # page views since fetched_at
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default="0") # comments visible to everyone
+    last_comment_at = db.Column(db.DateTime) # when the latest visible comment was left
 
     @property
     def release_date_str(self):
@@ -64,6 +76,7 @@ class User(db.Model):
     role = db.Column(db.Enum(Role), nullable=False, default="user")
     created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
     last_login = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     @property
     def role_string(self):
@@ -118,6 +131,7 @@ class MovieComment(db.Model):
     """Each user can leave one MovieComment on each Movie"""
 
     __tablename__ = "movie_comment"
+    __table_args__ = (db.UniqueConstraint("movie_id", "user_id", name="uq_movie_comment_movie_user"),)
 
     id = db.Column( db.Integer, primary_key=True, autoincrement=True)
     movie_id = db.Column(db.Integer, db.ForeignKey('movie.id', ondelete='CASCADE'), nullable=False)
@@ -128,15 +142,155 @@ class MovieComment(db.Model):
     subject = db.Column(db.String(100))
     text = db.Column(db.Text())
     rating = db.Column(db.Integer) # may or may not implement
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=UTC_NOW, index=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=UTC_NOW, onupdate=datetime.utcnow)
 
 class MovieCommentTag(db.Model):
     """Model for the MovieCommentTag table"""
     """Each MovieComment can have multiple MovieCommentTags associated with it"""
 
     __tablename__ = "movie_comment_tag"
+    __table_args__ = (db.UniqueConstraint("movie_comment_id", "tag_id", name="uq_movie_comment_tag_comment_tag"),)
 
     id = db.Column( db.Integer, primary_key=True, autoincrement=True)
     movie_comment_id = db.Column(db.Integer, db.ForeignKey('movie_comment.id', ondelete='CASCADE'), nullable=False)
     comment = db.relationship('MovieComment')
     tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), nullable=False)
-    tag = db.relationship('Tag')
\ No newline at end of file
+    tag = db.relationship('Tag')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, server_default=UTC_NOW, index=True)
+
+class RateLimitBucket(db.Model):
+    """Model for the RateLimitBucket table"""
+    """Token buckets shared by every worker when the database rate limit backend is used"""
+
+    __tablename__ = "rate_limit_bucket"
+
+    key = db.Column(db.String(200), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False) # seconds since the epoch
+    allowed = db.Column(db.Boolean, nullable=False, default=True) # whether the last request was allowed
+
+class RelatedMovie(db.Model):
+    """Model for the RelatedMovie table"""
+    """The movies most similarly tagged to each movie, rebuilt by the related movies refresh"""
+
+    __tablename__ = "related_movie"
+
+    movie_id = db.Column(db.Integer, db.ForeignKey('movie.id', ondelete='CASCADE'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    related_movie_id = db.Column(db.Integer, db.ForeignKey('movie.id', ondelete='CASCADE'), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    related_movie = db.relationship('Movie', foreign_keys=[related_movie_id])
+
+class RelatedTag(db.Model):
+    """Model for the RelatedTag table"""
+    """The tags most often given to the same movies as each tag, rebuilt by the related movies refresh"""
+
+    __tablename__ = "related_tag"
+
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    related_tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    movies = db.Column(db.Integer, nullable=False) # how many movies have been given both tags
+    related_tag = db.relationship('Tag', foreign_keys=[related_tag_id])
+
+class RelatedDirtyMovie(db.Model):
+    """Model for the RelatedDirtyMovie table"""
+    """Movies whose tags have changed since related movies were last refreshed"""
+
+    __tablename__ = "related_dirty_movie"
+
+    movie_id = db.Column(db.Integer, primary_key=True)
+
+class TagMovieCount(db.Model):
+    """Model for the TagMovieCount table"""
+    """How many visible comments gave each movie each tag, kept up to date as comments and roles change"""
+
+    __tablename__ = "tag_movie_count"
+    __table_args__ = (
+        db.Index("ix_tag_movie_count_leaderboard", "tag_id", "count", "movie_id"),
+        db.Index("ix_tag_movie_count_movie_id", "movie_id"),
+    )
+
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True)
+    movie_id = db.Column(db.Integer, db.ForeignKey('movie.id', ondelete='CASCADE'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    movie = db.relationship('Movie')
+
+class TagUsage(db.Model):
+    """Model for the TagUsage table"""
+    """How many times each tag has been used on visible comments, and on how many movies"""
+
+    __tablename__ = "tag_usage"
+
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True)
+    uses = db.Column(db.Integer, nullable=False, default=0)
+    movies = db.Column(db.Integer, nullable=False, default=0)
+
+class ModerationJob(db.Model):
+    """Model for the ModerationJob table"""
+    """A bulk moderation action and how far it has got, so the console can show its progress"""
+
+    __tablename__ = "moderation_job"
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    action = db.Column(db.String(30), nullable=False)
+    params = db.Column(db.JSON, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="queued") # queued, running, done, or failed
+    total = db.Column(db.Integer) # rows to process, counted when the job starts
+    done = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_by_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='SET NULL'))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    created_by = db.relationship("User")
+
+class MovieTagTrend(db.Model):
+    """Model for the MovieTagTrend table"""
+    """How many times each movie was given each tag in each hour or day, by visible comments"""
+
+    __tablename__ = "movie_tag_trend"
+    __table_args__ = (
+        db.Index("ix_movie_tag_trend_bucket", "period", "bucket"),
+    )
+
+    period = db.Column(db.String(4), primary_key=True) # "hour" or "day"
+    movie_id = db.Column(db.Integer, db.ForeignKey('movie.id', ondelete='CASCADE'), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True) # the start of the hour or day
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+
+class TagTrend(db.Model):
+    """Model for the TagTrend table"""
+    """How many times each tag was given to any movie in each hour or day, by visible comments"""
+
+    __tablename__ = "tag_trend"
+    __table_args__ = (
+        db.Index("ix_tag_trend_bucket", "period", "bucket"),
+    )
+
+    period = db.Column(db.String(4), primary_key=True) # "hour" or "day"
+    tag_id = db.Column(db.Integer, db.ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True) # the start of the hour or day
+    count = db.Column(db.Integer, nullable=False)
+
+class TrendDirtyHour(db.Model):
+    """Model for the TrendDirtyHour table"""
+    """Hours whose comment tags have changed since the trends were last aggregated"""
+
+    __tablename__ = "trend_dirty_hour"
+
+    bucket = db.Column(db.DateTime, primary_key=True)
+
+class ContentVersion(db.Model):
+    """Model for the ContentVersion table"""
+    """Versions of what movie and user pages show, bumped whenever it changes, so pages can be given ETags.
+    The "site" version, with key 0, is bumped by changes which touch many pages at once."""
+
+    __tablename__ = "content_version"
+
+    scope = db.Column(db.Text, primary_key=True) # "movie", "user" or "site"
+    key = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
@@ -0,0 +1,344 @@
+"""Bulk moderation actions, run as set-based SQL in chunked transactions which record their progress
+
+Each action works through its rows a chunk at a time. The rollups, the comment counters, the trends, the related
+movies queue, and the job's progress are updated in the same transaction as each chunk, so a job which stops
+part way through leaves everything consistent and can be run again to finish."""
+
+import logging
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy import exists, and_
+from sqlalchemy.orm import aliased
+import related
+import rollups
+import counters
+import trends
+import versions
+from models import db, Role, User, Tag, Movie, MovieComment, MovieCommentTag, ModerationJob, TagMovieCount, TagUsage
+
+CHUNK_SIZE = 5000 # rows deleted or updated per transaction
+
+class InvalidAction(Exception):
+    """Raised when a moderation action is asked for with missing or unknown parameters."""
+
+MAX_ID = 2 ** 31 - 1 # the largest id the database's integer columns hold
+
+def text_param(params, name):
+    """Returns the named parameter, which must be a string if it is given, or None if it is missing or empty."""
+    value = params.get(name)
+    if value is not None and not isinstance(value, str):
+        raise InvalidAction(f"{name} must be a string.")
+    return value or None
+
+def id_param(params, name):
+    """Returns the named parameter, which must be a positive whole number if it is given, or None if it is missing."""
+    value = params.get(name)
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 < value <= MAX_ID:
+        raise InvalidAction(f"{name} must be a positive whole number.")
+    return value
+
+def find_user(username):
+    """Returns the user with the username, or raises InvalidAction."""
+    user = User.query.filter_by(username=username).one_or_none() if username else None
+    if not user:
+        raise InvalidAction(f"User {username!r} does not exist.")
+    return user
+
+def find_tag(name):
+    """Returns the tag with the name, or raises InvalidAction."""
+    tag = Tag.query.filter_by(name=name).one_or_none() if name else None
+    if not tag:
+        raise InvalidAction(f"Tag {name!r} does not exist.")
+    return tag
+
+def visible_tag_counts(comment_ids):
+    """Returns (tag id, movie id, count) for the tags on those of the comments which are counted in the rollups."""
+    return (db.session.query(MovieCommentTag.tag_id, MovieComment.movie_id, db.func.count(MovieCommentTag.id))
+        .join(MovieComment, MovieComment.id == MovieCommentTag.movie_comment_id)
+        .join(User, User.id == MovieComment.user_id)
+        .filter(MovieComment.id.in_(comment_ids), User.role.in_(rollups.VISIBLE_ROLES))
+        .group_by(MovieCommentTag.tag_id, MovieComment.movie_id)
+        .all())
+
+def delete_comments(comment_ids):
+    """Delete comments, taking them out of the rollups and counters first. Their tags are deleted by the database's cascade."""
+    rollups.apply((tag_id, movie_id, -count) for tag_id, movie_id, count in visible_tag_counts(comment_ids))
+    counters.comments_deleted(comment_ids)
+    trends.mark_comments(comment_ids)
+    movie_ids = db.session.query(MovieComment.movie_id).filter(MovieComment.id.in_(comment_ids)).distinct()
+    related.mark_movies_dirty(movie_id for (movie_id,) in movie_ids)
+    MovieComment.query.filter(MovieComment.id.in_(comment_ids)).delete(synchronize_session=False)
+
+class Action(ABC):
+    """One kind of bulk moderation. Subclasses say how to check the parameters, how many rows there are to process,
+    and how to process them a chunk at a time."""
+
+    permission = 0 # the highest role value allowed to start the action
+
+    @abstractmethod
+    def prepare(self, params):
+        """Returns the parameters to store with the job, with names looked up, or raises InvalidAction."""
+
+    @abstractmethod
+    def describe(self, params):
+        """Returns a short description of the job for the console."""
+
+    @abstractmethod
+    def count(self, params):
+        """Returns how many rows are left to process."""
+
+    @abstractmethod
+    def chunks(self, params, chunk_size):
+        """Process the rows a chunk at a time, yielding how many rows each chunk processed.
+        Each chunk's changes are committed by the caller after it is yielded."""
+
+class PurgeUser(Action):
+    """Ban a user, then delete every comment they left."""
+
+    def prepare(self, params):
+        user = find_user(text_param(params, "username"))
+        if user.role == Role.admin:
+            raise InvalidAction("Admins can't be banned.")
+        return {"user_id": user.id, "username": user.username}
+
+    def describe(self, params):
+        return f"Ban {params['username']} and delete their comments"
+
+    def count(self, params):
+        return MovieComment.query.filter_by(user_id=params["user_id"]).count()
+
+    def chunks(self, params, chunk_size):
+        # Banning hides the comments first, taking them out of the rollups and movie counts in one go,
+        # so deleting them only changes the user's own count.
+        user = User.query.get(params["user_id"])
+        was_visible = rollups.is_visible(user)
+        user.role = Role.full_ban
+        if was_visible:
+            related.mark_user_movies_dirty(user.id)
+            rollups.user_visibility_changed(user, was_visible)
+            counters.user_visibility_changed(user, was_visible)
+            trends.mark_user(user.id)
+        yield 0
+
+        while True:
+            ids = [id for (id,) in db.session.query(MovieComment.id)
+                .filter_by(user_id=params["user_id"]).order_by(MovieComment.id).limit(chunk_size)]
+            if not ids:
+                break
+            counters.comments_deleted(ids)
+            MovieComment.query.filter(MovieComment.id.in_(ids)).delete(synchronize_session=False)
+            yield len(ids)
+
+class DeleteComments(Action):
+    """Delete every comment matching a filter on the movie, the user, the tags, and the text."""
+
+    permission = 10
+
+    def prepare(self, params):
+        prepared = {}
+        movie_id, username, tag_name, contains = (id_param(params, "movie"), text_param(params, "username"),
+                                                  text_param(params, "tag"), text_param(params, "contains"))
+        if movie_id:
+            movie = Movie.query.get(movie_id)
+            if not movie:
+                raise InvalidAction(f"Movie {movie_id} does not exist.")
+            prepared["movie_id"], prepared["movie"] = movie.id, movie.title
+        if username:
+            user = find_user(username)
+            prepared["user_id"], prepared["username"] = user.id, user.username
+        if tag_name:
+            tag = find_tag(tag_name)
+            prepared["tag_id"], prepared["tag"] = tag.id, tag.name
+        if contains:
+            prepared["contains"] = contains
+        if not prepared:
+            raise InvalidAction("Deleting comments needs at least one filter.")
+        return prepared
+
+    def describe(self, params):
+        filters = [f"on {params['movie']}" if "movie" in params else None,
+                   f"by {params['username']}" if "username" in params else None,
+                   f"tagged {params['tag']}" if "tag" in params else None,
+                   f"containing {params['contains']!r}" if "contains" in params else None]
+        return "Delete comments " + " ".join(f for f in filters if f)
+
+    def matching(self, params):
+        query = db.session.query(MovieComment.id)
+        if "movie_id" in params:
+            query = query.filter(MovieComment.movie_id == params["movie_id"])
+        if "user_id" in params:
+            query = query.filter(MovieComment.user_id == params["user_id"])
+        if "tag_id" in params:
+            query = query.filter(exists().where(and_(MovieCommentTag.movie_comment_id == MovieComment.id,
+                                                     MovieCommentTag.tag_id == params["tag_id"])))
+        if "contains" in params:
+            pattern = "%" + params["contains"].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            query = query.filter(db.or_(MovieComment.subject.ilike(pattern), MovieComment.text.ilike(pattern)))
+        return query
+
+    def count(self, params):
+        return self.matching(params).count()
+
+    def chunks(self, params, chunk_size):
+        last = 0
+        while True:
+            ids = [id for (id,) in self.matching(params).filter(MovieComment.id > last).order_by(MovieComment.id).limit(chunk_size)]
+            if not ids:
+                break
+            delete_comments(ids)
+            last = ids[-1]
+            yield len(ids)
+
+class DeleteTag(Action):
+    """Take a tag off every comment, then delete it."""
+
+    def prepare(self, params):
+        tag = find_tag(text_param(params, "tag"))
+        return {"tag_id": tag.id, "tag": tag.name}
+
+    def describe(self, params):
+        return f"Delete the tag {params['tag']}"
+
+    def count(self, params):
+        return MovieCommentTag.query.filter_by(tag_id=params["tag_id"]).count()
+
+    def chunks(self, params, chunk_size):
+        # Hide the tag and drop its rollups first, so it disappears from the site before the slow part starts.
+        tag_id = params["tag_id"]
+        Tag.query.filter_by(id=tag_id).update({"active": False}, synchronize_session=False)
+        related.mark_tag_movies_dirty(tag_id)
+        trends.mark_tag(tag_id)
+        TagMovieCount.query.filter_by(tag_id=tag_id).delete(synchronize_session=False)
+        TagUsage.query.filter_by(tag_id=tag_id).delete(synchronize_session=False)
+        yield 0
+
+        while True:
+            ids = db.session.query(MovieCommentTag.id).filter_by(tag_id=tag_id).limit(chunk_size).subquery()
+            deleted = MovieCommentTag.query.filter(MovieCommentTag.id.in_(ids)).delete(synchronize_session=False)
+            if not deleted:
+                break
+            yield deleted
+
+        Tag.query.filter_by(id=tag_id).delete(synchronize_session=False)
+        yield 0
+
+class MergeTags(Action):
+    """Move every use of one tag to another, then delete the first tag. A comment with both tags keeps just the second."""
+
+    def prepare(self, params):
+        tag, into = find_tag(text_param(params, "tag")), find_tag(text_param(params, "into"))
+        if tag == into:
+            raise InvalidAction("A tag can't be merged into itself.")
+        return {"tag_id": tag.id, "tag": tag.name, "into_id": into.id, "into": into.name}
+
+    def describe(self, params):
+        return f"Merge the tag {params['tag']} into {params['into']}"
+
+    def count(self, params):
+        return MovieCommentTag.query.filter_by(tag_id=params["tag_id"]).count()
+
+    def chunks(self, params, chunk_size):
+        tag_id, into_id = params["tag_id"], params["into_id"]
+        Tag.query.filter_by(id=tag_id).update({"active": False}, synchronize_session=False)
+        related.mark_tag_movies_dirty(tag_id)
+        trends.mark_tag(tag_id)
+        yield 0
+
+        other = aliased(MovieCommentTag)
+        has_target = exists().where(and_(other.movie_comment_id == MovieCommentTag.movie_comment_id, other.tag_id == into_id))
+        while True:
+            rows = (db.session.query(MovieCommentTag.id, MovieComment.movie_id, User.role.in_(rollups.VISIBLE_ROLES), has_target)
+                .join(MovieComment, MovieComment.id == MovieCommentTag.movie_comment_id)
+                .join(User, User.id == MovieComment.user_id)
+                .filter(MovieCommentTag.tag_id == tag_id)
+                .limit(chunk_size)
+                .all())
+            if not rows:
+                break
+
+            moved = [id for id, movie_id, visible, duplicate in rows if not duplicate]
+            duplicates = [id for id, movie_id, visible, duplicate in rows if duplicate]
+            if moved:
+                MovieCommentTag.query.filter(MovieCommentTag.id.in_(moved)).update({"tag_id": into_id}, synchronize_session=False)
+            if duplicates:
+                MovieCommentTag.query.filter(MovieCommentTag.id.in_(duplicates)).delete(synchronize_session=False)
+
+            rollups.apply([(tag_id, movie_id, -1) for id, movie_id, visible, duplicate in rows if visible] +
+                          [(into_id, movie_id, 1) for id, movie_id, visible, duplicate in rows if visible and not duplicate])
+            yield len(rows)
+
+        Tag.query.filter_by(id=tag_id).delete(synchronize_session=False)
+        yield 0
+
+ACTIONS = {
+    "purge_user": PurgeUser(),
+    "delete_comments": DeleteComments(),
+    "delete_tag": DeleteTag(),
+    "merge_tags": MergeTags(),
+}
+
+def create(action, params, user):
+    """Check the parameters and store a new job for the action. Returns the job, or raises InvalidAction."""
+    if not isinstance(action, str) or action not in ACTIONS:
+        raise InvalidAction(f"Unknown action {action!r}.")
+    job = ModerationJob(action=action, params=ACTIONS[action].prepare(params), created_by_id=user.id if user else None)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def run(job_id, chunk_size=CHUNK_SIZE):
+    """Run a job to the end, committing each chunk along with the job's progress.
+    Jobs which stopped part way through pick up where they left off."""
+    job = ModerationJob.query.get(job_id)
+    action = ACTIONS[job.action]
+    try:
+        job.status = "running"
+        job.error = None
+        job.total = job.done + action.count(job.params)
+        db.session.commit()
+
+        for processed in action.chunks(job.params, chunk_size):
+            job.done += processed
+            versions.bump_site()
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.exception(f"Moderation job {job_id} failed")
+        job.status = "failed"
+        job.error = str(e)
+    else:
+        job.status = "done"
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+    return job
+
+# Jobs started from the console run one at a time on a background thread, so requests return straight away.
+runner = ThreadPoolExecutor(max_workers=1)
+
+def start(app, job_id):
+    """Run a job in the background."""
+    runner.submit(run_in_app, app, job_id)
+
+def run_in_app(app, job_id):
+    with app.app_context():
+        try:
+            run(job_id)
+        finally:
+            db.session.remove()
+
+def progress(job):
+    """Returns the job's progress as a dict for the api."""
+    return {
+        "id": job.id,
+        "action": job.action,
+        "description": ACTIONS[job.action].describe(job.params),
+        "status": job.status,
+        "total": job.total,
+        "done": job.done,
+        "error": job.error,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
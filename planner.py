@@ -0,0 +1,125 @@
+"""Plans batches of TMDb movie lookups and writes what they find through to the Movie table
+
+Each movie is looked up at most once per plan, with every sub-resource wanted for it folded into the same request
+with append_to_response. The lookups run a few at a time under a shared request budget, and the movies found are
+written with one statement in the caller's transaction."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy.dialects.postgresql import insert
+import requests
+import tmdb
+from models import db, Movie
+import versions
+
+FIELDS = ("title", "poster_path", "release_date", "overview")
+APPEND_LIMIT = 20 # sub-resources TMDb allows in one append_to_response
+RATE = 20 # TMDb requests started per second, when the caller doesn't bring a budget
+BATCH_SIZE = 100 # movies looked up and written per transaction when backfilling
+
+class RequestBudget:
+    """Spaces out requests shared by several threads so no more than `rate` start each second,
+    and no more than `total` start altogether."""
+
+    def __init__(self, total, rate):
+        self.remaining = total
+        self.interval = 1 / rate
+        self.next_start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Wait for the next request's turn. Returns False once the budget has been spent."""
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            start = max(self.next_start, time.monotonic())
+            self.next_start = start + self.interval
+        time.sleep(max(0, start - time.monotonic()))
+        return True
+
+class FetchPlan:
+    """The movies to look up, and the sub-resources (such as credits or images) wanted for each."""
+
+    def __init__(self):
+        self.lookups = {}
+
+    def add(self, movie_id, append=()):
+        """Look up a movie, along with the given sub-resources. Adding a movie again only adds sub-resources."""
+        resources = self.lookups.setdefault(movie_id, set())
+        resources.update(append)
+        if len(resources) > APPEND_LIMIT:
+            raise ValueError(f"TMDb allows at most {APPEND_LIMIT} sub-resources per request")
+
+    def __len__(self):
+        return len(self.lookups)
+
+    def requests(self):
+        """Returns (movie id, append_to_response value) for each request to make."""
+        return [(movie_id, ",".join(sorted(resources))) for movie_id, resources in self.lookups.items()]
+
+def fetch(movie_id, append, api_key, budget):
+    """Look up one movie with its sub-resources. Returns (movie id, json or None if TMDb has no such movie),
+    or None if the budget ran out first or the request failed."""
+    if not budget.take():
+        return None
+    params = {"append_to_response": append} if append else {}
+    try:
+        res = tmdb.get(f"movie/{movie_id}", api_key, **params)
+        if res.status_code == 404:
+            return movie_id, None
+        res.raise_for_status()
+        return movie_id, res.json()
+    except requests.RequestException:
+        return None
+
+def run(plan, api_key, budget, concurrency=4):
+    """Make the plan's requests, `concurrency` at a time. Returns (movie id, json or None) for each one which finished.
+    A single request is made on the calling thread."""
+    lookups = plan.requests()
+    if len(lookups) <= 1:
+        results = [fetch(movie_id, append, api_key, budget) for movie_id, append in lookups]
+    else:
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(lookups))) as pool:
+            results = list(pool.map(lambda lookup: fetch(*lookup, api_key, budget), lookups))
+    return [r for r in results if r]
+
+def fetch_movies(movie_ids, api_key, append=(), budget=None, concurrency=4):
+    """Look up each of the movies once. Returns (movie id, json or None) for each lookup which finished."""
+    plan = FetchPlan()
+    for movie_id in movie_ids:
+        plan.add(movie_id, append)
+    return run(plan, api_key, budget or RequestBudget(len(plan), RATE), concurrency)
+
+def save(results, now=None):
+    """Write the movies found through to the Movie table with one upsert, committed with the caller's session.
+    Movies TMDb has no record of are left as they are. Returns the ids of movies already in the table whose
+    details changed."""
+    found = {movie_id: tmdb.movie_values(m) for movie_id, m in results if m}
+    if not found:
+        return []
+    now = now or datetime.utcnow()
+
+    current = db.session.query(Movie.id, *[getattr(Movie, field) for field in FIELDS]).filter(Movie.id.in_(list(found)))
+    changed = [row.id for row in current if any(getattr(row, field) != found[row.id][field] for field in FIELDS)]
+
+    stmt = insert(Movie.__table__).values([dict(values, fetched_at=now) for values in found.values()])
+    db.session.execute(stmt.on_conflict_do_update(index_elements=["id"],
+        set_={field: stmt.excluded[field] for field in FIELDS + ("fetched_at",)}))
+    versions.bump("movie", *changed)
+    return changed
+
+def backfill(movie_ids, api_key, budget, concurrency=4, batch_size=BATCH_SIZE):
+    """Look up the movies which aren't in the Movie table yet, committing each batch. Returns how many were added."""
+    movie_ids = list(dict.fromkeys(movie_ids))
+    added = 0
+    for start in range(0, len(movie_ids), batch_size):
+        batch = movie_ids[start:start + batch_size]
+        known = {id for (id,) in db.session.query(Movie.id).filter(Movie.id.in_(batch))}
+        results = fetch_movies([id for id in batch if id not in known], api_key, budget=budget, concurrency=concurrency)
+        save(results)
+        db.session.commit()
+        added += sum(1 for movie_id, m in results if m)
+    return added
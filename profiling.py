@@ -0,0 +1,238 @@
+"""On-demand profiling of single requests and memory sampling of a worker, for admins
+
+Nothing here is hooked into the app unless PROFILING_ENABLED is set, so there is no cost when it is off.
+When it is on, an admin adds ?profile=cprofile (or ?profile=sample, or an X-Profile header) to any url to
+profile that one request. Every profiled response gets a Server-Timing header breaking its time down into
+database, TMDb, and template rendering, and the profile is stored for download from /admin/profiles."""
+
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+from flask import Blueprint, g, request, jsonify, send_from_directory, abort, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event
+import tmdb
+
+MODES = ("cprofile", "sample")
+SAMPLE_INTERVAL = 0.001 # seconds between stack samples
+MAX_STORED = 200 # profiles and memory snapshots kept on disk; the oldest are deleted first
+
+# The last memory snapshot taken in this worker, to compare the next one against.
+previous_snapshot = None
+
+class RequestProfile:
+    """Where the time went in one profiled request."""
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.start = time.perf_counter()
+        self.db = self.tmdb = self.render = 0.0
+        self.queries = self.tmdb_requests = 0
+        self.profiler = None
+
+    def timings(self):
+        """Returns (name, milliseconds, description) for each part of the request."""
+        total = time.perf_counter() - self.start
+        return [
+            ("db", self.db * 1000, f"{self.queries} queries"),
+            ("tmdb", self.tmdb * 1000, f"{self.tmdb_requests} requests"),
+            ("render", self.render * 1000, "templates"),
+            ("total", total * 1000, self.mode),
+        ]
+
+class Sampler:
+    """Samples the stack of one thread at a fixed interval, counting each distinct stack it sees.
+
+    Unlike cProfile it doesn't slow down every function call, so it shows where time goes in code
+    that makes a great many small calls, such as rendering templates."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+
+    def enable(self):
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def dump_stats(self, path):
+        """Write the samples as collapsed stacks, the input format of flame graph tools."""
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+def current():
+    """Returns the profile of the current request, or None if it isn't being profiled."""
+    return g.get("profile") if has_request_context() else None
+
+def init_app(app, db, is_admin):
+    """Hook profiling into the app if PROFILING_ENABLED is set. is_admin is called to check the current user."""
+    if not app.config.get("PROFILING_ENABLED"):
+        return
+    directory = app.config["PROFILE_DIR"]
+    os.makedirs(directory, exist_ok=True)
+
+    @app.before_request
+    def start_profile():
+        mode = request.args.get("profile") or request.headers.get("X-Profile")
+        if mode not in MODES or not is_admin():
+            return
+        g.profile = RequestProfile(mode)
+        g.profile.profiler = cProfile.Profile() if mode == "cprofile" else Sampler(threading.get_ident())
+        g.profile.profiler.enable()
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.pop("profile", None)
+        if not profile:
+            return response
+        profile.profiler.disable()
+
+        timings = profile.timings()
+        name = f"{datetime.utcnow():%Y%m%d-%H%M%S-%f}-{request.endpoint or 'unknown'}"
+        filename = name + (".prof" if profile.mode == "cprofile" else ".txt")
+        profile.profiler.dump_stats(os.path.join(directory, filename))
+        with open(os.path.join(directory, name + ".json"), "w") as f:
+            json.dump({"file": filename, "method": request.method, "path": request.full_path, "status": response.status_code,
+                       "timings": {part: round(ms, 2) for part, ms, desc in timings}}, f)
+        prune(directory)
+
+        response.headers["Server-Timing"] = ", ".join(f'{part};dur={ms:.2f};desc="{desc}"' for part, ms, desc in timings)
+        response.headers["X-Profile"] = filename
+        return response
+
+    @app.teardown_request
+    def stop_profile(exc):
+        # Requests which failed before their response was made still have to stop their profiler.
+        profile = g.pop("profile", None)
+        if profile:
+            profile.profiler.disable()
+
+    @event.listens_for(db.engine, "before_cursor_execute")
+    def start_query(conn, cursor, statement, parameters, context, executemany):
+        if current():
+            conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(db.engine, "after_cursor_execute")
+    def finish_query(conn, cursor, statement, parameters, context, executemany):
+        profile = current()
+        if profile and conn.info.get("profile_query_start"):
+            profile.db += time.perf_counter() - conn.info["profile_query_start"].pop()
+            profile.queries += 1
+
+    def record_tmdb(response, *args, **kwargs):
+        profile = current()
+        if profile:
+            profile.tmdb += response.elapsed.total_seconds()
+            profile.tmdb_requests += 1
+    tmdb.http.hooks["response"].append(record_tmdb)
+
+    def start_render(sender, template, context, **extra):
+        profile = current()
+        if profile:
+            g.profile_render_start = time.perf_counter()
+
+    def finish_render(sender, template, context, **extra):
+        profile = current()
+        if profile and "profile_render_start" in g:
+            profile.render += time.perf_counter() - g.pop("profile_render_start")
+
+    before_render_template.connect(start_render, app, weak=False)
+    template_rendered.connect(finish_render, app, weak=False)
+
+    app.register_blueprint(make_blueprint(directory, is_admin))
+
+def prune(directory):
+    """Delete the oldest profiles and memory snapshots once there are more than MAX_STORED. Every file is named
+    after the time it was made, and a profile's files share their name up to the extension, so sorting the names
+    puts the oldest first whatever kind of file they are."""
+    filenames = os.listdir(directory)
+    names = sorted({os.path.splitext(filename)[0] for filename in filenames})
+    old = set(names[:-MAX_STORED])
+    for filename in filenames:
+        if os.path.splitext(filename)[0] in old:
+            os.remove(os.path.join(directory, filename))
+
+def memory_snapshot(directory, limit=20):
+    """Start tracing memory allocations in this worker, or if they are already being traced, take a snapshot.
+    The snapshot is stored for download, and its biggest allocations are returned along with how much they have
+    grown since the previous snapshot."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(25)
+        return {"tracing": True, "pid": os.getpid(), "message": "Started tracing. Take another snapshot to see allocations."}
+
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    filename = f"{datetime.utcnow():%Y%m%d-%H%M%S-%f}-memory-{os.getpid()}.tracemalloc"
+    snapshot.dump(os.path.join(directory, filename))
+    prune(directory)
+
+    global previous_snapshot
+    stats = snapshot.compare_to(previous_snapshot, "lineno") if previous_snapshot else snapshot.statistics("lineno")
+    previous_snapshot = snapshot
+    current_size, peak = tracemalloc.get_traced_memory()
+    return {
+        "tracing": True,
+        "pid": os.getpid(),
+        "file": filename,
+        "traced_bytes": current_size,
+        "peak_bytes": peak,
+        "top": [{"where": str(stat.traceback[0]), "bytes": stat.size, "growth": getattr(stat, "size_diff", None), "count": stat.count}
+                for stat in stats[:limit]],
+    }
+
+def make_blueprint(directory, is_admin):
+    """Routes for listing and downloading stored profiles, and for memory snapshots. Admins only."""
+    blueprint = Blueprint("profiling", __name__, url_prefix="/admin")
+
+    @blueprint.before_request
+    def require_admin():
+        if not is_admin():
+            abort(403)
+
+    @blueprint.route("/profiles")
+    def list_profiles():
+        """List the stored profiles, newest first."""
+        profiles = []
+        for name in sorted((name for name in os.listdir(directory) if name.endswith(".json")), reverse=True):
+            with open(os.path.join(directory, name)) as f:
+                profiles.append(json.load(f))
+        return jsonify(profiles)
+
+    @blueprint.route("/profiles/<path:filename>")
+    def download_profile(filename):
+        """Download a stored profile or memory snapshot. Open .prof files with pstats or snakeviz."""
+        return send_from_directory(directory, filename, as_attachment=True)
+
+    @blueprint.route("/memory", methods=["POST"])
+    def take_memory_snapshot():
+        """Start tracing memory in the worker which handles this request, or take a snapshot if it already is."""
+        return jsonify(memory_snapshot(directory))
+
+    @blueprint.route("/memory/stop", methods=["POST"])
+    def stop_memory_tracing():
+        """Stop tracing memory in the worker which handles this request."""
+        global previous_snapshot
+        tracemalloc.stop()
+        previous_snapshot = None
+        return jsonify({"tracing": False, "pid": os.getpid()})
+
+    return blueprint
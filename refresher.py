@@ -0,0 +1,74 @@
+"""Keeps the movie metadata copied from TMDb fresh, refreshing it in the background in rate-limited batches"""
+
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam
+import planner
+from models import db, Movie
+
+def stale_movies(limit, max_age):
+    """Returns (id, views) for up to `limit` movies last fetched longer than max_age ago,
+    most viewed since their last refresh first, then the longest since they were fetched."""
+    cutoff = datetime.utcnow() - max_age
+    query = (db.session.query(Movie.id, Movie.views)
+        .filter(db.or_(Movie.fetched_at == None, Movie.fetched_at < cutoff))
+        .order_by(Movie.views.desc(), Movie.fetched_at.asc().nullsfirst())
+        .limit(limit))
+    return query.all()
+
+def refresh(api_key, budget=500, rate=20, concurrency=4, max_age=timedelta(days=7)):
+    """Refresh the most in need of it of the stale movies, spending at most `budget` TMDb requests
+    at no more than `rate` per second with `concurrency` requests in flight.
+
+    All changes are written in one transaction. Returns (movies fetched, movies changed)."""
+    flush_views()
+
+    stale = dict(stale_movies(budget, max_age))
+    if not stale:
+        return 0, 0
+
+    results = planner.fetch_movies(stale, api_key, budget=planner.RequestBudget(budget, rate), concurrency=concurrency)
+    now = datetime.utcnow()
+    changed = planner.save(results, now)
+
+    # Views are counted again from zero after a refresh, including for movies TMDb no longer has.
+    # Views recorded while the batch was being fetched are kept.
+    if results:
+        table = Movie.__table__
+        stmt = (table.update().where(table.c.id == bindparam("b_id"))
+            .values(fetched_at=now, views=db.func.greatest(table.c.views - bindparam("b_seen"), 0)))
+        db.session.execute(stmt, [{"b_id": movie_id, "b_seen": stale[movie_id]} for movie_id, m in results])
+    db.session.commit()
+    return len(results), len(changed)
+
+# Views are counted in memory and written in batches, so viewing a movie doesn't write to its row every time.
+pending_views = Counter()
+pending_lock = threading.Lock()
+last_flush = time.monotonic()
+FLUSH_EVERY = 60 # seconds
+FLUSH_AT = 100 # views
+
+def record_view(movie_id):
+    """Count a view of a movie, writing the counts to the database once enough have built up."""
+    with pending_lock:
+        pending_views[movie_id] += 1
+        due = sum(pending_views.values()) >= FLUSH_AT or time.monotonic() - last_flush >= FLUSH_EVERY
+    if due:
+        flush_views()
+
+def flush_views():
+    """Add the views counted in memory to the movies' view counts. They are written on a connection of their own,
+    so a flush during a page view never commits the request's session."""
+    global last_flush
+    with pending_lock:
+        views = dict(pending_views)
+        pending_views.clear()
+        last_flush = time.monotonic()
+    if not views:
+        return
+    table = Movie.__table__
+    stmt = table.update().where(table.c.id == bindparam("b_id")).values(views=table.c.views + bindparam("b_views"))
+    with db.engine.begin() as conn:
+        conn.execute(stmt, [{"b_id": id, "b_views": count} for id, count in views.items()])
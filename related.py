@@ -0,0 +1,185 @@
+"""Related movies and related tags, computed from how movies have been tagged"""
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from models import db, Role, User, Tag, MovieComment, MovieCommentTag, RelatedMovie, RelatedTag, RelatedDirtyMovie
+import versions
+
+TOP_K = 10 # neighbours kept for each movie and each tag
+CHUNK_SIZE = 128 # movies scored against every other movie at a time
+
+class TagMatrix:
+    """A sparse movie x tag matrix of how many visible comments gave each movie each tag."""
+
+    def __init__(self, counts, movie_ids, tag_ids):
+        self.counts = counts
+        self.movie_ids = movie_ids
+        self.tag_ids = tag_ids
+
+    @classmethod
+    def from_triples(cls, movie_ids, tag_ids, counts):
+        """Build the matrix from parallel arrays of movie ids, tag ids, and counts."""
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        tag_ids = np.asarray(tag_ids, dtype=np.int64)
+        movies = np.unique(movie_ids)
+        tags = np.unique(tag_ids)
+        rows = np.searchsorted(movies, movie_ids)
+        cols = np.searchsorted(tags, tag_ids)
+        matrix = sparse.csr_matrix((np.asarray(counts, dtype=np.float32), (rows, cols)), shape=(len(movies), len(tags)))
+        return cls(matrix, movies, tags)
+
+    def rows_for(self, movie_ids):
+        """Returns the matrix rows of the given movie ids, leaving out movies with no tags."""
+        movie_ids = np.asarray(sorted(movie_ids), dtype=np.int64)
+        rows = np.searchsorted(self.movie_ids, movie_ids)
+        found = rows < len(self.movie_ids)
+        found[found] = self.movie_ids[rows[found]] == movie_ids[found]
+        return rows[found]
+
+def movie_vectors(counts):
+    """Weight tag counts by how rare each tag is (tf-idf) and scale each movie's row to unit length,
+    so the dot product of two rows is their cosine similarity."""
+    n_movies = counts.shape[0]
+    df = np.asarray((counts > 0).sum(axis=0)).ravel()
+    idf = np.log((1 + n_movies) / (1 + df)).astype(np.float32) + 1
+    weighted = sparse.csr_matrix(counts.multiply(idf))
+    norms = np.sqrt(np.asarray(weighted.multiply(weighted).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.csr_matrix(sparse.diags(1 / norms) @ weighted, dtype=np.float32)
+
+def top_k(scores, k):
+    """Returns the column indices and values of the k highest scores in each row of a dense array, best first."""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64), np.empty((scores.shape[0], 0), dtype=scores.dtype)
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+def movie_neighbours(matrix, rows=None, k=TOP_K, chunk_size=CHUNK_SIZE):
+    """Yields (movie id, [(neighbour id, score), ...]) for the given matrix rows, or for every movie.
+
+    Rows are scored against all movies CHUNK_SIZE at a time, which keeps memory to one
+    (movies x CHUNK_SIZE) block however many movies there are."""
+    vectors = movie_vectors(matrix.counts)
+    rows = np.arange(vectors.shape[0]) if rows is None else np.asarray(rows)
+
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        scores = np.ascontiguousarray((vectors @ vectors[chunk].T.toarray()).T)
+        scores[np.arange(len(chunk)), chunk] = 0 # a movie is not related to itself
+        best, best_scores = top_k(scores, k)
+        for i, row in enumerate(chunk):
+            yield matrix.movie_ids[row], [(matrix.movie_ids[col], float(score)) for col, score in zip(best[i], best_scores[i]) if score > 0]
+
+def tag_neighbours(matrix, k=TOP_K):
+    """Yields (tag id, [(neighbour id, score, movies), ...]) for every tag.
+
+    Two tags score by how often they are given to the same movies: the number of movies
+    with both, divided by the geometric mean of the number of movies with each."""
+    tagged = sparse.csr_matrix(matrix.counts > 0, dtype=np.float32)
+    together = np.asarray((tagged.T @ tagged).toarray())
+    totals = np.diag(together).copy()
+    np.fill_diagonal(together, 0)
+    scale = np.sqrt(np.outer(totals, totals))
+    scale[scale == 0] = 1
+    scores = together / scale
+    best, best_scores = top_k(scores, k)
+    for i, tag_id in enumerate(matrix.tag_ids):
+        yield tag_id, [(matrix.tag_ids[col], float(score), int(together[i, col])) for col, score in zip(best[i], best_scores[i]) if score > 0]
+
+def load_matrix():
+    """Build the matrix from the database, following the visibility rules of the movie page:
+    comments from shadow banned and banned users and hidden tags are left out."""
+    query = (db.session.query(MovieComment.movie_id, MovieCommentTag.tag_id, func.count(MovieCommentTag.id))
+        .join(MovieCommentTag, MovieCommentTag.movie_comment_id == MovieComment.id)
+        .join(Tag, Tag.id == MovieCommentTag.tag_id)
+        .join(User, User.id == MovieComment.user_id)
+        .filter(Tag.active == True, User.role.in_([Role.admin, Role.mod, Role.user]))
+        .group_by(MovieComment.movie_id, MovieCommentTag.tag_id))
+    triples = query.all()
+    if not triples:
+        return TagMatrix.from_triples([], [], [])
+    return TagMatrix.from_triples(*zip(*triples))
+
+def save_movie_neighbours(neighbours, batch_size=1000):
+    """Replace the stored neighbours of each movie given, a batch at a time."""
+    batch = []
+    for movie_id, found in neighbours:
+        batch.append((int(movie_id), found))
+        if len(batch) == batch_size:
+            write_movie_batch(batch)
+            batch = []
+    write_movie_batch(batch)
+
+def write_movie_batch(batch):
+    """Replace the stored neighbours of a batch of (movie id, neighbours) pairs."""
+    if not batch:
+        return
+    RelatedMovie.query.filter(RelatedMovie.movie_id.in_([movie_id for movie_id, found in batch])).delete(synchronize_session=False)
+    rows = [{"movie_id": movie_id, "related_movie_id": int(other), "score": score, "rank": rank}
+            for movie_id, found in batch for rank, (other, score) in enumerate(found)]
+    if rows:
+        db.session.execute(RelatedMovie.__table__.insert().values(rows))
+
+def save_tag_neighbours(neighbours):
+    """Replace the stored neighbours of every tag."""
+    RelatedTag.query.delete(synchronize_session=False)
+    rows = [{"tag_id": int(tag_id), "related_tag_id": int(other), "score": score, "movies": movies, "rank": rank}
+            for tag_id, found in neighbours for rank, (other, score, movies) in enumerate(found)]
+    if rows:
+        db.session.execute(RelatedTag.__table__.insert().values(rows))
+
+def refresh(full=False):
+    """Recompute related movies and tags. Returns how many movies were rescored.
+
+    Unless full is set, only movies marked dirty since the last refresh are rescored, along with the movies
+    which list one of them as a neighbour. A dirty movie can also become a new neighbour of a movie which isn't
+    rescored; that is picked up by the next full refresh. Related tags are cheap to compute and are always rebuilt.
+
+    The dirty marks are read before the tags are, and only those marks are cleared, so movies marked while the
+    refresh runs are left for the next one."""
+    marked = [movie_id for (movie_id,) in db.session.query(RelatedDirtyMovie.movie_id)]
+    matrix = load_matrix()
+
+    if full:
+        rows = None
+        RelatedMovie.query.delete(synchronize_session=False)
+        versions.bump_site()
+    else:
+        dirty = set(marked)
+        if dirty:
+            listing = db.session.query(RelatedMovie.movie_id).filter(RelatedMovie.related_movie_id.in_(marked))
+            dirty |= {movie_id for (movie_id,) in listing}
+        # Dirty movies which no longer have any visible tags have no row in the matrix, so just clear them.
+        RelatedMovie.query.filter(RelatedMovie.movie_id.in_(list(dirty))).delete(synchronize_session=False)
+        rows = matrix.rows_for(dirty)
+        versions.bump("movie", *dirty)
+    RelatedDirtyMovie.query.filter(RelatedDirtyMovie.movie_id.in_(marked)).delete(synchronize_session=False)
+
+    save_movie_neighbours(movie_neighbours(matrix, rows))
+    save_tag_neighbours(tag_neighbours(matrix))
+    db.session.commit()
+
+    return len(matrix.movie_ids) if rows is None else len(rows)
+
+def mark_movies_dirty(movie_ids):
+    """Mark movies whose tags have changed so the next refresh rescores them. Committed with the caller's session."""
+    movie_ids = {int(movie_id) for movie_id in movie_ids}
+    if movie_ids:
+        db.session.execute(insert(RelatedDirtyMovie.__table__).values([{"movie_id": movie_id} for movie_id in movie_ids]).on_conflict_do_nothing())
+
+def mark_user_movies_dirty(user_id):
+    """Mark every movie the user has commented on, for when their comments are hidden or shown."""
+    movie_ids = db.session.query(MovieComment.movie_id).filter(MovieComment.user_id == user_id)
+    db.session.execute(insert(RelatedDirtyMovie.__table__).from_select(["movie_id"], movie_ids.distinct().statement).on_conflict_do_nothing())
+
+def mark_tag_movies_dirty(tag_id):
+    """Mark every movie given the tag, for when the tag is hidden, shown, or deleted."""
+    movie_ids = (db.session.query(MovieComment.movie_id)
+        .join(MovieCommentTag, MovieCommentTag.movie_comment_id == MovieComment.id)
+        .filter(MovieCommentTag.tag_id == tag_id))
+    db.session.execute(insert(RelatedDirtyMovie.__table__).from_select(["movie_id"], movie_ids.distinct().statement).on_conflict_do_nothing())
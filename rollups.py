@@ -0,0 +1,106 @@
+"""Rollup tables of how often tags are used, kept up to date as comments and roles change"""
+
+from collections import Counter
+from sqlalchemy import func, tuple_
+from sqlalchemy.orm import joinedload
+from sqlalchemy.dialects.postgresql import insert
+from models import db, User, Tag, MovieComment, MovieCommentTag, TagMovieCount, TagUsage, Role
+import versions
+
+# Only comments from these roles are counted. Shadow banned and banned users' comments are hidden, as on the movie page.
+VISIBLE_ROLES = [Role.admin, Role.mod, Role.user]
+
+def is_visible(user):
+    """Returns True if the user's comments are shown to everyone."""
+    return user.role.value < 30
+
+def apply(deltas):
+    """Apply changes to the rollups. deltas is an iterable of (tag id, movie id, change in count) tuples.
+
+    Runs in the caller's session, so the rollups are committed along with the change to the comments."""
+    totals = Counter()
+    for tag_id, movie_id, delta in deltas:
+        totals[(tag_id, movie_id)] += delta
+    totals = {key: delta for key, delta in totals.items() if delta}
+    if not totals:
+        return
+
+    table = TagMovieCount.__table__
+    stmt = insert(table).values([{"tag_id": tag_id, "movie_id": movie_id, "count": delta} for (tag_id, movie_id), delta in totals.items()])
+    stmt = stmt.on_conflict_do_update(index_elements=[table.c.tag_id, table.c.movie_id], set_={"count": table.c.count + stmt.excluded.count})
+    rows = db.session.execute(stmt.returning(table.c.tag_id, table.c.movie_id, table.c.count)).fetchall()
+
+    # Work out how many movies each tag gained or lost from the counts before and after the change.
+    uses, movies, emptied = Counter(), Counter(), []
+    for tag_id, movie_id, count in rows:
+        delta = totals[(tag_id, movie_id)]
+        uses[tag_id] += delta
+        before = count - delta
+        if before <= 0 < count:
+            movies[tag_id] += 1
+        elif count <= 0 < before:
+            movies[tag_id] -= 1
+        if count <= 0:
+            emptied.append((tag_id, movie_id))
+
+    if emptied:
+        db.session.execute(table.delete().where(tuple_(table.c.tag_id, table.c.movie_id).in_(emptied)))
+
+    usage = TagUsage.__table__
+    stmt = insert(usage).values([{"tag_id": tag_id, "uses": uses[tag_id], "movies": movies[tag_id]} for tag_id in uses])
+    stmt = stmt.on_conflict_do_update(index_elements=[usage.c.tag_id], set_={"uses": usage.c.uses + stmt.excluded.uses, "movies": usage.c.movies + stmt.excluded.movies})
+    db.session.execute(stmt)
+
+def comment_tags_changed(comment, old_tag_ids, new_tag_ids):
+    """Update the rollups for a comment whose tags changed from old_tag_ids to new_tag_ids.
+    Pass an empty list of old tags for a new comment, and of new tags for a deleted one."""
+    if not is_visible(comment.user):
+        return
+    old_tag_ids, new_tag_ids = set(old_tag_ids), set(new_tag_ids)
+    apply([(tag_id, comment.movie_id, -1) for tag_id in old_tag_ids - new_tag_ids] +
+          [(tag_id, comment.movie_id, 1) for tag_id in new_tag_ids - old_tag_ids])
+
+def user_visibility_changed(user, was_visible):
+    """Update the rollups for a user whose comments have just been hidden or shown by a change of role."""
+    if is_visible(user) == was_visible:
+        return
+    sign = 1 if is_visible(user) else -1
+    query = (db.session.query(MovieCommentTag.tag_id, MovieComment.movie_id, func.count(MovieCommentTag.id))
+        .join(MovieComment, MovieComment.id == MovieCommentTag.movie_comment_id)
+        .filter(MovieComment.user_id == user.id)
+        .group_by(MovieCommentTag.tag_id, MovieComment.movie_id))
+    apply((tag_id, movie_id, sign * count) for tag_id, movie_id, count in query)
+
+def rebuild():
+    """Rebuild the rollups from scratch, for after a bulk import or to repair drift."""
+    TagMovieCount.query.delete(synchronize_session=False)
+    TagUsage.query.delete(synchronize_session=False)
+
+    counts = (db.session.query(MovieCommentTag.tag_id, MovieComment.movie_id, func.count(MovieCommentTag.id))
+        .join(MovieComment, MovieComment.id == MovieCommentTag.movie_comment_id)
+        .join(User, User.id == MovieComment.user_id)
+        .filter(User.role.in_(VISIBLE_ROLES))
+        .group_by(MovieCommentTag.tag_id, MovieComment.movie_id))
+    db.session.execute(insert(TagMovieCount.__table__).from_select(["tag_id", "movie_id", "count"], counts.statement))
+
+    usage = (db.session.query(TagMovieCount.tag_id, func.sum(TagMovieCount.count), func.count(TagMovieCount.movie_id))
+        .group_by(TagMovieCount.tag_id))
+    db.session.execute(insert(TagUsage.__table__).from_select(["tag_id", "uses", "movies"], usage.statement))
+    versions.bump_site()
+    db.session.commit()
+
+def movie_tag_stats(movie_id):
+    """Returns (count, tag name, tag id) for every visible tag on a movie, most used first."""
+    return (db.session.query(TagMovieCount.count, Tag.name, Tag.id)
+        .join(Tag, Tag.id == TagMovieCount.tag_id)
+        .filter(TagMovieCount.movie_id == movie_id, Tag.active == True)
+        .order_by(TagMovieCount.count.desc(), Tag.name.desc())
+        .all())
+
+def tag_leaderboard(tag_id, page, per_page):
+    """Returns one page of the movies given a tag the most, as TagMovieCount rows with their movies loaded."""
+    return (TagMovieCount.query.filter_by(tag_id=tag_id)
+        .options(joinedload(TagMovieCount.movie))
+        .order_by(TagMovieCount.count.desc(), TagMovieCount.movie_id.desc())
+        .offset((page - 1) * per_page).limit(per_page)
+        .all())
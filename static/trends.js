@@ -0,0 +1,44 @@
+// Draws a line chart of how often tags were given each day, from the /api/trends endpoint.
+async function drawTagTrend(canvas, params, days) {
+    const until = new Date();
+    until.setUTCDate(until.getUTCDate() + 1);
+    const since = new Date(until);
+    since.setUTCDate(since.getUTCDate() - days);
+    const day = date => date.toISOString().slice(0, 10);
+
+    const query = new URLSearchParams({...params, period: "day", since: day(since), until: day(until)});
+    const res = await fetch(`/api/trends?${query}`);
+    const rows = await res.json();
+
+    // Every day in the range gets a point, including the days no tags were given.
+    const labels = [];
+    for (let d = new Date(since); d < until; d.setUTCDate(d.getUTCDate() + 1)) {
+        labels.push(day(d));
+    }
+    const series = {};
+    for (const row of rows) {
+        series[row.tag] = series[row.tag] || labels.map(() => 0);
+        series[row.tag][labels.indexOf(row.bucket.slice(0, 10))] = row.count;
+    }
+
+    new Chart(canvas, {
+        type: "line",
+        data: {
+            labels: labels,
+            datasets: Object.entries(series).map(([tag, data], i) => ({
+                label: tag,
+                data: data,
+                borderColor: `hsl(${(i * 137) % 360}, 70%, 45%)`,
+                backgroundColor: `hsla(${(i * 137) % 360}, 70%, 45%, 0.5)`,
+            }))
+        },
+        options: {
+            responsive: true,
+            scales: {
+                y: {
+                    beginAtZero: true
+                }
+            }
+        }
+    });
+}
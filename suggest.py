@@ -0,0 +1,244 @@
+"""Type-ahead suggestions of movie titles from a memory-mapped prefix index
+
+The index is a snapshot file holding every movie's normalized title in sorted order, so the titles
+starting with a prefix are one contiguous range found by binary search. Next to the titles is each
+movie's comment count and a sparse table answering "which movie in this range has the most comments"
+in constant time, so the best few matches of even a one letter prefix are found without a scan.
+
+Every worker on a machine maps the same file, so the operating system keeps one copy of it in memory for all of
+them. The file is local to the machine, so each machine keeps its own snapshot fresh: once it is older than the
+refresh interval, the first worker to notice rebuilds it from the database in the background while the others
+carry on with the old one. Movies added since then are kept in a small per-worker list until the next rebuild."""
+
+import fcntl
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from heapq import heappush, heappop
+from models import db, Movie
+
+MAGIC = b"BIMDSUG1"
+HEADER = struct.Struct("<8sII") # magic, number of movies, levels in the sparse table
+RECORD = struct.Struct("<IH") # movie id, title length
+KEY_LENGTH = struct.Struct("<H")
+RELOAD_CHECK_EVERY = 5 # seconds between checks for a newer snapshot
+REFRESH_EVERY = 300 # seconds before a snapshot is rebuilt from the database
+
+def normalize(title):
+    """Lowercase a title, strip accents, and collapse punctuation and spaces, so "Amélie!" matches "amelie"."""
+    title = unicodedata.normalize("NFKD", title)
+    title = "".join(c for c in title if not unicodedata.combining(c))
+    return re.sub(r"[\W_]+", " ", title.lower()).strip()
+
+def build(path, movies):
+    """Write a snapshot to path from (movie id, title, comment count) tuples, replacing any older one atomically."""
+    entries = sorted((normalize(title), id, title, count) for id, title, count in movies)
+    entries = [entry for entry in entries if entry[0]]
+    n = len(entries)
+    levels = max(1, n.bit_length())
+
+    records = bytearray()
+    offsets = []
+    for key, id, title, count in entries:
+        offsets.append(len(records))
+        key, title = key.encode()[:65535], title.encode()[:65535]
+        records += KEY_LENGTH.pack(len(key)) + key + RECORD.pack(id, len(title)) + title
+    offsets.append(len(records))
+
+    # table[j][i] is the position of the movie with the most comments among positions i to i + 2^j - 1.
+    counts = [entry[3] for entry in entries]
+    table = [list(range(n))]
+    for j in range(1, levels):
+        half = 1 << (j - 1)
+        prev = table[-1]
+        row = prev[:]
+        for i in range(n - (1 << j) + 1):
+            a, b = prev[i], prev[i + half]
+            row[i] = a if counts[a] >= counts[b] else b
+        table.append(row)
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, n, levels))
+        f.write(struct.pack(f"<{n + 1}I", *offsets))
+        f.write(struct.pack(f"<{n}I", *counts))
+        for row in table:
+            f.write(struct.pack(f"<{n}I", *row))
+        f.write(records)
+    os.replace(tmp, path)
+
+class Snapshot:
+    """A read-only view of a snapshot file."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.n, self.levels = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a suggestion index")
+
+        view = memoryview(self.map)
+        start = HEADER.size
+        self.offsets = view[start:start + 4 * (self.n + 1)].cast("I")
+        start += 4 * (self.n + 1)
+        self.counts = view[start:start + 4 * self.n].cast("I")
+        start += 4 * self.n
+        self.table = [view[start + 4 * self.n * j:start + 4 * self.n * (j + 1)].cast("I") for j in range(self.levels)]
+        self.records = start + 4 * self.n * self.levels
+
+    def key(self, i):
+        """Returns the normalized title at position i as bytes."""
+        start = self.records + self.offsets[i]
+        (length,) = KEY_LENGTH.unpack_from(self.map, start)
+        return self.map[start + 2:start + 2 + length]
+
+    def movie(self, i):
+        """Returns (movie id, title) at position i."""
+        start = self.records + self.offsets[i]
+        (length,) = KEY_LENGTH.unpack_from(self.map, start)
+        start += 2 + length
+        id, length = RECORD.unpack_from(self.map, start)
+        start += RECORD.size
+        return id, self.map[start:start + length].decode()
+
+    def prefix_range(self, prefix):
+        """Returns the range of positions whose normalized titles start with prefix (as bytes)."""
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        start, hi = lo, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid)[:len(prefix)] == prefix:
+                lo = mid + 1
+            else:
+                hi = mid
+        return start, lo
+
+    def most_commented(self, lo, hi):
+        """Returns the position of the movie with the most comments in positions lo to hi - 1."""
+        j = (hi - lo).bit_length() - 1
+        a, b = self.table[j][lo], self.table[j][hi - (1 << j)]
+        return a if self.counts[a] >= self.counts[b] else b
+
+    def top(self, prefix, limit):
+        """Returns up to limit (comment count, movie id, title) tuples for the most commented movies matching prefix."""
+        lo, hi = self.prefix_range(prefix)
+        results, heap = [], []
+        if lo < hi:
+            best = self.most_commented(lo, hi)
+            heappush(heap, (-self.counts[best], best, lo, hi))
+        while heap and len(results) < limit:
+            count, best, lo, hi = heappop(heap)
+            results.append((-count,) + self.movie(best))
+            for a, b in ((lo, best), (best + 1, hi)):
+                if a < b:
+                    i = self.most_commented(a, b)
+                    heappush(heap, (-self.counts[i], i, a, b))
+        return results
+
+class SuggestionIndex:
+    """The snapshot this worker has mapped, plus movies added since it was built.
+
+    With a rebuild function, which writes a new snapshot to the path, the snapshot is rebuilt once it is older
+    than refresh_every seconds."""
+
+    def __init__(self, path, rebuild=None, refresh_every=REFRESH_EVERY):
+        self.path = path
+        self.rebuild = rebuild
+        self.refresh_every = refresh_every
+        self.snapshot = None
+        self.added = [] # sorted (normalized title, movie id, title, time added)
+        self.checked = 0
+        self.rebuilding = False
+        self._lock = threading.Lock()
+
+    def reload_if_changed(self):
+        """Map the snapshot file if it is newer than the one in use, and start rebuilding it if it is stale.
+        Checks at most every few seconds."""
+        now = time.monotonic()
+        if now - self.checked < RELOAD_CHECK_EVERY:
+            return
+        self.checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if self.rebuild and (mtime is None or time.time() - mtime > self.refresh_every):
+            self.start_rebuild()
+        if mtime is None or (self.snapshot and mtime <= self.snapshot.mtime):
+            return
+        # The old snapshot is unmapped once no request is still reading it.
+        with self._lock:
+            self.snapshot = Snapshot(self.path)
+            # Movies added before this snapshot was built are in it now.
+            self.added = [entry for entry in self.added if entry[3] > self.snapshot.mtime]
+
+    def start_rebuild(self):
+        """Rebuild the snapshot on a background thread, unless this worker already is."""
+        with self._lock:
+            if self.rebuilding:
+                return
+            self.rebuilding = True
+        threading.Thread(target=self.rebuild_snapshot, daemon=True).start()
+
+    def rebuild_snapshot(self):
+        """Rebuild the snapshot if it is still stale once no other worker on this machine is rebuilding it."""
+        try:
+            with open(f"{self.path}.lock", "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                try:
+                    if time.time() - os.stat(self.path).st_mtime <= self.refresh_every:
+                        return # another worker has just rebuilt it
+                except FileNotFoundError:
+                    pass
+                self.rebuild()
+        except Exception:
+            logging.exception(f"Rebuilding the suggestion snapshot {self.path} failed")
+        finally:
+            self.rebuilding = False
+            self.checked = 0 # map the new snapshot on the next suggestion
+
+    def add(self, movie_id, title):
+        """Add a movie which has just been stored in the database."""
+        key = normalize(title)
+        if key:
+            with self._lock:
+                insort(self.added, (key, movie_id, title, time.time()))
+
+    def suggest(self, query, limit=10):
+        """Returns up to limit (movie id, title) pairs whose titles start with query, most commented first."""
+        prefix = normalize(query)
+        if not prefix:
+            return []
+        self.reload_if_changed()
+
+        results = self.snapshot.top(prefix.encode(), limit) if self.snapshot else []
+        seen = {id for count, id, title in results}
+        with self._lock:
+            # New movies have no comments yet, so they rank after the snapshot's matches.
+            for key, id, title, added in self.added[bisect_left(self.added, (prefix,)):]:
+                if len(results) >= limit or not key.startswith(prefix):
+                    break
+                if id not in seen:
+                    results.append((0, id, title))
+                    seen.add(id)
+        return [(id, title) for count, id, title in results]
+
+def load_movies():
+    """Returns (movie id, title, comment count) for every movie in the database."""
+    return db.session.query(Movie.id, Movie.title, Movie.comment_count).yield_per(10000)
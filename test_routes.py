@@ -1,8 +1,24 @@
 import os
-from unittest import TestCase
+import gzip
+import time
+import tempfile
+from datetime import datetime
+from unittest import TestCase, mock
+from flask import Flask
 from app import app, DATABASE_NAME
-from models import db, User, Movie, Tag, MovieComment, MovieCommentTag
+from types import SimpleNamespace
+from models import db, Role, User, Movie, Tag, MovieComment, MovieCommentTag, ContentVersion, ModerationJob, TagMovieCount, MovieTagTrend, TagTrend, RelatedDirtyMovie, TrendDirtyHour
 from forms import UserSignUpForm
+from metrics import metrics
+from planner import FetchPlan, RequestBudget
+from tmdb import API_POSTER_PATH
+from limiter import MemoryBackend, DatabaseBackend
+from compression import Compressor
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+from sqlalchemy.exc import IntegrityError
+import bulk_import, rollups, counters, refresher, suggest, moderation, trends, planner, related, viewmodels, profiling
+import numpy as np
 
 os.environ['DATABASE_URL'] = f'postgresql:///{DATABASE_NAME}_test'
 app.config['WTF_CSRF_ENABLED'] = False
@@ -10,6 +26,42 @@ db.create_all()
 
 TEST_ID_1 = 666
 
+def add_test_data(test):
+    """Add an admin, a user, a tag, two movies, and a tagged comment by the user on the first movie, with the
+    rollups and counters to match. They are deleted again, with everything which refers to them and any movie the
+    test adds as new_movie_id, when the test ends."""
+
+    users = [User(id=TEST_ID_1 + i, username=f"test_{name}", email=f"test_{name}@test.com", password="test_password", role=role)
+             for i, name, role in ((0, "admin", Role.admin), (1, "user", Role.user))]
+    movies = [Movie(id=TEST_ID_1 + i, title=f"Test Movie {i}") for i in range(2)]
+    db.session.add_all(users + movies)
+    db.session.flush()
+    tag = Tag(id=TEST_ID_1, name="test_tag", description="", active=True, created_by_id=TEST_ID_1)
+    comment = MovieComment(id=TEST_ID_1, movie_id=TEST_ID_1, user_id=TEST_ID_1 + 1, subject="Test Comment", text="Test comment text.")
+    db.session.add_all([tag, comment])
+    db.session.flush()
+    db.session.add(MovieCommentTag(movie_comment_id=TEST_ID_1, tag_id=TEST_ID_1))
+    rollups.comment_tags_changed(comment, [], [TEST_ID_1])
+    counters.comment_added(comment)
+    db.session.commit()
+    test.addCleanup(remove_test_data)
+    return SimpleNamespace(admin_id=TEST_ID_1, user_id=TEST_ID_1 + 1, username="test_user", tag_id=TEST_ID_1,
+                           movie_id=TEST_ID_1, other_movie_id=TEST_ID_1 + 1, new_movie_id=TEST_ID_1 + 2, comment_id=TEST_ID_1)
+
+def remove_test_data():
+    """Delete the data added by add_test_data, after writing out any views of its movies still counted in memory.
+    The database cascades the deletes to comments, tags and rollups."""
+
+    db.session.rollback()
+    refresher.flush_views()
+    ids = [TEST_ID_1, TEST_ID_1 + 1, TEST_ID_1 + 2]
+    ModerationJob.query.filter(ModerationJob.created_by_id.in_(ids)).delete(synchronize_session=False)
+    ContentVersion.query.filter(ContentVersion.key.in_(ids)).delete(synchronize_session=False)
+    RelatedDirtyMovie.query.filter(RelatedDirtyMovie.movie_id.in_(ids)).delete(synchronize_session=False)
+    Movie.query.filter(Movie.id.in_(ids)).delete(synchronize_session=False)
+    User.query.filter(User.id.in_(ids)).delete(synchronize_session=False)
+    db.session.commit()
+
 class FlaskRouteTests(TestCase):
     """Tests for the Flask routes."""
 
@@ -113,4 +165,700 @@ class FlaskRouteTests(TestCase):
     def test_search(self):
         """Test a search of the database."""
         pass
-        # TODO
\ No newline at end of file
+        # TODO
+
+    def test_login_rate_limit(self):
+        """Test that repeated log in attempts are turned away once the rate limit is reached."""
+
+        with app.test_client() as client:
+            for i in range(5):
+                res = client.post("/login", data={"username": "nobody", "password": "wrong_password"}, environ_base={"REMOTE_ADDR": "10.0.0.26"})
+                self.assertEqual(res.status_code, 200) # failed log ins re-render the form
+
+            res = client.post("/login", data={"username": "nobody", "password": "wrong_password"}, environ_base={"REMOTE_ADDR": "10.0.0.26"})
+
+            self.assertEqual(res.status_code, 429) # the sixth attempt is over the limit
+            self.assertIn("Retry-After", res.headers) # it should say when to try again
+
+    def test_rate_limit_eviction(self):
+        """Test that making room for new buckets keeps depleted buckets, judging each by its own policy."""
+
+        backend = MemoryBackend()
+        backend.MAX_KEYS = 2
+        for i in range(5):
+            backend.take("login:1", 5, 5 / 60, 0) # a depleted bucket with a slow refill
+        backend.take("search:1", 10, 100, 0) # a bucket which refills completely by the next take
+        backend.take("search:2", 10, 100, 1)
+
+        self.assertFalse(backend.take("login:1", 5, 5 / 60, 1)[0])
+        self.assertNotIn("search:1", backend._buckets)
+
+    def test_rate_limit_pruning(self):
+        """Test that the database backend deletes buckets idle for longer than a full refill, and keeps the others."""
+
+        def remove_buckets():
+            db.session.execute("DELETE FROM rate_limit_bucket WHERE key LIKE 'test:%'")
+            db.session.commit()
+
+        self.addCleanup(remove_buckets)
+        backend = DatabaseBackend(db.engine, idle_after=100)
+        backend.take("test:idle", 5, 1, 1000)
+        backend.take("test:recent", 5, 1, 1020)
+
+        backend.take("test:recent", 5, 1, 1110) # the first take PRUNE_EVERY seconds after the last prune prunes again
+        keys = [key for (key,) in db.session.execute("SELECT key FROM rate_limit_bucket WHERE key LIKE 'test:%'")]
+
+        self.assertEqual(keys, ["test:recent"])
+        self.assertEqual(backend.prune(1110), 0)
+
+    def test_import_rejects_non_objects(self):
+        """Test that import rows which aren't objects are reported as invalid rather than stopping the import."""
+
+        report = bulk_import.run("movies", [[1, 2], "x", None])
+
+        self.assertEqual(report.invalid, 3)
+        self.assertEqual(report.inserted, 0)
+        self.assertIn("row 1: row is not an object", report.errors)
+
+    def test_import_reports_bad_json(self):
+        """Test that an ndjson line which isn't valid json is reported with its line number, and the rest imported."""
+
+        data = add_test_data(self)
+        with tempfile.NamedTemporaryFile("w", suffix=".ndjson") as f:
+            f.write(f'{{"id": {data.new_movie_id}, "title": "Test Movie 2"}}\n\n{{"id": 1, "title": \n')
+            f.flush()
+            report = bulk_import.run("movies", bulk_import.read_rows(f.name))
+
+        self.assertEqual((report.inserted, report.invalid), (1, 1))
+        self.assertIn("row 2: line 3 is not valid json", report.errors)
+
+    def test_import_tags_active_by_default(self):
+        """Test that tags imported from a csv file with a blank active cell are active, and "false" ones aren't."""
+
+        data = add_test_data(self)
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as f:
+            f.write("name,active\ntest_blank,\ntest_hidden,false\n")
+            f.flush()
+            report = bulk_import.run("tags", bulk_import.read_rows(f.name), {"created_by_id": data.admin_id})
+
+        self.assertEqual(report.inserted, 2)
+        self.assertTrue(Tag.query.filter_by(name="test_blank").one().active)
+        self.assertFalse(Tag.query.filter_by(name="test_hidden").one().active)
+
+    def test_export_requires_admin(self):
+        """Test that the data export can't be downloaded without logging in as an admin."""
+
+        with app.test_client() as client:
+            res = client.get("/admin/export/comments.csv")
+
+            self.assertEqual(res.status_code, 302) # it should redirect to the home page
+
+    def test_suggest_empty_query(self):
+        """Test that an empty query gets no suggestions."""
+
+        with app.test_client() as client:
+            res = client.get("/api/suggest?q=")
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.json, [])
+
+    def test_suggestion_index(self):
+        """Test that suggestions are the movies whose titles start with the query, most commented first, ignoring case
+        and accents, with movies added since the snapshot after the ones in it."""
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "suggest.idx")
+            suggest.build(path, [(1, "Amélie", 3), (2, "American Beauty", 9), (3, "Alien", 5), (4, "Am I Alone?", 1),
+                                 (5, "Brazil", 7), (6, "!!!", 2)])
+            index = suggest.SuggestionIndex(path)
+            index.add(7, "AMERICAN PSYCHO")
+            index.add(2, "American Beauty")
+
+            self.assertEqual(index.suggest("am"), [(2, "American Beauty"), (1, "Amélie"), (4, "Am I Alone?"), (7, "AMERICAN PSYCHO")])
+            self.assertEqual(index.suggest("AMÉ"), [(2, "American Beauty"), (1, "Amélie"), (7, "AMERICAN PSYCHO")])
+            self.assertEqual(index.suggest("ame", limit=1), [(2, "American Beauty")])
+            self.assertEqual(index.suggest("a"), [(2, "American Beauty"), (3, "Alien"), (1, "Amélie"), (4, "Am I Alone?"),
+                                                  (7, "AMERICAN PSYCHO")])
+            self.assertEqual(index.suggest("am i"), [(4, "Am I Alone?")])
+            self.assertEqual(index.suggest("z"), [])
+            self.assertEqual(index.suggest("?!"), [])
+
+    def test_suggestion_refresh(self):
+        """Test that a stale snapshot is rebuilt in the background, and the new one used once it is ready."""
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "suggest.idx")
+            suggest.build(path, [(1, "Alien", 1)])
+            os.utime(path, (0, 0))
+            index = suggest.SuggestionIndex(path, lambda: suggest.build(path, [(1, "Alien", 1), (2, "Aliens", 2)]), refresh_every=60)
+
+            index.suggest("alien")
+            while index.rebuilding:
+                time.sleep(0.01)
+            self.assertEqual(index.suggest("alien"), [(2, "Aliens"), (1, "Alien")])
+
+    def test_moderation_requires_mod(self):
+        """Test that the moderation console and api can't be used without logging in as a moderator."""
+
+        with app.test_client() as client:
+            res = client.get("/admin/moderation")
+            self.assertEqual(res.status_code, 302) # it should redirect to the home page
+
+            res = client.post("/api/moderation/jobs", json={"action": "delete_tag", "tag": "test"})
+            self.assertEqual(res.status_code, 403)
+
+    def test_moderation_rejects_non_objects(self):
+        """Test that a moderation job can't be started from a body which isn't a json object."""
+
+        data = add_test_data(self)
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["curr_user"] = data.admin_id
+            for body in ("[]", '"delete_tag"', "null", "{"):
+                res = client.post("/api/moderation/jobs", data=body, content_type="application/json")
+
+                self.assertEqual(res.status_code, 400)
+
+    def test_moderation_rejects_bad_types(self):
+        """Test that moderation parameters of the wrong type are rejected with a 400, leaving the session usable."""
+
+        data = add_test_data(self)
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["curr_user"] = data.admin_id
+            for body in ({"action": "delete_comments", "movie": "abc"}, {"action": "delete_comments", "movie": 2 ** 40},
+                         {"action": "delete_comments", "movie": True}, {"action": "delete_comments", "contains": 5},
+                         {"action": "delete_comments", "username": ["test_user"]}, {"action": "delete_tag", "tag": {"name": "x"}},
+                         {"action": "merge_tags", "tag": "test_tag", "into": 1}, {"action": ["delete_tag"]}):
+                res = client.post("/api/moderation/jobs", json=body)
+
+                self.assertEqual(res.status_code, 400, body)
+                self.assertIn("error", res.json)
+
+            res = client.get("/admin/moderation")
+            self.assertEqual(res.status_code, 200)
+
+    def test_moderation_job(self):
+        """Test that a job deletes the matching comments a chunk at a time, recording its progress after each chunk,
+        and takes them out of the rollups and counters."""
+
+        data = add_test_data(self)
+        comment = MovieComment(movie_id=data.movie_id, user_id=data.admin_id, subject="Another", text="Another comment.")
+        db.session.add(comment)
+        db.session.flush()
+        counters.comment_added(comment)
+        db.session.commit()
+
+        job = moderation.create("delete_comments", {"movie": data.movie_id}, User.query.get(data.admin_id))
+        progress = []
+        with mock.patch.object(moderation.versions, "bump_site", side_effect=lambda: progress.append(job.done)):
+            job = moderation.run(job.id, chunk_size=1)
+
+        self.assertEqual((job.status, job.total, job.done), ("done", 2, 2))
+        self.assertEqual(progress, [1, 2])
+        self.assertEqual(MovieComment.query.filter_by(movie_id=data.movie_id).count(), 0)
+        self.assertEqual(Movie.query.get(data.movie_id).comment_count, 0)
+        self.assertIsNone(TagMovieCount.query.get((data.tag_id, data.movie_id)))
+
+    def test_moderation_job_resumes(self):
+        """Test that running a job which stopped part way through finishes the rows it had left."""
+
+        data = add_test_data(self)
+        job = moderation.create("delete_comments", {"username": data.username}, User.query.get(data.admin_id))
+        job.status, job.total, job.done = "running", 3, 2
+        db.session.commit()
+
+        job = moderation.run(job.id)
+
+        self.assertEqual((job.status, job.total, job.done), ("done", 3, 3))
+        self.assertIsNone(MovieComment.query.get(data.comment_id))
+
+    def test_moderation_job_fails_counting(self):
+        """Test that a job whose rows can't be counted is marked as failed."""
+
+        data = add_test_data(self)
+        job = moderation.create("delete_comments", {"movie": data.movie_id}, User.query.get(data.admin_id))
+        with mock.patch.object(moderation.DeleteComments, "count", side_effect=RuntimeError("count failed")):
+            job = moderation.run(job.id)
+
+        self.assertEqual((job.status, job.error), ("failed", "count failed"))
+        self.assertIsNotNone(MovieComment.query.get(data.comment_id))
+
+    def test_profiling_disabled(self):
+        """Test that requests aren't profiled unless profiling is enabled."""
+
+        with app.test_client() as client:
+            res = client.get("/about?profile=cprofile")
+
+            self.assertEqual(res.status_code, 200)
+            self.assertNotIn("Server-Timing", res.headers)
+            self.assertEqual(client.get("/admin/profiles").status_code, 404)
+
+    def test_profiling(self):
+        """Test that a profiled request gets its timings and stores its profile, and that a request without
+        ?profile doesn't."""
+
+        with tempfile.TemporaryDirectory() as directory:
+            profiled = Flask(__name__)
+            profiled.config.update(PROFILING_ENABLED=True, PROFILE_DIR=directory)
+            profiled.add_url_rule("/", "index", lambda: "ok")
+            profiling.init_app(profiled, db, lambda: True)
+
+            with profiled.test_client() as client:
+                self.assertNotIn("Server-Timing", client.get("/").headers)
+                for mode, extension in (("cprofile", ".prof"), ("sample", ".txt")):
+                    res = client.get(f"/?profile={mode}")
+
+                    self.assertIn("total;dur=", res.headers["Server-Timing"])
+                    self.assertTrue(res.headers["X-Profile"].endswith(extension))
+                    self.assertIn(res.headers["X-Profile"], os.listdir(directory))
+                self.assertEqual(len(client.get("/admin/profiles").json), 2)
+
+    def test_profile_pruning(self):
+        """Test that pruning deletes the oldest profiles and memory snapshots, every file of each, whatever kind."""
+
+        with tempfile.TemporaryDirectory() as directory:
+            names = ["20200101-000000-000000-index.json", "20200101-000000-000000-index.prof",
+                     "20200102-000000-000000-memory-1.tracemalloc",
+                     "20200103-000000-000000-index.json", "20200103-000000-000000-index.txt",
+                     "20200104-000000-000000-memory-1.tracemalloc"]
+            for name in names:
+                open(os.path.join(directory, name), "w").close()
+
+            with mock.patch.object(profiling, "MAX_STORED", 2):
+                profiling.prune(directory)
+
+            self.assertEqual(sorted(os.listdir(directory)), names[3:])
+
+    def test_movie_listings(self):
+        """Test that the trending and most discussed listings load, and unknown listings don't."""
+
+        with app.test_client() as client:
+            self.assertEqual(client.get("/movies/trending").status_code, 200)
+            self.assertEqual(client.get("/movies/discussed?page=2").status_code, 200)
+            self.assertEqual(client.get("/movies/newest").status_code, 404)
+
+    def test_page_numbers(self):
+        """Test that listings and user pages treat page numbers which aren't positive numbers as the first page."""
+
+        data = add_test_data(self)
+        with app.test_client() as client:
+            for page in ("abc", "0", "-3"):
+                res = client.get(f"/movies/discussed?page={page}")
+                self.assertEqual(res.status_code, 200)
+                self.assertIn(b"Test Movie 0", res.data)
+
+                res = client.get(f"/u/{data.username}?page={page}")
+                self.assertEqual(res.status_code, 200)
+                self.assertIn(b"Test Comment", res.data)
+
+    def test_deleting_newest_comment(self):
+        """Test that deleting a movie's newest comment moves its last comment time back to the newest one left,
+        and that reconcile repairs a last comment time which has drifted."""
+
+        data = add_test_data(self)
+        older = MovieComment.query.get(data.comment_id)
+        for single in (True, False):
+            newer = MovieComment(movie_id=data.movie_id, user_id=data.admin_id, subject="Newer", text="Newer.")
+            db.session.add(newer)
+            db.session.flush()
+            counters.comment_added(newer)
+            db.session.commit()
+            self.assertEqual(Movie.query.get(data.movie_id).last_comment_at, newer.created_at)
+
+            if single:
+                counters.comment_deleted(newer)
+            else:
+                counters.comments_deleted([newer.id])
+            db.session.delete(newer)
+            db.session.commit()
+
+            movie = Movie.query.get(data.movie_id)
+            self.assertEqual((movie.comment_count, movie.last_comment_at), (1, older.created_at))
+
+        Movie.query.filter_by(id=data.movie_id).update({"last_comment_at": datetime(2000, 1, 1)})
+        db.session.commit()
+        self.assertEqual(counters.reconcile(), 1)
+        self.assertEqual(Movie.query.get(data.movie_id).last_comment_at, older.created_at)
+        self.assertEqual(counters.reconcile(), 0)
+
+    def test_comment_permissions(self):
+        """Test who may edit and delete a comment: its author both, mods delete users' comments, admins both."""
+
+        viewer = lambda role, id=1: SimpleNamespace(id=id, role=role)
+        cases = [(None, 2, Role.user, (False, False)),
+                 (viewer(Role.user, 2), 2, Role.user, (True, True)),
+                 (viewer(Role.user), 2, Role.user, (False, False)),
+                 (viewer(Role.mod), 2, Role.user, (False, True)),
+                 (viewer(Role.mod), 2, Role.admin, (False, False)),
+                 (viewer(Role.admin), 2, Role.user, (True, True))]
+        for comment_viewer, user_id, role, expected in cases:
+            self.assertEqual(viewmodels.comment_permissions(comment_viewer, user_id, role), expected)
+
+    def test_load_comments(self):
+        """Test that comment views carry their tags and the viewer's permissions, and leave out hidden comments
+        when asked."""
+
+        data = add_test_data(self)
+        criteria = MovieComment.movie_id == data.movie_id
+
+        (comment,) = viewmodels.load_comments(None, criteria)
+        self.assertEqual((comment.id, comment.username, comment.movie_title, comment.subject),
+                         (data.comment_id, data.username, "Test Movie 0", "Test Comment"))
+        self.assertEqual(comment.tags, [viewmodels.TagView(data.tag_id, "test_tag")])
+        self.assertEqual((comment.can_edit, comment.can_delete), (False, False))
+
+        (comment,) = viewmodels.load_comments(User.query.get(data.user_id), criteria)
+        self.assertEqual((comment.can_edit, comment.can_delete), (True, True))
+        self.assertEqual(viewmodels.load_comments(None, criteria, page=2, per_page=1), [])
+
+        User.query.get(data.user_id).role = Role.shadow_ban
+        db.session.commit()
+        self.assertEqual(viewmodels.load_comments(None, criteria, visible_only=True), [])
+        self.assertEqual(len(viewmodels.load_comments(None, criteria)), 1)
+
+    def test_user_page_buttons(self):
+        """Test that the edit and delete buttons on a user's page are only shown to those who may use them."""
+
+        data = add_test_data(self)
+        edit_link = f"/m/{data.movie_id}/c/{data.comment_id}/edit".encode()
+        with app.test_client() as client:
+            self.assertNotIn(edit_link, client.get(f"/u/{data.username}").data)
+
+            with client.session_transaction() as sess:
+                sess["curr_user"] = data.user_id
+            self.assertIn(edit_link, client.get(f"/u/{data.username}").data)
+
+    def test_unban_restores_counters(self):
+        """Test that banning a user takes their comments out of the movie counters, and unbanning puts them back
+        along with the time of the movie's last comment."""
+
+        data = add_test_data(self)
+        user = User.query.get(data.user_id)
+        comment = MovieComment.query.get(data.comment_id)
+        for role, count, last_comment_at in ((Role.full_ban, 0, None), (Role.user, 1, comment.created_at)):
+            was_visible = rollups.is_visible(user)
+            user.role = role
+            counters.user_visibility_changed(user, was_visible)
+            db.session.commit()
+
+            movie = Movie.query.get(data.movie_id)
+            self.assertEqual((movie.comment_count, movie.last_comment_at), (count, last_comment_at))
+
+        Movie.query.filter_by(id=data.movie_id).update({"last_comment_at": None})
+        db.session.commit()
+        self.assertEqual(counters.reconcile(), 1)
+        self.assertEqual(Movie.query.get(data.movie_id).last_comment_at, comment.created_at)
+
+    def test_tag_trends(self):
+        """Test that tag trends load for a range of days, and unknown periods are rejected."""
+
+        with app.test_client() as client:
+            res = client.get("/api/trends?period=day&since=2020-01-01&until=2020-02-01")
+
+            self.assertEqual(res.status_code, 200)
+            self.assertIsInstance(res.json, list)
+            self.assertEqual(client.get("/api/trends?period=week").status_code, 400)
+
+    def test_new_tags_mark_their_hour(self):
+        """Test that tagging a comment marks the hour the tag was given in, whatever the app's clock says."""
+
+        def remove_hours():
+            TrendDirtyHour.query.delete()
+            db.session.commit()
+
+        data = add_test_data(self)
+        self.addCleanup(remove_hours)
+        clock = mock.Mock(wraps=datetime)
+        clock.utcnow.return_value = datetime(2000, 1, 1)
+        with app.test_client() as client, mock.patch("app.datetime", clock):
+            with client.session_transaction() as sess:
+                sess["curr_user"] = data.admin_id
+            res = client.post(f"/m/{data.movie_id}/add", data={"subject": "New", "text": "New.", "tags": [data.tag_id]})
+            self.assertEqual(res.status_code, 302)
+
+        comment = MovieComment.query.filter_by(movie_id=data.movie_id, user_id=data.admin_id).one()
+        (tag,) = MovieCommentTag.query.filter_by(movie_comment_id=comment.id).all()
+        hours = [hour for (hour,) in db.session.query(TrendDirtyHour.bucket)]
+        self.assertEqual(hours, [trends.truncate(tag.created_at, "hour")])
+
+    def test_trend_aggregation(self):
+        """Test that aggregating recounts the dirty hours, and the days they fall in, for the movie and over every movie."""
+
+        data = add_test_data(self)
+        comment = MovieComment(movie_id=data.movie_id, user_id=data.admin_id, subject="Another", text="Another comment.")
+        db.session.add(comment)
+        db.session.flush()
+        db.session.add(MovieCommentTag(movie_comment_id=comment.id, tag_id=data.tag_id))
+        times = [datetime(2020, 1, 1, 10, 30), datetime(2020, 1, 1, 14, 10)]
+        for (tag,), given in zip(db.session.query(MovieCommentTag.id).filter_by(tag_id=data.tag_id).order_by(MovieCommentTag.id), times):
+            MovieCommentTag.query.filter_by(id=tag).update({"created_at": given})
+        trends.mark_hours(times)
+        db.session.commit()
+
+        trends.aggregate()
+
+        movie_counts = {(row.period, row.bucket): row.count for row in MovieTagTrend.query.filter_by(movie_id=data.movie_id, tag_id=data.tag_id)}
+        tag_counts = {(row.period, row.bucket): row.count for row in TagTrend.query.filter_by(tag_id=data.tag_id)}
+        expected = {("hour", datetime(2020, 1, 1, 10)): 1, ("hour", datetime(2020, 1, 1, 14)): 1, ("day", datetime(2020, 1, 1)): 2}
+        self.assertEqual(movie_counts, expected)
+        self.assertEqual(tag_counts, expected)
+
+    def test_pool_metrics(self):
+        """Test that checkouts from the connection pool are counted in the metrics."""
+
+        with app.test_client() as client:
+            client.get("/")
+            snapshot = metrics.snapshot()
+
+            self.assertGreater(snapshot["counters"]["db.pool.checkouts"], 0)
+            self.assertIn("db.pool.checkout", snapshot["timings"])
+
+    def test_compression(self):
+        """Test that pages are gzipped for clients which accept it, and sent as they are for those which don't."""
+
+        with app.test_client() as client:
+            res = client.get("/about", headers={"Accept-Encoding": "gzip"})
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.headers.get("Content-Encoding"), "gzip")
+            self.assertIn(b"<html", gzip.decompress(res.data))
+            self.assertIsNone(client.get("/about").headers.get("Content-Encoding"))
+
+    def test_compression_write(self):
+        """Test that what an app sends through the write callable is compressed along with the rest of its body."""
+
+        def legacy_app(environ, start_response):
+            write = start_response("200 OK", [("Content-Type", "text/plain")])
+            write(b"written " * 200)
+            return [b"returned " * 200]
+
+        res = Client(Compressor(legacy_app), BaseResponse).get("/", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(res.headers.get("Content-Encoding"), "gzip")
+        self.assertEqual(gzip.decompress(res.data), b"written " * 200 + b"returned " * 200)
+
+    def test_comment_writes_are_atomic(self):
+        """Test that a comment and its tags are only saved together with the rollups and counters made from them."""
+
+        data = add_test_data(self)
+        failure = IntegrityError("INSERT", {}, Exception("failed"))
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess["curr_user"] = data.admin_id
+            with mock.patch.object(counters, "comment_added", side_effect=failure):
+                res = client.post(f"/m/{data.movie_id}/add", data={"subject": "New", "text": "New.", "tags": [data.tag_id]})
+            self.assertEqual(res.status_code, 302)
+            self.assertIsNone(MovieComment.query.filter_by(movie_id=data.movie_id, user_id=data.admin_id).one_or_none())
+
+            with client.session_transaction() as sess:
+                sess["curr_user"] = data.user_id
+            with mock.patch.object(rollups, "comment_tags_changed", side_effect=failure):
+                res = client.post(f"/m/{data.movie_id}/c/{data.comment_id}/edit", data={"subject": "Edited", "text": "Edited."})
+            self.assertEqual(res.status_code, 302)
+
+        self.assertEqual(MovieComment.query.get(data.comment_id).subject, "Test Comment")
+        self.assertEqual(MovieCommentTag.query.filter_by(movie_comment_id=data.comment_id).count(), 1)
+        self.assertEqual(TagMovieCount.query.get((data.tag_id, data.movie_id)).count, 1)
+
+    def test_page_etag(self):
+        """Test that an anonymous visitor's copy of a movie page is reused until a comment on it is edited."""
+
+        data = add_test_data(self)
+        with app.test_client() as client, app.test_client() as commenter:
+            res = client.get(f"/m/{data.movie_id}")
+            etag = res.headers.get("ETag")
+            self.assertEqual(res.status_code, 200)
+            self.assertIsNotNone(etag)
+
+            res = client.get(f"/m/{data.movie_id}", headers={"If-None-Match": etag})
+            self.assertEqual(res.status_code, 304)
+
+            with commenter.session_transaction() as sess:
+                sess["curr_user"] = data.user_id
+            res = commenter.post(f"/m/{data.movie_id}/c/{data.comment_id}/edit",
+                                 data={"subject": "Edited Comment", "text": "Edited.", "tags": [data.tag_id]})
+            self.assertEqual(res.status_code, 302)
+
+            res = client.get(f"/m/{data.movie_id}", headers={"If-None-Match": etag})
+            self.assertEqual(res.status_code, 200)
+            self.assertNotEqual(res.headers.get("ETag"), etag)
+            self.assertIn(b"Edited Comment", res.data)
+
+    def test_fetch_plan(self):
+        """Test that a fetch plan looks each movie up once, with all of its sub-resources in one request."""
+
+        plan = FetchPlan()
+        plan.add(2, ["credits"])
+        plan.add(2, ["images", "credits"])
+        plan.add(3)
+
+        self.assertEqual(sorted(plan.requests()), [(2, "credits,images"), (3, "")])
+
+    def test_planner(self):
+        """Test that backfilling looks up only the movies not in the database, and that saving a plan's results
+        updates the movies whose details changed and bumps their page versions."""
+
+        data = add_test_data(self)
+        tmdb_movies = {data.movie_id: {"id": data.movie_id, "title": "Test Movie 0 (Director's Cut)", "poster_path": "/p.jpg",
+                                       "release_date": "2001-02-03", "overview": "Longer."},
+                       data.new_movie_id: {"id": data.new_movie_id, "title": "Test Movie 2", "poster_path": None,
+                                           "release_date": "", "overview": ""}}
+        requested = []
+
+        def get(path, api_key, **params):
+            movie_id = int(path.split("/")[1])
+            requested.append((movie_id, params.get("append_to_response")))
+            found = tmdb_movies.get(movie_id)
+            return SimpleNamespace(status_code=200 if found else 404, json=lambda: found, raise_for_status=lambda: None)
+
+        with mock.patch("tmdb.get", side_effect=get):
+            added = planner.backfill([data.movie_id, data.new_movie_id, data.new_movie_id, 1], "key", RequestBudget(10, 1000))
+            self.assertEqual(added, 1)
+            self.assertEqual(sorted(requested), [(1, None), (data.new_movie_id, None)])
+            self.assertEqual(Movie.query.get(data.new_movie_id).title, "Test Movie 2")
+            self.assertEqual(Movie.query.get(data.movie_id).title, "Test Movie 0")
+
+            plan = FetchPlan()
+            plan.add(data.movie_id, ["credits"])
+            plan.add(data.new_movie_id)
+            results = planner.run(plan, "key", RequestBudget(10, 1000))
+            self.assertEqual(len(results), 2)
+            self.assertIn((data.movie_id, "credits"), requested)
+            self.assertEqual(planner.save(results), [data.movie_id])
+            db.session.commit()
+
+        movie = Movie.query.get(data.movie_id)
+        self.assertEqual((movie.title, movie.overview), ("Test Movie 0 (Director's Cut)", "Longer."))
+        self.assertEqual(movie.poster_path, API_POSTER_PATH + "/p.jpg")
+        self.assertEqual(ContentVersion.query.filter_by(scope="movie", key=data.movie_id).one().version, 1)
+        self.assertIsNone(ContentVersion.query.filter_by(scope="movie", key=data.new_movie_id).one_or_none())
+
+    def test_fetch_movies_bad_file(self):
+        """Test that fetch-movies reports a line of its file which isn't a movie id as a usage error."""
+
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("2\nabc\n")
+            f.flush()
+            res = app.test_cli_runner().invoke(args=["fetch-movies", "--file", f.name])
+
+        self.assertEqual(res.exit_code, 2)
+        self.assertIn("line 2 is not a movie id", res.output)
+
+    def test_search_adds_movies(self):
+        """Test that the movies in search results which aren't in the database yet are added to it."""
+
+        data = add_test_data(self)
+        results = [{"id": data.movie_id, "title": "Renamed", "poster_path": None, "release_date": "", "overview": ""},
+                   {"id": data.new_movie_id, "title": "Test Movie 2", "poster_path": "/p.jpg", "release_date": "2001-02-03",
+                    "overview": "New."}]
+        response = SimpleNamespace(json=lambda: {"results": results, "total_pages": 1})
+
+        with mock.patch("tmdb.get", return_value=response), app.test_client() as client:
+            res = client.get("/search?q=test")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b"Test Movie 2", res.data)
+        movie = Movie.query.get(data.new_movie_id)
+        self.assertEqual((movie.title, movie.overview), ("Test Movie 2", "New."))
+        self.assertEqual(movie.poster_path, API_POSTER_PATH + "/p.jpg")
+        self.assertEqual(Movie.query.get(data.movie_id).title, "Test Movie 0")
+
+
+    def test_tag_matrix(self):
+        """Test that the tag matrix has a row per movie and a column per tag, in id order, summing repeated pairs."""
+
+        matrix = related.TagMatrix.from_triples([3, 1, 3, 3], [20, 20, 10, 20], [1, 2, 3, 4])
+
+        self.assertEqual(list(matrix.movie_ids), [1, 3])
+        self.assertEqual(list(matrix.tag_ids), [10, 20])
+        self.assertEqual(matrix.counts.toarray().tolist(), [[0, 2], [3, 5]])
+        self.assertEqual(list(matrix.rows_for([5, 3, 1])), [0, 1])
+
+    def test_movie_vectors(self):
+        """Test that movie vectors have unit length, and that a movie with no tags is left as zeros."""
+
+        counts = np.array([[2, 0], [1, 1], [0, 0]], dtype=np.float32)
+        vectors = related.movie_vectors(related.sparse.csr_matrix(counts)).toarray()
+
+        np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), [1, 1, 0], rtol=1e-6)
+        np.testing.assert_allclose(vectors[0], [1, 0], rtol=1e-6)
+
+    def test_top_k(self):
+        """Test that the best scores of each row come first, and that k is capped at the number of columns."""
+
+        scores = np.array([[0.1, 0.5, 0.3], [0.9, 0.0, 0.2]])
+
+        best, best_scores = related.top_k(scores, 2)
+        self.assertEqual(best.tolist(), [[1, 2], [0, 2]])
+        np.testing.assert_allclose(best_scores, [[0.5, 0.3], [0.9, 0.2]])
+        self.assertEqual(related.top_k(scores, 10)[0].tolist(), [[1, 2, 0], [0, 2, 1]])
+        self.assertEqual(related.top_k(scores[:, :0], 3)[0].shape, (2, 0))
+
+    def test_movie_neighbours(self):
+        """Test that movies are ranked by the cosine of their tag vectors, that tied neighbours score the same,
+        and that movies sharing no tags aren't neighbours."""
+
+        # Movie 1 has tag 10, movie 2 tags 10 and 20, movie 3 tag 20, and movie 4 only tag 30.
+        matrix = related.TagMatrix.from_triples([1, 2, 2, 3, 4], [10, 10, 20, 20, 30], [1, 1, 1, 1, 1])
+        neighbours = {movie_id: found for movie_id, found in related.movie_neighbours(matrix, k=10, chunk_size=2)}
+
+        self.assertEqual([movie_id for movie_id, score in neighbours[1]], [2])
+        self.assertAlmostEqual(neighbours[1][0][1], 2 ** -0.5, places=5)
+        self.assertEqual(sorted(movie_id for movie_id, score in neighbours[2]), [1, 3])
+        self.assertAlmostEqual(neighbours[2][0][1], neighbours[2][1][1], places=6)
+        self.assertEqual(neighbours[4], [])
+
+        only = list(related.movie_neighbours(matrix, rows=matrix.rows_for([3]), k=1))
+        self.assertEqual([(movie_id, [other for other, score in found]) for movie_id, found in only], [(3, [2])])
+
+    def test_tag_neighbours(self):
+        """Test that tags score by the movies they share over the geometric mean of the movies each is given to."""
+
+        matrix = related.TagMatrix.from_triples([1, 2, 2, 3, 4], [10, 10, 20, 20, 30], [1, 1, 1, 1, 1])
+        neighbours = dict(related.tag_neighbours(matrix, k=10))
+
+        self.assertEqual([(other, movies) for other, score, movies in neighbours[10]], [(20, 1)])
+        self.assertAlmostEqual(neighbours[10][0][1], 0.5, places=6)
+        self.assertEqual(neighbours[30], [])
+
+    def test_related_refresh_keeps_new_marks(self):
+        """Test that a full refresh leaves movies marked dirty while it runs marked for the next refresh."""
+
+        data = add_test_data(self)
+        related.mark_movies_dirty([data.movie_id])
+        db.session.commit()
+        load_matrix = related.load_matrix
+
+        def load_while_marking():
+            related.mark_movies_dirty([data.other_movie_id])
+            return load_matrix()
+
+        with mock.patch.object(related, "load_matrix", side_effect=load_while_marking):
+            related.refresh(full=True)
+
+        self.assertEqual([movie_id for (movie_id,) in db.session.query(RelatedDirtyMovie.movie_id)], [data.other_movie_id])
+
+    def test_tag_page_numbers(self):
+        """Test that tag pages treat page numbers which aren't positive numbers as the first page."""
+
+        data = add_test_data(self)
+        with app.test_client() as client:
+            for page in ("abc", "0", "-3"):
+                res = client.get(f"/tags/{data.tag_id}?page={page}")
+
+                self.assertEqual(res.status_code, 200)
+                self.assertIn(b"Test Movie 0", res.data)
+
+    def test_view_flush_keeps_session(self):
+        """Test that writing the view counts doesn't commit what the request's session has pending."""
+
+        data = add_test_data(self)
+        Movie.query.get(data.movie_id).title = "Uncommitted Title"
+        refresher.record_view(data.movie_id)
+        refresher.flush_views()
+        db.session.rollback()
+
+        movie = Movie.query.get(data.movie_id)
+        self.assertEqual(movie.title, "Test Movie 0")
+        self.assertEqual(movie.views, 1)
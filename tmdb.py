@@ -0,0 +1,31 @@
+"""Requests to The Movie Database API"""
+
+import requests
+from models import Movie
+
+API_BASE_URL = "https://api.themoviedb.org/3/"
+API_POSTER_PATH = "https://image.tmdb.org/t/p/w600_and_h900_bestv2"
+NO_POSTER_PATH = "./static/no-poster.png"
+
+# Reused between requests so batches of lookups share connections to TMDb.
+http = requests.Session()
+
+def get(path, api_key, **params):
+    """Send a GET request to TMDb and return the response."""
+    return http.get(f"{API_BASE_URL}{path}", params={"api_key": api_key, **params}, timeout=10)
+
+def poster_path(m):
+    """Takes movie json from TMDb and returns the full url of its poster, or the placeholder if it has none."""
+    if "poster_path" in m and m["poster_path"]:
+        return API_POSTER_PATH + m["poster_path"]
+    return NO_POSTER_PATH
+
+def movie_values(m):
+    """Takes movie json from TMDb and returns the values we keep for it in the Movie table."""
+    return {
+        "id": m["id"],
+        "title": m["title"],
+        "poster_path": poster_path(m),
+        "release_date": Movie.convert_release_date_to_datetime(m),
+        "overview": m["overview"],
+    }
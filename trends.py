@@ -0,0 +1,144 @@
+"""Hourly and daily trends of how often movies are given each tag, aggregated incrementally from the comment tags
+
+Comment tags are counted in the hour they were given. Whenever tags are given, taken away, or hidden by a change
+of role, the hours they were given in are marked dirty, and the aggregator recounts only those hours (and the
+days they fall in), so keeping the trends up to date costs the same however many comments there are."""
+
+from datetime import timedelta
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+from models import db, User, Tag, MovieComment, MovieCommentTag, MovieTagTrend, TagTrend, TrendDirtyHour
+from rollups import VISIBLE_ROLES
+
+PERIODS = {"hour": timedelta(hours=1), "day": timedelta(days=1)}
+BATCH_HOURS = 500 # dirty hours recounted per transaction
+MAX_BUCKETS = 2000 # the most hours or days one request for a trend may cover
+DAY_LOCK = 7301 # the first key of the advisory locks taken on days being recounted
+
+def truncate(time, period):
+    """Returns the start of the hour or day the time falls in."""
+    time = time.replace(minute=0, second=0, microsecond=0)
+    return time.replace(hour=0) if period == "day" else time
+
+def ranges(buckets, step):
+    """Group sorted bucket starts into (start, end) ranges of consecutive buckets."""
+    found = []
+    for bucket in buckets:
+        if found and found[-1][1] == bucket:
+            found[-1][1] = bucket + step
+        else:
+            found.append([bucket, bucket + step])
+    return found
+
+def in_ranges(column, found):
+    """A condition that column falls in one of the (start, end) ranges."""
+    return db.or_(*[db.and_(column >= start, column < end) for start, end in found])
+
+def mark_hours(times):
+    """Mark the hours the given times fall in as dirty. Committed with the caller's session."""
+    hours = {truncate(time, "hour") for time in times}
+    if hours:
+        db.session.execute(insert(TrendDirtyHour.__table__).values([{"bucket": hour} for hour in hours]).on_conflict_do_nothing())
+
+def mark_comment_tags(query):
+    """Mark the hours in which the comment tags selected by query were given. The query is filtered and joined
+    from MovieCommentTag."""
+    hours = query.with_entities(func.date_trunc("hour", MovieCommentTag.created_at)).distinct()
+    db.session.execute(insert(TrendDirtyHour.__table__).from_select(["bucket"], hours.statement).on_conflict_do_nothing())
+
+def mark_comments(comment_ids):
+    """Mark the hours the tags on the comments were given in, for when the comments are deleted."""
+    mark_comment_tags(MovieCommentTag.query.filter(MovieCommentTag.movie_comment_id.in_(comment_ids)))
+
+def mark_user(user_id):
+    """Mark the hours the tags on the user's comments were given in, for when their comments are hidden or shown."""
+    mark_comment_tags(MovieCommentTag.query
+        .join(MovieComment, MovieComment.id == MovieCommentTag.movie_comment_id)
+        .filter(MovieComment.user_id == user_id))
+
+def mark_tag(tag_id):
+    """Mark the hours the tag was given in, for when it is moved to another tag or deleted."""
+    mark_comment_tags(MovieCommentTag.query.filter(MovieCommentTag.tag_id == tag_id))
+
+def recount(hours):
+    """Recount the trends for the given hours, the days they fall in, and the totals over every movie."""
+    hours = sorted(hours)
+    days = sorted({truncate(hour, "day") for hour in hours})
+    movie_trend, tag_trend = MovieTagTrend.__table__, TagTrend.__table__
+
+    # Each hour is counted from the comment tags given in it.
+    db.session.execute(movie_trend.delete().where(db.and_(movie_trend.c.period == "hour", movie_trend.c.bucket.in_(hours))))
+    bucket = func.date_trunc("hour", MovieCommentTag.created_at)
+    counts = (db.session.query(db.literal("hour"), MovieComment.movie_id, bucket, MovieCommentTag.tag_id, func.count(MovieCommentTag.id))
+        .join(MovieComment, MovieComment.id == MovieCommentTag.movie_comment_id)
+        .join(User, User.id == MovieComment.user_id)
+        .filter(in_ranges(MovieCommentTag.created_at, ranges(hours, PERIODS["hour"])), User.role.in_(VISIBLE_ROLES))
+        .group_by(MovieComment.movie_id, bucket, MovieCommentTag.tag_id))
+    db.session.execute(insert(movie_trend).from_select(["period", "movie_id", "bucket", "tag_id", "count"], counts.statement))
+
+    # Each day is the sum of its hours. Another aggregator may be recounting other hours of the same days, so the
+    # days are locked, in order, until this transaction ends, and the sums below see the hours it has committed.
+    for day in days:
+        db.session.execute(db.select([func.pg_advisory_xact_lock(DAY_LOCK, day.toordinal())]))
+    day_hours = [day + timedelta(hours=h) for day in days for h in range(24)]
+    db.session.execute(movie_trend.delete().where(db.and_(movie_trend.c.period == "day", movie_trend.c.bucket.in_(days))))
+    bucket = func.date_trunc("day", MovieTagTrend.bucket)
+    counts = (db.session.query(db.literal("day"), MovieTagTrend.movie_id, bucket, MovieTagTrend.tag_id, func.sum(MovieTagTrend.count))
+        .filter(MovieTagTrend.period == "hour", MovieTagTrend.bucket.in_(day_hours))
+        .group_by(MovieTagTrend.movie_id, bucket, MovieTagTrend.tag_id))
+    db.session.execute(insert(movie_trend).from_select(["period", "movie_id", "bucket", "tag_id", "count"], counts.statement))
+
+    # The totals over every movie are the sums of the movies' hours and days.
+    for period, buckets in (("hour", hours), ("day", days)):
+        db.session.execute(tag_trend.delete().where(db.and_(tag_trend.c.period == period, tag_trend.c.bucket.in_(buckets))))
+        counts = (db.session.query(MovieTagTrend.period, MovieTagTrend.tag_id, MovieTagTrend.bucket, func.sum(MovieTagTrend.count))
+            .filter(MovieTagTrend.period == period, MovieTagTrend.bucket.in_(buckets))
+            .group_by(MovieTagTrend.period, MovieTagTrend.tag_id, MovieTagTrend.bucket))
+        db.session.execute(insert(tag_trend).from_select(["period", "tag_id", "bucket", "count"], counts.statement))
+
+def aggregate(batch_hours=BATCH_HOURS):
+    """Recount every dirty hour, a batch of hours per transaction. Returns how many hours were recounted.
+
+    Each batch claims its hours with SKIP LOCKED, so two aggregators running at once never recount the same hour,
+    and hours marked dirty again while a batch runs are left for the next batch. Batches with hours in the same day
+    recount that day one after the other, each under an advisory lock on the day, so the second sums the hours
+    the first committed instead of racing it to replace the day's rows."""
+    done = 0
+    while True:
+        claimed = (db.session.query(TrendDirtyHour.bucket).order_by(TrendDirtyHour.bucket)
+            .limit(batch_hours).with_for_update(skip_locked=True).subquery())
+        table = TrendDirtyHour.__table__
+        hours = [hour for (hour,) in db.session.execute(table.delete().where(table.c.bucket.in_(claimed)).returning(table.c.bucket))]
+        if not hours:
+            db.session.commit()
+            return done
+        recount(hours)
+        db.session.commit()
+        done += len(hours)
+
+def rebuild(batch_hours=BATCH_HOURS):
+    """Mark every hour in which a tag was given as dirty, then recount them all. Returns how many hours were recounted."""
+    db.session.query(MovieTagTrend).delete(synchronize_session=False)
+    db.session.query(TagTrend).delete(synchronize_session=False)
+    mark_comment_tags(MovieCommentTag.query)
+    db.session.commit()
+    return aggregate(batch_hours)
+
+def series(period, since, until, movie_id=None, tag_id=None):
+    """Returns (bucket, tag id, tag name, count) for each hour or day from since up to until, for one movie or
+    over every movie, optionally for one tag. Hidden tags are left out. Raises ValueError for too long a range."""
+    if period not in PERIODS:
+        raise ValueError(f"period must be one of {', '.join(PERIODS)}")
+    since = truncate(since, period)
+    if until <= since or (until - since) / PERIODS[period] > MAX_BUCKETS:
+        raise ValueError(f"the range must cover between 1 and {MAX_BUCKETS} {period}s")
+
+    trend = MovieTagTrend if movie_id else TagTrend
+    query = (db.session.query(trend.bucket, trend.tag_id, Tag.name, trend.count)
+        .join(Tag, Tag.id == trend.tag_id)
+        .filter(trend.period == period, trend.bucket >= since, trend.bucket < until, Tag.active == True))
+    if movie_id:
+        query = query.filter(trend.movie_id == movie_id)
+    if tag_id:
+        query = query.filter(trend.tag_id == tag_id)
+    return query.order_by(trend.bucket, trend.tag_id).all()
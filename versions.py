@@ -0,0 +1,61 @@
+"""Content versions of movie and user pages, and the weak ETags made from them
+
+Everything which changes what a movie or user page shows bumps that page's version in the same transaction,
+and changes which touch many pages at once bump the site version. An anonymous visitor's ETag can then be
+checked with one small query, before any of the page is loaded."""
+
+import hashlib
+import os
+from sqlalchemy import tuple_
+from sqlalchemy.dialects.postgresql import insert
+from models import db, User, MovieComment, ContentVersion
+
+SITE = ("site", 0)
+
+def release_hash(root):
+    """A hash of the app's modules and templates, so pages get new ETags when a new version of the app is deployed.
+    Every worker running the same code gets the same hash."""
+    digest = hashlib.sha1()
+    paths = [os.path.join(root, name) for name in os.listdir(root) if name.endswith(".py")]
+    for directory, dirs, files in os.walk(os.path.join(root, "templates")):
+        paths += [os.path.join(directory, name) for name in files]
+    for path in sorted(paths):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+def bump(scope, *keys):
+    """Bump the versions of the pages with the given keys. Committed with the caller's session."""
+    if keys:
+        stmt = insert(ContentVersion.__table__).values([{"scope": scope, "key": key, "version": 1} for key in set(keys)])
+        db.session.execute(stmt.on_conflict_do_update(index_elements=["scope", "key"],
+            set_={"version": ContentVersion.__table__.c.version + 1}))
+
+def bump_site():
+    """Bump the site version, changing the ETag of every page."""
+    bump(*SITE)
+
+def bump_comment(comment):
+    """Bump the versions of the pages showing a comment: its movie's and its user's."""
+    bump("movie", comment.movie_id)
+    bump("user", comment.user_id)
+
+def bump_user(user_id):
+    """Bump the version of a user's page and of every movie page showing their comments, for when their name or
+    role changes."""
+    bump("user", user_id)
+    movies = (db.session.query(db.literal("movie"), MovieComment.movie_id, db.literal(1))
+        .filter(MovieComment.user_id == user_id).distinct())
+    stmt = insert(ContentVersion.__table__).from_select(["scope", "key", "version"], movies.statement)
+    db.session.execute(stmt.on_conflict_do_update(index_elements=["scope", "key"],
+        set_={"version": ContentVersion.__table__.c.version + 1}))
+
+def etag(scope, key, release):
+    """Returns the ETag for the page with the given key: its version, the site version, and the release."""
+    versions = dict(db.session.query(ContentVersion.scope, ContentVersion.version)
+        .filter(tuple_(ContentVersion.scope, ContentVersion.key).in_([(scope, key), SITE])))
+    return f"{scope}-{key}-{versions.get(scope, 0)}-{versions.get('site', 0)}-{release}"
+
+def user_key(username):
+    """Returns the id of the user with the given name, or None if there is none."""
+    return db.session.query(User.id).filter_by(username=username).scalar()
@@ -0,0 +1,47 @@
+"""Plain tuples of what the templates show, loaded with a couple of queries instead of lazy ORM attributes"""
+
+from collections import namedtuple, defaultdict
+from models import db, User, Tag, Movie, MovieComment, MovieCommentTag
+from rollups import VISIBLE_ROLES
+
+CommentView = namedtuple("CommentView", "id user_id username movie_id movie_title subject text tags can_edit can_delete")
+TagView = namedtuple("TagView", "id name")
+
+def comment_permissions(viewer, user_id, role):
+    """Returns (can edit, can delete) for the viewer on a comment left by a user with the given id and role.
+    Users can change their own comments, mods can delete other users' comments, and admins can do both."""
+    if not viewer:
+        return False, False
+    own = viewer.id == user_id
+    can_delete = own or (viewer.role.value < 11 and role.value > 1)
+    return can_delete and (own or viewer.role.value == 0), can_delete
+
+def load_comments(viewer, *criteria, visible_only=False, page=None, per_page=20):
+    """Returns a CommentView for each comment matching the criteria, oldest first, with its active tags.
+
+    viewer is the user the edit and delete buttons are shown for. With visible_only set, comments from
+    shadow banned and banned users are left out. With page set, only that page of comments is loaded."""
+    query = (db.session.query(MovieComment.id, MovieComment.user_id, User.username, User.role, MovieComment.movie_id,
+                              Movie.title, MovieComment.subject, MovieComment.text)
+        .join(User, User.id == MovieComment.user_id)
+        .join(Movie, Movie.id == MovieComment.movie_id)
+        .filter(*criteria)
+        .order_by(MovieComment.id))
+    if visible_only:
+        query = query.filter(User.role.in_(VISIBLE_ROLES))
+    if page:
+        query = query.offset((page - 1) * per_page).limit(per_page)
+    rows = query.all()
+    if not rows:
+        return []
+
+    tags = defaultdict(list)
+    tag_rows = (db.session.query(MovieCommentTag.movie_comment_id, Tag.id, Tag.name)
+        .join(Tag, Tag.id == MovieCommentTag.tag_id)
+        .filter(MovieCommentTag.movie_comment_id.in_([row.id for row in rows]), Tag.active == True)
+        .order_by(MovieCommentTag.id))
+    for comment_id, tag_id, name in tag_rows:
+        tags[comment_id].append(TagView(tag_id, name))
+
+    return [CommentView(id, user_id, username, movie_id, title, subject or "", text or "", tags[id], *comment_permissions(viewer, user_id, role))
+            for id, user_id, username, role, movie_id, title, subject, text in rows]